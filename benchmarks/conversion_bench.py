@@ -0,0 +1,171 @@
+"""
+Times the video conversion path (`probe_video`, `plan_instagram_video`, `transform_for_instagram`)
+over a synthetic corpus generated with ffmpeg's lavfi test sources. Needs ffmpeg and ffprobe
+on PATH; the corpus is generated once and reused across runs so results stay comparable.
+
+    python benchmarks/conversion_bench.py --workers 1 2 4 --aspect original 9_16 --output before.json
+    python benchmarks/conversion_bench.py --cases mkv_opus hevc_4k --runs 3
+
+Every case is probed and converted on its own first (per-case timings), then the whole corpus
+is converted at once through a thread pool of each `--workers` size, the way uploads run
+ffmpeg via `asyncio.to_thread`. Results are written as JSON.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+# main.py validates these at import time; the benchmark never connects to anything.
+for name, value in {
+    "TELEGRAM_API_ID": "1", "TELEGRAM_API_HASH": "bench", "TELEGRAM_BOT_TOKEN": "1:bench",
+    "ADMIN_ID": "1", "MONGO_DB": "mongodb://bench.invalid",
+}.items():
+    os.environ.setdefault(name, value)
+
+# name: (extension, duration, video source + encoder args, audio encoder args, extra muxer args)
+# Each case targets one branch of plan_instagram_video.
+CORPUS = {
+    "mp4_aac_compliant": ("mp4", "short", "testsrc2=size=1080x1920:rate=30", ["-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p"], ["-c:a", "aac"], ["-movflags", "+faststart"]),
+    "mp4_moov_at_end": ("mp4", "short", "testsrc2=size=1080x1920:rate=30", ["-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p"], ["-c:a", "aac"], []),
+    "mkv_opus": ("mkv", "short", "testsrc2=size=1920x1080:rate=30", ["-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p"], ["-c:a", "libopus"], []),
+    "webm_vorbis": ("webm", "short", "testsrc2=size=1280x720:rate=30", ["-c:v", "libvpx-vp9", "-deadline", "realtime", "-cpu-used", "8", "-b:v", "2M"], ["-c:a", "libvorbis"], []),
+    "hevc_4k": ("mp4", "short", "testsrc2=size=3840x2160:rate=30", ["-c:v", "libx265", "-preset", "ultrafast", "-tag:v", "hvc1", "-pix_fmt", "yuv420p"], ["-c:a", "aac"], ["-movflags", "+faststart"]),
+    "long_mkv_opus": ("mkv", "long", "testsrc2=size=1280x720:rate=30", ["-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p"], ["-c:a", "libopus"], []),
+    "long_mp4_moov_at_end": ("mp4", "long", "testsrc2=size=1080x1920:rate=30", ["-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p"], ["-c:a", "aac"], []),
+}
+
+def ffmpeg_version():
+    result = subprocess.run(["ffmpeg", "-version"], check=True, capture_output=True, text=True)
+    return result.stdout.splitlines()[0]
+
+def generate_case(name, corpus_dir, durations):
+    ext, length, video_source, video_args, audio_args, mux_args = CORPUS[name]
+    seconds = durations[length]
+    path = os.path.join(corpus_dir, f"{name}_{seconds}s.{ext}")
+    if os.path.exists(path):
+        return path
+    command = [
+        "ffmpeg", "-y", "-f", "lavfi", "-i", f"{video_source}:duration={seconds}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=48000:duration={seconds}",
+        *video_args, *audio_args, *mux_args, path + ".part." + ext,
+    ]
+    try:
+        subprocess.run(command, check=True, capture_output=True, text=True)
+    except subprocess.CalledProcessError as e:
+        sys.exit(f"Generating '{name}' failed (is ffmpeg built with the needed encoders?):\n{e.stderr[-2000:]}")
+    os.replace(path + ".part." + ext, path)
+    return path
+
+def convert_case(main, source, aspect_ratio, workdir):
+    """One pass of the conversion path on a private copy of `source`. Returns timings in seconds."""
+    case_dir = tempfile.mkdtemp(dir=workdir)
+    try:
+        path = os.path.join(case_dir, os.path.basename(source))
+        shutil.copyfile(source, path)
+
+        start = time.perf_counter()
+        info = main.probe_video(path)
+        probe_seconds = time.perf_counter() - start
+
+        plan = main.plan_instagram_video(info, aspect_ratio)
+        start = time.perf_counter()
+        output_bytes = info.size
+        if plan["action"] != "noop":
+            output = os.path.join(case_dir, "out.mp4")
+            main.transform_for_instagram(path, output, plan)
+            output_bytes = os.path.getsize(output)
+        return {
+            "action": plan["action"], "probe_seconds": probe_seconds,
+            "convert_seconds": time.perf_counter() - start, "input_bytes": info.size, "output_bytes": output_bytes,
+        }
+    finally:
+        shutil.rmtree(case_dir, ignore_errors=True)
+
+def run(args, workdir):
+    import main
+
+    durations = {"short": args.short_seconds, "long": args.long_seconds}
+    os.makedirs(args.corpus, exist_ok=True)
+    sources = {}
+    for name in args.cases:
+        print(f"corpus: {name}...", file=sys.stderr)
+        sources[name] = generate_case(name, args.corpus, durations)
+
+    jobs = [(name, aspect) for name in args.cases for aspect in args.aspect]
+    per_case = []
+    for name, aspect in jobs:
+        runs = [convert_case(main, sources[name], aspect, workdir) for _ in range(args.runs)]
+        result = {
+            "case": name, "aspect_ratio": aspect, "action": runs[0]["action"],
+            "duration_seconds": round(main.probe_video(sources[name]).duration, 2),
+            "input_bytes": runs[0]["input_bytes"], "output_bytes": runs[0]["output_bytes"],
+            "probe_seconds": round(statistics.median(r["probe_seconds"] for r in runs), 4),
+            "convert_seconds": round(statistics.median(r["convert_seconds"] for r in runs), 4),
+        }
+        per_case.append(result)
+        print(f"{name:<22} {aspect:<9} {result['action']:<10} probe={result['probe_seconds']:.3f}s convert={result['convert_seconds']:.3f}s", file=sys.stderr)
+
+    pools = []
+    for workers in args.workers:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(lambda job: convert_case(main, sources[job[0]], job[1], workdir), jobs))
+        elapsed = time.perf_counter() - start
+        pools.append({
+            "workers": workers, "jobs": len(jobs), "wall_seconds": round(elapsed, 3),
+            "jobs_per_minute": round(len(jobs) / elapsed * 60, 1),
+            "busy_seconds": round(sum(r["probe_seconds"] + r["convert_seconds"] for r in results), 3),
+        })
+        print(f"workers={workers:<3} wall={elapsed:.2f}s  {pools[-1]['jobs_per_minute']} jobs/min", file=sys.stderr)
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count(), "ffmpeg": ffmpeg_version()},
+        "corpus": {"short_seconds": args.short_seconds, "long_seconds": args.long_seconds, "runs": args.runs},
+        "cases": per_case,
+        "pools": pools,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cases", nargs="+", choices=sorted(CORPUS), default=list(CORPUS))
+    parser.add_argument("--aspect", nargs="+", choices=["original", "9_16"], default=["original", "9_16"])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--runs", type=int, default=1, help="per-case repetitions; the median is reported")
+    parser.add_argument("--short-seconds", type=int, default=5)
+    parser.add_argument("--long-seconds", type=int, default=90)
+    parser.add_argument("--corpus", default=os.path.join(tempfile.gettempdir(), "conversion_bench_corpus"))
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    if not (shutil.which("ffmpeg") and shutil.which("ffprobe")):
+        sys.exit("ffmpeg and ffprobe must be on PATH.")
+    args.corpus = os.path.abspath(args.corpus)
+    output = os.path.abspath(args.output) if args.output else None
+
+    # main.py writes bot.log into the working directory.
+    workdir = tempfile.mkdtemp(prefix="conversion_bench_")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        report = run(args, workdir)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {output}", file=sys.stderr)
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,75 @@
+"""
+Compares the sequential `download_media` path with `fast_download.download_parallel`.
+
+Needs the bot credentials from `.env` and a message the bot can read that holds a large video:
+
+    python benchmarks/download_bench.py <chat_id> <message_id> --parts 1 2 4 8 --runs 3
+
+`--parts 1` is the current sequential path. Timings are wall-clock seconds per run. Run it for
+a message on the bot's home DC and for one on another DC; the two use different sessions.
+"""
+import os
+import sys
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+from pyrogram import Client
+from pyrogram.file_id import FileId
+
+from fast_download import download_parallel, get_message_media
+
+async def timed(coro):
+    start = time.perf_counter()
+    path = await coro
+    return time.perf_counter() - start, path
+
+async def main(args):
+    load_dotenv()
+    app = Client(
+        "download_bench",
+        api_id=int(os.getenv("TELEGRAM_API_ID")),
+        api_hash=os.getenv("TELEGRAM_API_HASH"),
+        bot_token=os.getenv("TELEGRAM_BOT_TOKEN"),
+        in_memory=True,
+        no_updates=True,
+    )
+    async with app:
+        message = await app.get_messages(args.chat_id, args.message_id)
+        media = get_message_media(message)
+        if media is None:
+            sys.exit("That message has no downloadable media.")
+        size_mb = media.file_size / 1024 / 1024
+        # Files on another DC take a different path in download_parallel; say which one this is.
+        file_dc, home_dc = FileId.decode(media.file_id).dc_id, await app.storage.dc_id()
+        print(f"File: {size_mb:.1f} MB on DC {file_dc} (home DC {home_dc})")
+        app.get_file_semaphore = asyncio.Semaphore(max(args.parts))
+
+        for parts in args.parts:
+            timings = []
+            for _ in range(args.runs):
+                workdir = tempfile.mkdtemp(prefix="download_bench_")
+                try:
+                    if parts == 1:
+                        elapsed, _ = await timed(app.download_media(message, file_name=os.path.join(workdir, "")))
+                    else:
+                        elapsed, _ = await timed(download_parallel(app, message, workdir, parts=parts))
+                finally:
+                    shutil.rmtree(workdir, ignore_errors=True)
+                timings.append(elapsed)
+            median = statistics.median(timings)
+            print(f"parts={parts:<3} median={median:6.2f}s  {size_mb / median:6.1f} MB/s  runs={[round(t, 2) for t in timings]}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("chat_id", type=int)
+    parser.add_argument("message_id", type=int)
+    parser.add_argument("--parts", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--runs", type=int, default=3)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,442 @@
+"""
+Offline end-to-end throughput benchmark for the upload pipeline.
+
+Drives the real handlers (`initiate_instagram_upload`, `handle_media_upload`,
+`handle_text_input`, `upload_now_cb` and the `process_and_upload` task they start) for N
+simulated users at once. Nothing leaves the machine:
+
+- Telegram messages and callback queries are small fakes with a configurable reply latency.
+- `app.download_media` copies a local source file after `--download-latency` seconds.
+- MongoDB is an in-memory stand-in that understands the equality queries the bot uses.
+- instagrapi's Client is replaced by a stub whose uploads take `--ig-latency` seconds.
+
+Photo normalization runs for real in the media process pool. Pass `--media clip.mp4` to
+benchmark reels instead, which needs ffmpeg/ffprobe on PATH.
+
+    python benchmarks/e2e_bench.py --users 20 --uploads 5 --ig-latency 1.5
+
+Reports throughput, per-upload latency percentiles (media message to "Uploaded") and the
+peak RSS of the bot process together with its media workers.
+"""
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+import itertools
+import threading
+import statistics
+from types import SimpleNamespace
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+# main.py validates these at import time; the benchmark never talks to the real services.
+for name, value in {
+    "TELEGRAM_API_ID": "1", "TELEGRAM_API_HASH": "bench", "TELEGRAM_BOT_TOKEN": "1:bench",
+    "ADMIN_ID": "1", "MONGO_DB": "mongodb://bench.invalid", "UPLOAD_QUEUE": "local",
+}.items():
+    os.environ[name] = value
+
+import psutil
+from PIL import Image
+from state_store import MediaRef
+
+BENCH_USER_ID_START = 1000
+_ids = itertools.count(1)
+
+# --- In-memory MongoDB stand-in ---
+
+def _matches(doc, query):
+    """Equality match on plain top-level keys. Operator queries ($gte, $in, ...) match everything."""
+    return all(doc.get(k) == v for k, v in (query or {}).items() if not k.startswith("$") and not isinstance(v, dict))
+
+def _apply_update(doc, update, inserting=False):
+    for k, v in update.get("$set", {}).items():
+        doc[k] = v
+    if inserting:
+        for k, v in update.get("$setOnInsert", {}).items():
+            doc[k] = v
+    for k, v in update.get("$inc", {}).items():
+        doc[k] = doc.get(k, 0) + v
+    for k in update.get("$unset", {}):
+        doc.pop(k, None)
+
+class FakeCursor(list):
+    def sort(self, *args, **kwargs):
+        return self
+
+    def limit(self, n):
+        return FakeCursor(self[:n]) if n else self
+
+class FakeCollection:
+    def __init__(self):
+        self.docs = []
+        self._lock = threading.Lock()
+
+    def find_one(self, query=None, projection=None, **kwargs):
+        with self._lock:
+            return next((dict(d) for d in self.docs if _matches(d, query)), None)
+
+    def find(self, query=None, projection=None, **kwargs):
+        with self._lock:
+            return FakeCursor(dict(d) for d in self.docs if _matches(d, query))
+
+    def count_documents(self, query=None, **kwargs):
+        with self._lock:
+            return sum(1 for d in self.docs if _matches(d, query))
+
+    def insert_one(self, doc, **kwargs):
+        doc.setdefault("_id", next(_ids))
+        with self._lock:
+            self.docs.append(dict(doc))
+        return SimpleNamespace(inserted_id=doc["_id"])
+
+    def insert_many(self, docs, **kwargs):
+        return SimpleNamespace(inserted_ids=[self.insert_one(d).inserted_id for d in docs])
+
+    def update_one(self, query, update, upsert=False, **kwargs):
+        return self._update(query, update, upsert, many=False)
+
+    def update_many(self, query, update, upsert=False, **kwargs):
+        return self._update(query, update, upsert, many=True)
+
+    def find_one_and_update(self, query, update, upsert=False, **kwargs):
+        self._update(query, update, upsert, many=False)
+        return self.find_one(query)
+
+    def delete_one(self, query, **kwargs):
+        with self._lock:
+            for i, d in enumerate(self.docs):
+                if _matches(d, query):
+                    del self.docs[i]
+                    return SimpleNamespace(deleted_count=1)
+        return SimpleNamespace(deleted_count=0)
+
+    def delete_many(self, query, **kwargs):
+        with self._lock:
+            before = len(self.docs)
+            self.docs = [d for d in self.docs if not _matches(d, query)]
+            return SimpleNamespace(deleted_count=before - len(self.docs))
+
+    def create_index(self, *args, **kwargs):
+        return "bench"
+
+    def _update(self, query, update, upsert, many):
+        with self._lock:
+            matched = [d for d in self.docs if _matches(d, query)]
+            for d in matched if many else matched[:1]:
+                _apply_update(d, update)
+            if not matched and upsert:
+                doc = {k: v for k, v in query.items() if not k.startswith("$") and not isinstance(v, dict)}
+                doc.setdefault("_id", next(_ids))
+                _apply_update(doc, update, inserting=True)
+                self.docs.append(doc)
+            return SimpleNamespace(matched_count=len(matched), modified_count=len(matched))
+
+class FakeDatabase:
+    def __init__(self):
+        self._collections = {}
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self._collections.setdefault(name, FakeCollection())
+
+    __getitem__ = __getattr__
+
+class FakeMongoClient:
+    database = FakeDatabase()
+
+    def __init__(self, *args, **kwargs):
+        self.admin = SimpleNamespace(command=lambda *a, **k: {"ok": 1})
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self.database
+
+    def close(self):
+        pass
+
+# --- Instagram stub ---
+
+class StubInstaClient:
+    """Stands in for instagrapi.Client. Every upload blocks its worker thread for `latency` seconds."""
+    latency = 1.0
+
+    def __init__(self, settings=None, **kwargs):
+        self.delay_range = [0, 0]
+
+    def set_proxy(self, url):
+        pass
+
+    def set_settings(self, settings):
+        pass
+
+    def login_by_sessionid(self, sessionid):
+        time.sleep(self.latency / 10)
+        return True
+
+    def get_timeline_feed(self):
+        time.sleep(self.latency / 10)
+        return {}
+
+    def user_info_by_username(self, username):
+        time.sleep(self.latency / 10)
+        return SimpleNamespace(pk=next(_ids), username=username)
+
+    def _media(self, media_type):
+        time.sleep(self.latency)
+        pk = next(_ids)
+        return SimpleNamespace(pk=pk, code=f"bench{pk}", media_type=media_type)
+
+    def photo_upload(self, path, caption="", **kwargs):
+        return self._media(1)
+
+    def clip_upload(self, path, caption="", **kwargs):
+        return self._media(2)
+
+    def album_upload(self, paths, caption="", **kwargs):
+        return self._media(8)
+
+    def photo_upload_to_story(self, path, **kwargs):
+        return self._media(1)
+
+    def video_upload_to_story(self, path, **kwargs):
+        return self._media(2)
+
+# --- Telegram fakes ---
+
+class FakeTelegramClient:
+    """Receives the calls of state_store.MessageRef and keeps the latest text of every message."""
+    def __init__(self):
+        self.texts = {}
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        await asyncio.sleep(FakeMessage.reply_latency)
+        self.texts[(chat_id, message_id)] = text
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return await FakeMessage(chat_id).reply(text)
+
+class FakeMessage:
+    reply_latency = 0.05
+    _client = FakeTelegramClient()
+
+    def __init__(self, user_id, text=None, photo=None, video=None):
+        self.id = next(_ids)
+        self.from_user = SimpleNamespace(id=user_id, first_name="Bench", username=f"bench{user_id}")
+        self.chat = SimpleNamespace(id=user_id)
+        self.text = text
+        self.caption = None
+        self.reply_markup = None
+        self.reply_to_message = None
+        self.photo = photo
+        self.video = video
+        self.document = None
+        self.empty = False
+
+    async def reply(self, text, **kwargs):
+        await asyncio.sleep(self.reply_latency)
+        message = FakeMessage(self.from_user.id, text=text)
+        message.reply_markup = kwargs.get("reply_markup")
+        self._client.texts[(self.chat.id, message.id)] = text
+        return message
+
+    async def edit_text(self, text, reply_markup=None, **kwargs):
+        await asyncio.sleep(self.reply_latency)
+        self.text = text
+        self.reply_markup = reply_markup
+        self._client.texts[(self.chat.id, self.id)] = text
+        return self
+
+def fake_callback_query(user_id, message, data):
+    async def answer(*args, **kwargs):
+        pass
+    from_user = SimpleNamespace(id=user_id, first_name="Bench", username=f"bench{user_id}")
+    return SimpleNamespace(id=str(next(_ids)), from_user=from_user, message=message, data=data, answer=answer)
+
+def make_media(kind, source, info):
+    unique = f"bench{next(_ids)}"  # Unique per upload so the media cache never short-circuits a run.
+    common = dict(file_id=unique, file_unique_id=unique, file_size=os.path.getsize(source))
+    if kind == "photo":
+        return SimpleNamespace(width=info["width"], height=info["height"], **common)
+    return SimpleNamespace(
+        width=info["width"], height=info["height"], duration=info["duration"],
+        mime_type="video/mp4", file_name=f"{unique}.mp4", **common
+    )
+
+def make_fake_download(source, latency):
+    async def download_media(message, file_name=None, progress=None, progress_args=(), **kwargs):
+        # Like pyrogram: a Message is searched for its media, anything else (a MediaRef) is the
+        # media itself, and the progress total is whatever file_size the media claims.
+        media = message if isinstance(message, (str, MediaRef)) else (message.video or message.photo)
+        unique_id = media if isinstance(media, str) else media.file_unique_id
+        total = getattr(media, "file_size", 0)
+        size = os.path.getsize(source)
+        await asyncio.sleep(latency)
+        ext = os.path.splitext(source)[1]
+        directory = os.path.dirname(file_name) if file_name else tempfile.gettempdir()
+        path = os.path.join(directory, f"{unique_id}{ext}")
+        await asyncio.to_thread(shutil.copyfile, source, path)
+        if progress:
+            progress(size, total, *progress_args)
+        return path
+    return download_media
+
+# --- Benchmark driver ---
+
+class PeakRSS:
+    """Samples the RSS of this process plus its children (the media workers) from a thread."""
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        process = psutil.Process()
+        while not self._stop.is_set():
+            total = 0
+            for p in [process] + process.children(recursive=True):
+                try:
+                    total += p.memory_info().rss
+                except psutil.Error:
+                    pass
+            self.peak = max(self.peak, total)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+async def simulate_user(main, user_id, uploads, kind, source, info, latencies, outcomes):
+    button = "📤 ɪɴꜱᴛᴀ ʀᴇᴇʟ" if kind == "video" else "📸 ɪɴꜱᴛᴀ ᴩʜᴏᴛᴏ"
+    for _ in range(uploads):
+        await main.initiate_instagram_upload(main.app, FakeMessage(user_id, text=button))
+        started = time.perf_counter()
+        media = make_media(kind, source, info)
+        await main.handle_media_upload(main.app, FakeMessage(user_id, **{kind: media}))
+        await main.handle_text_input(main.app, FakeMessage(user_id, text="Benchmark caption #bench"))
+
+        state = main.user_states.get(user_id) or {}
+        processing_msg = (state.get("file_info") or {}).get("processing_msg")
+        if state.get("action") != "waiting_for_upload_options" or processing_msg is None:
+            outcomes["failed"] += 1
+            continue
+        await main.upload_now_cb(main.app, fake_callback_query(user_id, processing_msg, "upload_now"))
+        task = main.task_tracker._user_specific_tasks.get(user_id, {}).get("upload")
+        if task is not None:
+            await task
+        final_text = FakeMessage._client.texts.get((processing_msg.chat.id, processing_msg.id)) or ""
+        if main.to_bold_sans("Uploaded Successfully") in final_text:
+            outcomes["succeeded"] += 1
+            latencies.append(time.perf_counter() - started)
+        else:
+            outcomes["failed"] += 1
+            outcomes.setdefault("errors", []).append(final_text)
+
+def prepare_source(args, workdir):
+    if args.media:
+        return "video", os.path.abspath(args.media), {"width": 1080, "height": 1920, "duration": 10}
+    path = os.path.join(workdir, "source.jpg")
+    width, height = args.photo_size
+    Image.new("RGB", (width, height), (180, 90, 40)).save(path, "JPEG", quality=92)
+    return "photo", path, {"width": width, "height": height}
+
+async def run(args, workdir):
+    import main
+
+    logging.getLogger("BotUser").setLevel(logging.ERROR)
+    main.MongoClient = FakeMongoClient
+    main.InstaClient = StubInstaClient
+    StubInstaClient.latency = args.ig_latency
+    FakeMessage.reply_latency = args.telegram_latency
+    main.DEFAULT_GLOBAL_SETTINGS.update({
+        "max_concurrent_uploads": args.slots, "download_parallel_parts": 1, "media_pool_workers": args.media_workers,
+    })
+
+    kind, source, info = prepare_source(args, workdir)
+    main.app.download_media = make_fake_download(source, args.download_latency)
+    main.task_tracker = main.TaskTracker()
+    await main.init_runtime()
+
+    users = range(BENCH_USER_ID_START, BENCH_USER_ID_START + args.users)
+    for user_id in users:
+        main.db.users.insert_one({"_id": user_id, "premium": {"instagram": {"type": "lifetime"}}})
+        main.db.settings.insert_one({"_id": user_id, "active_ig_username": f"bench{user_id}"})
+        main.db.sessions.insert_one({
+            "user_id": user_id, "platform": "instagram", "username": f"bench{user_id}",
+            "session_data": {"authorization_data": {"sessionid": "bench"}}, "device_settings": {"bench": True},
+        })
+
+    latencies, outcomes = [], {"succeeded": 0, "failed": 0}
+    with PeakRSS() as rss:
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            simulate_user(main, user_id, args.uploads, kind, source, info, latencies, outcomes) for user_id in users
+        ))
+        elapsed = time.perf_counter() - started
+    main.media_executor.shutdown(cancel_futures=True)
+
+    report = {
+        "users": args.users, "uploads_per_user": args.uploads, "upload_slots": args.slots, "media": kind,
+        "succeeded": outcomes["succeeded"], "failed": outcomes["failed"], "elapsed_seconds": round(elapsed, 2),
+        "uploads_per_minute": round(outcomes["succeeded"] / elapsed * 60, 1) if elapsed else 0,
+        "peak_rss_mb": round(rss.peak / 1024 / 1024, 1),
+    }
+    if latencies:
+        report.update({
+            "latency_p50": round(percentile(latencies, 50), 3), "latency_p95": round(percentile(latencies, 95), 3),
+            "latency_p99": round(percentile(latencies, 99), 3), "latency_mean": round(statistics.mean(latencies), 3),
+        })
+    if outcomes.get("errors"):
+        report["first_error"] = outcomes["errors"][0]
+    return report
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10, help="simulated users uploading at the same time")
+    parser.add_argument("--uploads", type=int, default=3, help="uploads per user, one after another")
+    parser.add_argument("--slots", type=int, default=15, help="max_concurrent_uploads")
+    parser.add_argument("--media-workers", type=int, default=2, help="media_pool_workers")
+    parser.add_argument("--download-latency", type=float, default=0.5, help="seconds per fake Telegram download")
+    parser.add_argument("--ig-latency", type=float, default=1.0, help="seconds per stub Instagram upload")
+    parser.add_argument("--telegram-latency", type=float, default=0.05, help="seconds per fake reply/edit")
+    parser.add_argument("--photo-size", type=int, nargs=2, default=[2160, 2700], metavar=("W", "H"))
+    parser.add_argument("--media", help="upload this video as a reel instead of a generated photo (needs ffmpeg)")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    # main.py writes bot.log, downloads/ and media_cache/ into the working directory.
+    workdir = tempfile.mkdtemp(prefix="e2e_bench_")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        report = asyncio.run(run(args, workdir))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for key, value in report.items():
+        print(f"{key:<18} {value}")
+
+if __name__ == "__main__":
+    main_cli()
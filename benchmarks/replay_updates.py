@@ -0,0 +1,316 @@
+"""
+Replays an update log written with UPDATE_LOG=update_log.jsonl through the bot's real
+dispatcher, offline, to reproduce a traffic shape and measure how updates queue up.
+
+    python benchmarks/replay_updates.py update_log.jsonl --speed 10 --workers 8
+    python benchmarks/replay_updates.py update_log.jsonl --speed 0 --json
+
+`--speed 1` keeps the recorded timing, `--speed 10` compresses it tenfold and `--speed 0`
+feeds every update as fast as the dispatcher takes them. Each user's updates stay in order:
+the next one is only sent once the previous one has been handled.
+
+Updates go through the registered handler groups the way pyrogram's dispatcher workers run
+them, against the same fakes as e2e_bench.py: in-memory MongoDB, stubbed instagrapi and
+Telegram calls that only sleep.
+
+Photos are replayed with a generated JPEG. Videos and documents need `--video PATH` (a clip
+ffmpeg can read), otherwise they are skipped and counted as such. Callback data that was
+redacted when recording ends in "x" here, so those callbacks run their not-found paths.
+
+Reports how long updates waited for a dispatcher worker (arrival to handler start), how long
+handlers ran, the deepest the queue got, upload outcomes and peak RSS. Updates the bot
+answered with a premium gate instead of running the flow are counted as denied, not dispatched.
+"""
+import os
+import json
+import time
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+import itertools
+from datetime import datetime
+from collections import Counter
+
+from e2e_bench import FakeMongoClient, StubInstaClient, PeakRSS, percentile, make_fake_download
+
+import pyrogram
+from pyrogram import enums, types
+from PIL import Image
+
+REPLAY_USER_ID_START = 5000
+_ids = itertools.count(1)
+_video_file_ids = set()  # The bot downloads flow-state media by file id, so remember which ids are videos.
+
+def load_records(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def install_telegram_fakes(app, latency, last_bot_message, bot_texts):
+    """
+    Replaces the client methods pyrogram's bound methods (reply, edit_text, answer...) end up in.
+    Every text the bot sends or edits to a chat is appended to `bot_texts[chat_id]`.
+    """
+    app.me = types.User(id=next(_ids), is_bot=True, first_name="Replay", username="replay_bot")
+
+    async def send_message(chat_id, text="", reply_markup=None, **kwargs):
+        await asyncio.sleep(latency)
+        message = bot_message(app, chat_id, text, reply_markup)
+        last_bot_message[chat_id] = message
+        bot_texts.setdefault(chat_id, []).append(text or "")
+        return message
+
+    async def send_media(chat_id, *args, caption="", reply_markup=None, **kwargs):
+        return await send_message(chat_id, caption, reply_markup)
+
+    async def edit_message_text(chat_id=None, message_id=None, text="", reply_markup=None, **kwargs):
+        await asyncio.sleep(latency)
+        message = bot_message(app, chat_id, text, reply_markup, message_id=message_id)
+        last_bot_message[chat_id] = message
+        bot_texts.setdefault(chat_id, []).append(text or "")
+        return message
+
+    async def edit_message_reply_markup(chat_id=None, message_id=None, reply_markup=None, **kwargs):
+        return await edit_message_text(chat_id, message_id, "", reply_markup)
+
+    async def acknowledge(*args, **kwargs):
+        await asyncio.sleep(latency)
+        return True
+
+    async def get_messages(chat_id, message_ids=None, **kwargs):
+        return bot_message(app, chat_id, "", None, message_id=message_ids)
+
+    app.send_message = send_message
+    app.send_photo = app.send_document = app.send_video = send_media
+    app.copy_message = lambda chat_id, from_chat_id, message_id, **kwargs: send_message(chat_id, "")
+    app.edit_message_text = edit_message_text
+    app.edit_message_reply_markup = edit_message_reply_markup
+    app.answer_callback_query = app.delete_messages = acknowledge
+    app.get_messages = get_messages
+
+def user_and_chat(app, user_id):
+    user = types.User(client=app, id=user_id, is_bot=False, first_name="Replay", username=f"replay{user_id}")
+    chat = types.Chat(client=app, id=user_id, type=enums.ChatType.PRIVATE, first_name="Replay")
+    return user, chat
+
+def bot_message(app, chat_id, text, reply_markup, message_id=None):
+    _, chat = user_and_chat(app, chat_id)
+    return types.Message(
+        client=app, id=message_id or next(_ids), chat=chat, date=datetime.now(),
+        text=text or None, reply_markup=reply_markup
+    )
+
+def build_update(app, record, user_id, sources, last_bot_message):
+    """A pyrogram Message or CallbackQuery for one record, or None if it can't be replayed here."""
+    user, chat = user_and_chat(app, user_id)
+    if record["type"] == "callback_query":
+        data = record["data"]
+        if data == "…":
+            return None
+        return types.CallbackQuery(
+            client=app, id=str(next(_ids)), from_user=user, chat_instance="replay",
+            message=last_bot_message.get(user_id) or bot_message(app, user_id, "", None),
+            data=data[:-1] + "x" if data.endswith("…") else data
+        )
+
+    kind = record.get("kind")
+    fields = dict(client=app, id=next(_ids), from_user=user, chat=chat, date=datetime.now())
+    if kind == "command":
+        text = f"/{record['command']}" + " x" * record.get("args", 0)
+        return types.Message(text=text, **fields)
+    if kind == "button":
+        return types.Message(text=record["text"], **fields)
+    if kind == "text":
+        return types.Message(text="x" * max(record.get("text_len", 1), 1), **fields)
+
+    source = sources.get("photo" if kind == "photo" else "video")
+    if source is None or kind not in ("photo", "video", "document"):
+        return None
+    unique = f"replay{next(_ids)}"
+    media = dict(client=app, file_id=unique, file_unique_id=unique, file_size=os.path.getsize(source))
+    caption = "x" * record["caption_len"] if record.get("caption_len") else None
+    group = f"replay{record['media_group']}" if record.get("media_group") else None
+    if kind == "photo":
+        photo = types.Photo(width=record.get("width", 1080), height=record.get("height", 1350), date=datetime.now(), **media)
+        return types.Message(photo=photo, media=enums.MessageMediaType.PHOTO, caption=caption, media_group_id=group, **fields)
+    _video_file_ids.add(unique)
+    video = types.Video(
+        width=record.get("width", 1080), height=record.get("height", 1920), duration=record.get("duration", 10),
+        file_name=f"{unique}.mp4", mime_type=record.get("mime_type", "video/mp4"), **media
+    )
+    return types.Message(video=video, media=enums.MessageMediaType.VIDEO, caption=caption, media_group_id=group, **fields)
+
+async def dispatch(app, update):
+    """Runs one update through the handler groups like pyrogram's Dispatcher.handler_worker."""
+    handler_type = pyrogram.handlers.CallbackQueryHandler if isinstance(update, types.CallbackQuery) else pyrogram.handlers.MessageHandler
+    try:
+        for group in app.dispatcher.groups.values():
+            for handler in group:
+                if not isinstance(handler, handler_type) or not await handler.check(app, update):
+                    continue
+                try:
+                    await handler.callback(app, update)
+                except pyrogram.ContinuePropagation:
+                    continue
+                break
+    except pyrogram.StopPropagation:
+        pass
+
+async def run(args, workdir):
+    import main
+
+    logging.getLogger("BotUser").setLevel(logging.ERROR)
+    main.MongoClient = FakeMongoClient
+    main.InstaClient = StubInstaClient
+    StubInstaClient.latency = args.ig_latency
+    main.DEFAULT_GLOBAL_SETTINGS.update({"max_concurrent_uploads": args.slots, "download_parallel_parts": 1})
+
+    records = load_records(args.log)
+    photo = os.path.join(workdir, "source.jpg")
+    Image.new("RGB", (2160, 2700), (40, 90, 180)).save(photo, "JPEG", quality=92)
+    sources = {"photo": photo}
+    if args.video:
+        sources["video"] = os.path.abspath(args.video)
+
+    async def download_media(message, *a, **kwargs):
+        file_id = message if isinstance(message, str) else (message.video or message.photo).file_id
+        source = sources["video"] if file_id in _video_file_ids else sources["photo"]
+        return await make_fake_download(source, args.download_latency)(message, *a, **kwargs)
+
+    last_bot_message, bot_texts = {}, {}
+    install_telegram_fakes(main.app, args.telegram_latency, last_bot_message, bot_texts)
+    denial_marker = main.to_bold_sans("Premium")  # every "❌ ... Premium ..." gate reply names it
+    main.app.download_media = download_media
+    main.task_tracker = main.TaskTracker()
+    main.task_tracker.loop = asyncio.get_running_loop()
+    await main.init_runtime()
+
+    def replay_id(record):
+        return main.ADMIN_ID if record.get("admin") else REPLAY_USER_ID_START + record["user"]
+
+    for user_id in {replay_id(r) for r in records}:
+        # With added_by set, a recorded /start is a returning user and keeps the premium below.
+        main.db.users.insert_one({"_id": user_id, "premium": {"instagram": {"type": "lifetime"}}, "added_by": "replay"})
+        main.db.settings.insert_one({"_id": user_id, "active_ig_username": f"replay{user_id}"})
+        main.db.sessions.insert_one({
+            "user_id": user_id, "platform": "instagram", "username": f"replay{user_id}",
+            "session_data": {"authorization_data": {"sessionid": "replay"}}, "device_settings": {"replay": True},
+        })
+
+    queue = asyncio.Queue()
+    waits, runs, counts, denied = [], [], Counter(), Counter()
+    max_depth = 0
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            arrived, record, done = item
+            started = time.perf_counter()
+            waits.append(started - arrived)
+            try:
+                update = build_update(main.app, record, replay_id(record), sources, last_bot_message)
+                if update is None:
+                    counts["skipped"] += 1
+                    continue
+                user_id = replay_id(record)
+                bot_texts[user_id] = []
+                await dispatch(main.app, update)
+                runs.append(time.perf_counter() - started)
+                if any(text.startswith("❌") and denial_marker in text for text in bot_texts.pop(user_id, [])):
+                    counts["denied"] += 1
+                    denied[record.get("kind", record["type"])] += 1
+                else:
+                    counts["dispatched"] += 1
+            except Exception as e:
+                counts["errors"] += 1
+                logging.getLogger("replay").debug(f"Handler failed for {record}: {e}")
+            finally:
+                done.set_result(None)
+
+    async def replay_user(user_records):
+        # A user answers what the bot said, so their next update waits for the previous one
+        # to be handled, on top of the recorded gap.
+        nonlocal max_depth
+        for record in user_records:
+            if args.speed:
+                delay = (record["t"] - first) / args.speed - (time.perf_counter() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            done = asyncio.get_running_loop().create_future()
+            await queue.put((time.perf_counter(), record, done))
+            max_depth = max(max_depth, queue.qsize())
+            await done
+
+    by_user = {}
+    for record in records:
+        by_user.setdefault(replay_id(record), []).append(record)
+
+    with PeakRSS() as rss:
+        workers = [asyncio.create_task(worker()) for _ in range(args.workers)]
+        started = time.perf_counter()
+        first = records[0]["t"] if records else 0
+        await asyncio.gather(*(replay_user(user_records) for user_records in by_user.values()))
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+        dispatched_at = time.perf_counter() - started
+
+        # Let the uploads the replayed clicks started run to completion.
+        pending = [t for t in main.task_tracker._tasks if not t.done()]
+        if pending:
+            await asyncio.wait(pending, timeout=args.drain_timeout)
+        elapsed = time.perf_counter() - started
+    await main.task_tracker.cancel_and_wait_all()
+    main.media_executor.shutdown(cancel_futures=True)
+
+    report = {
+        "records": len(records), "speed": args.speed or "unbounded", "workers": args.workers,
+        "dispatched": counts["dispatched"], "skipped": counts["skipped"], "errors": counts["errors"],
+        "denied": counts["denied"], "denied_by_kind": dict(denied),
+        "record_types": dict(Counter(r.get("kind", r["type"]) for r in records)),
+        "dispatch_seconds": round(dispatched_at, 2), "elapsed_seconds": round(elapsed, 2),
+        "max_queue_depth": max_depth,
+        "uploads": {"/".join(key): value for key, value in main.UPLOADS._values.items()},
+        "peak_rss_mb": round(rss.peak / 1024 / 1024, 1),
+    }
+    if waits:
+        report.update({f"queue_wait_p{q}": round(percentile(waits, q), 4) for q in (50, 95, 99)})
+    if runs:
+        report.update({f"handler_p{q}": round(percentile(runs, q), 4) for q in (50, 95, 99)})
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("log", help="a file recorded with UPDATE_LOG")
+    parser.add_argument("--speed", type=float, default=1, help="time compression factor; 0 means unbounded")
+    parser.add_argument("--workers", type=int, default=min(32, (os.cpu_count() or 0) + 4), help="dispatcher workers (pyrogram's default)")
+    parser.add_argument("--slots", type=int, default=15, help="max_concurrent_uploads")
+    parser.add_argument("--download-latency", type=float, default=0.5)
+    parser.add_argument("--ig-latency", type=float, default=1.0)
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--drain-timeout", type=float, default=300, help="seconds to wait for started uploads")
+    parser.add_argument("--video", help="clip used for recorded videos and documents (needs ffmpeg)")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+    args.log = os.path.abspath(args.log)
+
+    # main.py writes bot.log, downloads/ and media_cache/ into the working directory.
+    workdir = tempfile.mkdtemp(prefix="replay_updates_")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        import main
+        # Handlers registered at import are added by tasks on the client's loop, so run there.
+        report = main.app.loop.run_until_complete(run(args, workdir))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for key, value in report.items():
+            print(f"{key:<18} {value}")
@@ -0,0 +1,153 @@
+import os
+import math
+import asyncio
+import logging
+import mimetypes
+
+from pyrogram import raw
+from pyrogram.file_id import FileId, FileType
+# Pyrogram's own cache of exported-auth sessions to other DCs (client.media_sessions).
+from pyrogram.methods.messages.inline_session import get_session
+
+logger = logging.getLogger("BotUser")
+
+CHUNK_SIZE = 1024 * 1024  # Telegram serves files in 1 MiB chunks
+PART_RETRIES = 3
+
+def get_message_media(message):
+    """Returns the downloadable media object of a message (video, photo or document)."""
+    return message.video or message.photo or message.document
+
+def default_file_name(media):
+    """Builds a stable file name for a media object, mirroring the names Pyrogram would pick."""
+    name = getattr(media, "file_name", None)
+    if name:
+        return os.path.basename(name)
+    # MediaRefs say what they are; pyrogram media objects only tell photos apart by lacking a duration.
+    kind = getattr(media, "kind", None) or ("video" if hasattr(media, "duration") else "photo")
+    mime_type = getattr(media, "mime_type", None) or ("image/jpeg" if kind == "photo" else "video/mp4")
+    ext = mimetypes.guess_extension(mime_type) or ""
+    if ext in (".jpe", ".jpeg"):
+        ext = ".jpg"
+    return f"{media.file_unique_id}{ext}"
+
+def split_ranges(total_chunks, parts):
+    """Splits `total_chunks` into at most `parts` contiguous (offset, count) ranges."""
+    parts = max(1, min(parts, total_chunks))
+    per_part = math.ceil(total_chunks / parts)
+    return [(start, min(per_part, total_chunks - start)) for start in range(0, total_chunks, per_part)]
+
+def _file_location(file_id):
+    if file_id.file_type == FileType.PHOTO:
+        return raw.types.InputPhotoFileLocation(
+            id=file_id.media_id, access_hash=file_id.access_hash,
+            file_reference=file_id.file_reference, thumb_size=file_id.thumbnail_size
+        )
+    return raw.types.InputDocumentFileLocation(
+        id=file_id.media_id, access_hash=file_id.access_hash,
+        file_reference=file_id.file_reference, thumb_size=file_id.thumbnail_size
+    )
+
+async def _chunk_source(client, file_id):
+    """
+    Returns chunks(offset, limit), an async iterator over the file's chunks from `offset`.
+    Files on the home DC go through `client.stream_media`, which opens a media session per
+    call; that costs only a connect there. For another DC the same call would also run a
+    full auth key exchange, so every part there shares one exported-auth session instead.
+    """
+    decoded = FileId.decode(file_id)
+    if decoded.dc_id == await client.storage.dc_id():
+        return lambda offset, limit: client.stream_media(file_id, limit=limit, offset=offset)
+
+    session = await get_session(client, decoded.dc_id)
+    location = _file_location(decoded)
+
+    async def chunks(offset, limit):
+        async with client.get_file_semaphore:
+            for index in range(offset, offset + limit):
+                r = await session.invoke(
+                    raw.functions.upload.GetFile(location=location, offset=index * CHUNK_SIZE, limit=CHUNK_SIZE),
+                    sleep_threshold=30
+                )
+                if not isinstance(r, raw.types.upload.File):
+                    # CDN-served files are left to pyrogram's sequential download.
+                    raise ValueError(f"Telegram served chunk {index} through a CDN ({type(r).__name__})")
+                yield r.bytes
+                if len(r.bytes) < CHUNK_SIZE:
+                    return
+
+    return chunks
+
+async def _download_range(chunks, fd, start_chunk, chunk_count, on_chunk):
+    """Streams one chunk range into `fd`, resuming from the last written chunk on failure."""
+    done = 0
+    attempt = 0
+    while done < chunk_count:
+        try:
+            async for chunk in chunks(start_chunk + done, chunk_count - done):
+                # A 1 MiB write into the page cache is cheap; writing inline keeps the fd
+                # from being used by a worker thread after the download is torn down.
+                os.pwrite(fd, chunk, (start_chunk + done) * CHUNK_SIZE)
+                done += 1
+                on_chunk(len(chunk))
+                if len(chunk) < CHUNK_SIZE:
+                    return
+            if done < chunk_count:
+                # Pyrogram's get_file logs and swallows transfer errors, which just ends the stream.
+                raise ConnectionError(f"stream ended after {done} of {chunk_count} chunks")
+            return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            attempt += 1
+            if attempt > PART_RETRIES:
+                raise
+            logger.warning(f"Part at chunk {start_chunk + done} failed ({type(e).__name__}: {e}). Retry {attempt}/{PART_RETRIES}.")
+            await asyncio.sleep(attempt)
+
+async def download_parallel(client, message, directory, parts=4, file_name=None, progress=None, progress_args=()):
+    """
+    Downloads the media of `message` (a Message or a state_store.MediaRef) into `directory` by streaming `parts` chunk ranges at once.
+    Each part writes straight to its offset in a preallocated file and retries on its own.
+    The number of parts that actually run together is bounded by `client.get_file_semaphore`.
+    Parts of a file on another DC share one session to that DC, see `_chunk_source`.
+    `progress` follows Pyrogram's convention and is called as progress(current, total, *progress_args).
+    Returns the final file path.
+    """
+    media = get_message_media(message)
+    if media is None:
+        raise ValueError("This message doesn't contain any downloadable media")
+    file_size = getattr(media, "file_size", 0) or 0
+    if not file_size:
+        raise ValueError("Parallel download needs a known file size")
+
+    chunks = await _chunk_source(client, media.file_id)
+    path = os.path.join(directory, file_name or default_file_name(media))
+    temp_path = path + ".part"
+    fd = os.open(temp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    received = [0]
+
+    def on_chunk(nbytes):
+        received[0] += nbytes
+        if progress:
+            progress(min(received[0], file_size), file_size, *progress_args)
+
+    tasks = []
+    try:
+        os.ftruncate(fd, file_size)
+        ranges = split_ranges(math.ceil(file_size / CHUNK_SIZE), parts)
+        tasks = [asyncio.create_task(_download_range(chunks, fd, start, count, on_chunk)) for start, count in ranges]
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        os.close(fd)
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    os.close(fd)
+    os.replace(temp_path, path)
+    return path
@@ -0,0 +1,13 @@
+"""
+Starts the bot front end, or an upload worker with `--worker`:
+
+    python launcher.py [--worker]
+
+The media workers run in processes started from a forkserver, and multiprocessing re-imports
+the script that started the parent in each of them. This is that script: a worker imports
+only these lines, while main.py is imported under the guard and never in a worker.
+"""
+
+if __name__ == "__main__":
+    import main
+    main.run()
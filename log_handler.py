@@ -1,10 +1,160 @@
+import os
+import sys
+import gzip
+import json
+import queue
+import shutil
+import atexit
 import logging
+import logging.handlers
+import contextvars
 import asyncio
 from pyrogram import enums  # ✅ Import enums here
 from pyrogram.errors import FloodWait, RPCError
 
 logger = logging.getLogger("BotUser")
 
+# === Logging pipeline ===
+# Loggers only put records on a queue; one listener thread formats them and does the writing
+# (stdout and a rotating, optionally gzipped file), so a slow disk never stalls the event loop.
+
+STRUCTURED_FIELDS = ("user_id", "job_id", "stage", "duration")
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_log_context = contextvars.ContextVar("log_context", default={})
+
+def bind_log_context(**fields):
+    """
+    Adds `fields` (e.g. user_id, job_id) to every record logged from the current task and the
+    tasks and threads it starts. Meant for the top of a task that works on one job.
+    """
+    _log_context.set({**_log_context.get(), **fields})
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and the structured fields that are set."""
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = round(value, 3) if isinstance(value, float) else value
+        if getattr(record, "sample_rate", 1) > 1:
+            entry["sample_rate"] = record.sample_rate
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class _ContextQueueHandler(logging.handlers.QueueHandler):
+    """
+    Stamps the bound log context on records and flattens them before they cross to the
+    listener thread: the message is rendered and the traceback turned into text here, where
+    the arguments are still current, but extra fields stay separate for the JSON formatter.
+    """
+    def prepare(self, record):
+        for field, value in _log_context.get().items():
+            if getattr(record, field, None) is None:
+                setattr(record, field, value)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class DebugSampler(logging.Filter):
+    """
+    Keeps the first DEBUG record of each call site and then one in `rate`; other levels all
+    pass. Kept records carry `sample_rate` so counts can be scaled back up.
+    """
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = max(1, rate)
+        self._seen = {}
+
+    def filter(self, record):
+        if record.levelno != logging.DEBUG or self.rate == 1:
+            return True
+        site = (record.pathname, record.lineno)
+        count = self._seen.get(site, 0)
+        self._seen[site] = count + 1
+        if count % self.rate:
+            return False
+        record.sample_rate = self.rate
+        return True
+
+def _gzip_namer(name):
+    return name + ".gz"
+
+def _gzip_rotator(source, dest):
+    with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+def parse_log_levels(spec):
+    """'pyrogram=WARNING,BotUser=DEBUG' -> {'pyrogram': 'WARNING', 'BotUser': 'DEBUG'}"""
+    levels = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, level = item.partition("=")
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+def setup_logging(level="INFO", levels=None, path="bot.log", max_bytes=50 * 1024 * 1024, backups=5,
+                  compress=False, console_json=False, debug_sample_rate=100):
+    """
+    Replaces the root handlers with a queue handler and starts the listener that writes to
+    stdout (text, or JSON with `console_json`) and to `path` as JSON lines, rotated at
+    `max_bytes` keeping `backups` old files (gzipped with `compress`). `levels` maps logger
+    names to their own levels. The listener is stopped, and the queue drained, by
+    `stop_logging()` or at exit.
+    """
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(JsonFormatter() if console_json else logging.Formatter(TEXT_FORMAT))
+    sinks = [console]
+    if path:
+        file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+        if compress:
+            file_handler.namer = _gzip_namer
+            file_handler.rotator = _gzip_rotator
+        file_handler.setFormatter(JsonFormatter())
+        sinks.append(file_handler)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _ContextQueueHandler(log_queue)
+    queue_handler.addFilter(DebugSampler(debug_sample_rate))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level.upper())
+    for name, logger_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(logger_level)
+
+    global _listener
+    stop_logging()
+    _listener = logging.handlers.QueueListener(log_queue, *sinks, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+_listener = None
+
+def stop_logging():
+    """Writes out what is still queued and stops the listener. Does nothing if already stopped."""
+    global _listener
+    listener, _listener = _listener, None
+    if listener is not None:
+        atexit.unregister(stop_logging)
+        listener.stop()
+
 async def send_log_to_channel(app, log_channel_id, message):
     """Send log message to a Telegram channel."""
     try:
@@ -6,21 +6,36 @@ import logging
 import subprocess
 import json
 from datetime import datetime, timedelta
-from http.server import HTTPServer, BaseHTTPRequestHandler
 import signal
 from functools import wraps, partial
 import re
 import time
+import shutil
+import uuid
+import io
+import traceback
+import random
+import math
+import hashlib
+import copy
+import socket
+import multiprocessing
+from collections import OrderedDict, Counter, deque
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, asynccontextmanager
+import contextvars
 # Load environment variables
 from dotenv import load_dotenv
 
 load_dotenv()
 # MongoDB
-from pymongo import MongoClient
-from pymongo.errors import OperationFailure
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import OperationFailure, DuplicateKeyError
 # Pyrogram (Telegram Bot)
 from pyrogram import Client, filters, enums, idle
 from pyrogram.errors import UserNotParticipant, FloodWait
+from pyrogram.handlers import MessageHandler, CallbackQueryHandler
 from pyrogram.types import (
     ReplyKeyboardMarkup,
     KeyboardButton,
@@ -35,20 +50,36 @@ from instagrapi.exceptions import (
     ChallengeRequired,
     BadPassword,
     PleaseWaitFewMinutes,
-    ClientError
+    ClientError,
+    ClientConnectionError,
+    ClientRequestTimeout,
+    ClientThrottledError
 )
 from instagrapi.types import Usertag, Location, StoryMention, StoryLocation, StoryHashtag, StoryLink
+from instagrapi.mixins import clip as instagrapi_clip, video as instagrapi_video
+from instagrapi.extractors import extract_media_v1
+from requests.exceptions import ConnectionError as RequestsConnectionError, Timeout as RequestsTimeout
 # System Utilities
 import psutil
 import GPUtil
+# Local Modules
+from fast_download import download_parallel
+import media_pool
+import metrics
+import update_log
+import profiling
+from state_store import BoundedRegistry, MessageRef, MediaRef, LocationRef, restore_refs
+from log_handler import setup_logging, parse_log_levels, bind_log_context
 # Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler("bot.log")
-    ]
+setup_logging(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    levels=parse_log_levels(os.getenv("LOG_LEVELS", "")),  # e.g. "pyrogram=WARNING,BotUser=DEBUG"
+    path=os.getenv("LOG_FILE", "bot.log"),
+    max_bytes=int(os.getenv("LOG_MAX_MB", "50")) * 1024 * 1024,
+    backups=int(os.getenv("LOG_BACKUPS", "5")),
+    compress=os.getenv("LOG_COMPRESS", "0") == "1",
+    console_json=os.getenv("LOG_CONSOLE_FORMAT", "text").lower() == "json",
+    debug_sample_rate=int(os.getenv("LOG_DEBUG_SAMPLE", "100")),  # keep 1 in N DEBUG lines per call site
 )
 logger = logging.getLogger("BotUser")
 
@@ -76,77 +107,206 @@ INSTAGRAM_PASSWORD = os.getenv("INSTAGRAM_PASSWORD", "")
 INSTAGRAM_PROXY = os.getenv("INSTAGRAM_PROXY", "")
 PROXY_SETTINGS = os.getenv("PROXY_SETTINGS", "")
 
+# Process Mode: `python launcher.py` runs the bot front end, `python launcher.py --worker` an upload worker.
+WORKER_MODE = "--worker" in sys.argv
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+UPLOAD_QUEUE = os.getenv("UPLOAD_QUEUE", "local").lower()  # "local" or "mongo" (hand uploads to workers)
+
 # === Video Conversion Helpers ===
 
-def needs_conversion(input_file: str) -> bool:
+# Target frame for the "9_16" aspect ratio setting.
+VERTICAL_WIDTH, VERTICAL_HEIGHT = 1080, 1920
+# Ratios within this relative distance of 9:16 are treated as already vertical.
+ASPECT_TOLERANCE = 0.01
+# Crop to 9:16 if that cuts at most this share of the frame, otherwise pad.
+MAX_CROP_LOSS = 0.2
+
+class MediaInfo:
     """
-    Checks if a video file needs conversion to be Instagram-compatible (MP4/AAC).
-    Uses ffprobe to inspect the file's container and audio codec.
-    Returns True if conversion is needed, False otherwise.
+    What the pipeline knows about one media file. Built once after download and carried in
+    `file_info["media_info"]` (keyed by path) so later stages never probe the file again.
+    Width and height are display dimensions, i.e. with rotation already applied.
     """
+    __slots__ = (
+        "kind", "container", "video_codec", "audio_codec", "width", "height",
+        "duration", "bitrate", "rotation", "faststart", "size"
+    )
+
+    def __init__(self, kind, container="", video_codec=None, audio_codec="none", width=0, height=0,
+                 duration=0.0, bitrate=0, rotation=0, faststart=False, size=0):
+        self.kind = kind  # "video" or "photo"
+        self.container = container
+        self.video_codec = video_codec
+        self.audio_codec = audio_codec
+        self.width = width
+        self.height = height
+        self.duration = duration
+        self.bitrate = bitrate
+        self.rotation = rotation
+        self.faststart = faststart
+        self.size = size
+
+    @property
+    def is_video(self):
+        return self.kind == "video"
+
+    def derive(self, **changes):
+        """Returns a copy with `changes` applied, for files produced from this one."""
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(changes)
+        return MediaInfo(**values)
+
+    def __repr__(self):
+        return (f"MediaInfo({self.kind}, {self.container or '?'}, {self.video_codec}/{self.audio_codec}, "
+                f"{self.width}x{self.height}, {self.duration:.1f}s, {self.bitrate // 1000} kb/s, "
+                f"rot={self.rotation}, faststart={self.faststart})")
+
+def has_faststart(input_file: str) -> bool:
+    """True if the MP4/MOV `moov` atom comes before `mdat`. Reads only the top-level box headers."""
+    try:
+        with open(input_file, 'rb') as f:
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return False
+                size = int.from_bytes(header[:4], 'big')
+                box_type = header[4:8]
+                if box_type == b'moov':
+                    return True
+                if box_type == b'mdat':
+                    return False
+                header_size = 8
+                if size == 1:
+                    size = int.from_bytes(f.read(8), 'big')
+                    header_size = 16
+                elif size == 0:
+                    return False
+                if size < header_size:
+                    # A box smaller than its own header is corrupt; seeking by it would never move forward.
+                    return False
+                f.seek(size - header_size, os.SEEK_CUR)
+    except OSError:
+        return False
+
+def probe_video(input_file: str) -> MediaInfo:
+    """
+    Inspects a video with a single ffprobe call plus a scan of its top-level atoms.
+    Raises FileNotFoundError if ffprobe is missing and ValueError if the file can't be probed.
+    """
+    command = [
+        'ffprobe',
+        '-v', 'quiet',
+        '-print_format', 'json',
+        '-show_format',
+        '-show_streams',
+        input_file
+    ]
     try:
-        # Command to get stream info as JSON from ffprobe
-        command = [
-            'ffprobe',
-            '-v', 'quiet',
-            '-print_format', 'json',
-            '-show_format',
-            '-show_streams',
-            input_file
-        ]
         result = subprocess.run(command, check=True, capture_output=True, text=True, encoding='utf-8')
         data = json.loads(result.stdout)
-        
-        # Check container format
-        format_name = data.get('format', {}).get('format_name', '')
-        is_compatible_container = any(x in format_name for x in ['mp4', 'mov', '3gp'])
-
-        # Check audio stream codec
-        audio_codec = 'none' # Default for videos with no audio
-        for stream in data.get('streams', []):
-            if stream.get('codec_type') == 'audio':
-                audio_codec = stream.get('codec_name')
-                break # Found the first audio stream
-        
-        is_compatible_audio = (audio_codec == 'aac' or audio_codec == 'none')
-
-        if is_compatible_container and is_compatible_audio:
-            logger.info(f"'{input_file}' is already compatible (Container: {format_name}, Audio: {audio_codec}). No conversion needed.")
-            return False
+    except (subprocess.CalledProcessError, json.JSONDecodeError) as e:
+        raise ValueError(f"Could not probe '{input_file}': {e}")
+
+    fmt = data.get('format', {})
+    info = MediaInfo(
+        "video",
+        container=fmt.get('format_name', ''),
+        duration=float(fmt.get('duration') or 0),
+        bitrate=int(fmt.get('bit_rate') or 0),
+        size=int(fmt.get('size') or 0) or os.path.getsize(input_file),
+    )
+    for stream in data.get('streams', []):
+        if stream.get('codec_type') == 'video' and info.video_codec is None:
+            info.video_codec = stream.get('codec_name')
+            width, height = stream.get('width', 0), stream.get('height', 0)
+            rotation = stream.get('tags', {}).get('rotate')
+            for side_data in stream.get('side_data_list', []):
+                rotation = side_data.get('rotation', rotation)
+            info.rotation = int(float(rotation)) if rotation is not None else 0
+            if abs(info.rotation) % 180 == 90:
+                width, height = height, width
+            info.width, info.height = width, height
+            if not info.duration:
+                info.duration = float(stream.get('duration') or 0)
+        elif stream.get('codec_type') == 'audio' and info.audio_codec == 'none':
+            info.audio_codec = stream.get('codec_name')
+    if not info.bitrate and info.duration:
+        info.bitrate = int(info.size * 8 / info.duration)
+    if any(x in info.container for x in ['mp4', 'mov', '3gp']):
+        info.faststart = has_faststart(input_file)
+    return info
+
+# Actions of the conversion decision tree, cheapest first.
+VIDEO_ACTIONS = ("noop", "faststart", "remux", "audio", "transcode")
+INSTAGRAM_VIDEO_CODECS = ('h264', 'hevc')
+# How often each action was chosen since startup.
+video_action_counts = Counter({action: 0 for action in VIDEO_ACTIONS})
+
+def plan_instagram_video(info: MediaInfo, aspect_ratio: str = "original") -> dict:
+    """
+    Picks the cheapest action that makes a probed video Instagram-compatible:
+      noop       - already MP4-family, AAC (or no) audio, moov first, frame as requested
+      faststart  - only the moov atom is at the end; remux in place with stream copy
+      remux      - wrong container; stream-copy into MP4
+      audio      - audio isn't AAC; copy the video and transcode only the audio
+      transcode  - the frame must change for "9_16" or the video codec isn't accepted
+    Returns {"action", "audio", "video_filter"}; `audio` is "copy" or "aac".
+    """
+    is_compatible_container = any(x in info.container for x in ['mp4', 'mov', '3gp'])
+    copy_audio = info.audio_codec in ('aac', 'none')
+
+    video_filter = None
+    if aspect_ratio == "9_16" and info.width and info.height:
+        target = VERTICAL_WIDTH / VERTICAL_HEIGHT
+        ratio = info.width / info.height
+        fit = f"scale={VERTICAL_WIDTH}:{VERTICAL_HEIGHT}:flags=bicubic,setsar=1"
+        if abs(ratio - target) / target <= ASPECT_TOLERANCE:
+            video_filter = None
+        elif ratio > target and 1 - target / ratio <= MAX_CROP_LOSS:
+            video_filter = f"crop=trunc(ih*9/16/2)*2:ih,{fit}"
+        elif ratio < target and 1 - ratio / target <= MAX_CROP_LOSS:
+            video_filter = f"crop=iw:trunc(iw*16/9/2)*2,{fit}"
         else:
-            logger.warning(f"'{input_file}' needs conversion (Container: {format_name}, Audio: {audio_codec}).")
-            return True
+            video_filter = (
+                f"scale={VERTICAL_WIDTH}:{VERTICAL_HEIGHT}:force_original_aspect_ratio=decrease:flags=bicubic,"
+                f"pad={VERTICAL_WIDTH}:{VERTICAL_HEIGHT}:(ow-iw)/2:(oh-ih)/2:black,setsar=1"
+            )
 
-    except FileNotFoundError:
-        logger.error("ffprobe/ffmpeg is not installed. Cannot check video format. Assuming conversion is needed as a fallback.")
-        return True # Failsafe: if we can't check, we should try to convert.
-    except (subprocess.CalledProcessError, json.JSONDecodeError):
-        logger.error(f"Could not probe file '{input_file}'. It might be corrupted or not a valid video. Assuming conversion is needed.")
-        return True # Failsafe for corrupted or non-media files
+    if video_filter or (info.video_codec and info.video_codec not in INSTAGRAM_VIDEO_CODECS):
+        action = "transcode"
+    elif not copy_audio:
+        action = "audio"
+    elif not is_compatible_container:
+        action = "remux"
+    elif not info.faststart:
+        action = "faststart"
+    else:
+        action = "noop"
+    return {"action": action, "audio": "copy" if copy_audio else "aac", "video_filter": video_filter}
 
-def fix_for_instagram(input_file: str, output_file: str) -> str:
+def transform_for_instagram(input_file: str, output_file: str, plan: dict) -> str:
     """
-    Converts a video file to an Instagram-compatible format (MP4 container, AAC audio)
-    by copying the video stream and re-encoding only the audio.
+    Applies a plan from `plan_instagram_video` in one ffmpeg pass. Streams are copied unless
+    the action requires otherwise; video re-encodes use a fast x264 preset.
     """
+    command = ['ffmpeg', '-y', '-i', input_file]
+    if plan["action"] == "transcode":
+        if plan["video_filter"]:
+            command += ['-vf', plan["video_filter"]]
+        command += ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '21', '-pix_fmt', 'yuv420p']
+    else:
+        command += ['-c:v', 'copy']
+    if plan["audio"] == "copy":
+        command += ['-c:a', 'copy']
+    else:
+        command += ['-c:a', 'aac', '-b:a', '192k', '-ar', '48000']
+    command += ['-movflags', '+faststart', output_file]
+
     try:
-        logger.info(f"Converting '{input_file}' to Instagram-compatible format...")
-        command = [
-            'ffmpeg',
-            '-y',
-            '-i', input_file,
-            '-c:v', 'copy',
-            '-c:a', 'aac',
-            '-b:a', '192k',
-            '-ar', '48000',
-            '-movflags', '+faststart',
-            output_file
-        ]
-        
-        result = subprocess.run(command, check=True, capture_output=True, text=True)
+        logger.info(f"Converting '{input_file}' for Instagram ({plan['action']}, video: {plan['video_filter'] or 'default'}, audio: {plan['audio']})...")
+        subprocess.run(command, check=True, capture_output=True, text=True)
         logger.info(f"Successfully converted video to '{output_file}'.")
         return output_file
-        
     except FileNotFoundError:
         logger.critical("ffmpeg is not installed or not found. Video conversion is not possible.")
         raise FileNotFoundError("ffmpeg is not installed. Cannot process video files.")
@@ -154,6 +314,408 @@ def fix_for_instagram(input_file: str, output_file: str) -> str:
         logger.error(f"ffmpeg conversion failed for {input_file}. Error: {e.stderr}")
         raise ValueError(f"Video format is incompatible and conversion failed. Error: {e.stderr}")
 
+def planned_output_info(info: MediaInfo, plan: dict, output_file: str) -> MediaInfo:
+    """MediaInfo for the output of `transform_for_instagram`, derived from the plan instead of a new probe."""
+    changes = {"container": "mov,mp4,m4a,3gp,3g2,mj2", "faststart": True, "size": os.path.getsize(output_file)}
+    if plan["action"] == "transcode":
+        changes.update(video_codec="h264", rotation=0)
+    if plan["video_filter"]:
+        changes.update(width=VERTICAL_WIDTH, height=VERTICAL_HEIGHT)
+    if plan["audio"] == "aac":
+        changes["audio_codec"] = "aac"
+    if info.duration:
+        changes["bitrate"] = int(changes["size"] * 8 / info.duration)
+    return info.derive(**changes)
+
+def instagram_video_profile(aspect_ratio: str) -> str:
+    """Media cache variant for outputs of `transform_for_instagram`. Bump the version whenever the
+    ffmpeg arguments change so stale conversions in the cache are not reused."""
+    return f"ig-v2-{aspect_ratio}"
+
+def extract_thumbnail(input_file: str, output_file: str, at_seconds: float, vertical: bool = False) -> str:
+    """
+    Grabs a single frame as a JPEG. `-noaccurate_seek` makes ffmpeg decode only the keyframe
+    at or before `at_seconds` instead of every frame up to it. `vertical` center-crops the
+    frame to 9:16 the way instagrapi crops reel covers.
+    """
+    command = ['ffmpeg', '-y', '-noaccurate_seek', '-ss', f"{max(at_seconds, 0):.3f}", '-i', input_file, '-frames:v', '1']
+    if vertical:
+        command += ['-vf', "crop='min(iw,trunc(ih*9/16/2)*2)':ih"]
+    command += ['-q:v', '2', output_file]
+    try:
+        subprocess.run(command, check=True, capture_output=True, text=True)
+    except FileNotFoundError:
+        raise FileNotFoundError("ffmpeg is not installed. Cannot create thumbnails.")
+    except subprocess.CalledProcessError as e:
+        raise ValueError(f"Thumbnail extraction failed for {input_file}. Error: {e.stderr}")
+    if not os.path.exists(output_file):
+        raise ValueError(f"ffmpeg produced no frame for {input_file} at {at_seconds:.3f}s.")
+    return output_file
+
+# instagrapi calls analyze_video() on every video upload, which opens the file with moviepy
+# just to read its size and duration and to render a thumbnail. Uploads register what our
+# own probe already knows here, and the patched analyze_video() answers from it.
+# Cached media can be uploaded by several jobs at once, so hints are reference counted.
+_video_hints = {}
+_video_hints_lock = threading.Lock()
+
+def register_video_hint(path, width, height, duration, thumbnail):
+    key = os.path.abspath(str(path))
+    with _video_hints_lock:
+        refs = _video_hints[key][1] if key in _video_hints else 0
+        _video_hints[key] = ((width, height, duration, thumbnail), refs + 1)
+
+def forget_video_hint(path):
+    key = os.path.abspath(str(path))
+    with _video_hints_lock:
+        if key not in _video_hints:
+            return
+        hint, refs = _video_hints[key]
+        if refs <= 1:
+            del _video_hints[key]
+        else:
+            _video_hints[key] = (hint, refs - 1)
+
+def _lookup_video_hint(path):
+    with _video_hints_lock:
+        entry = _video_hints.get(os.path.abspath(str(path)))
+    return entry[0] if entry else None
+
+def _hinted_clip_analyze_video(path, thumbnail=None):
+    hint = _lookup_video_hint(path)
+    if hint is None:
+        return _instagrapi_clip_analyze_video(path, thumbnail)
+    width, height, duration, hinted_thumbnail = hint
+    return Path(thumbnail or hinted_thumbnail), width, height, duration
+
+def _hinted_video_analyze_video(path, thumbnail=None):
+    hint = _lookup_video_hint(path)
+    if hint is None:
+        return _instagrapi_video_analyze_video(path, thumbnail)
+    width, height, duration, hinted_thumbnail = hint
+    return width, height, duration, Path(thumbnail or hinted_thumbnail)
+
+_instagrapi_clip_analyze_video = instagrapi_clip.analyze_video
+_instagrapi_video_analyze_video = instagrapi_video.analyze_video
+instagrapi_clip.analyze_video = _hinted_clip_analyze_video
+instagrapi_video.analyze_video = _hinted_video_analyze_video
+
+# === Media Cache ===
+MEDIA_CACHE_DIR = "media_cache"
+
+class MediaCache:
+    """
+    Disk cache for downloaded and converted media, keyed by Telegram's `file_unique_id`
+    (or a content digest, see `content_key`) plus a variant tag (the conversion profile,
+    or "original" for the raw download).
+    Entries are reference counted: a file handed out to a job is never evicted or deleted
+    until that job releases it. Least recently used entries are evicted above `max_bytes`,
+    and unused entries expire `ttl_seconds` after their last use.
+    """
+    def __init__(self, directory, max_bytes, ttl_seconds=None):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> {"path", "size", "refs", "used_at"}, oldest first
+        self._keys_by_path = {}
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(file_unique_id, variant="original"):
+        return f"{file_unique_id}__{variant}"
+
+    @staticmethod
+    def content_key(digest, variant):
+        """Key for outputs derived from file content rather than from a Telegram file."""
+        return f"sha256-{digest[:40]}__{variant}"
+
+    def load(self):
+        """Rebuilds the index from the cache directory. Blocking; call it via asyncio.to_thread."""
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            key, _ = os.path.splitext(name)
+            if "__" not in key or "." in key:
+                # Not one of ours (e.g. a thumbnail instagrapi wrote next to a cached video).
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            stat = os.stat(path)
+            found.append((stat.st_mtime, key, path, stat.st_size))
+        with self._lock:
+            for mtime, key, path, size in sorted(found):  # mtime is the last use, see acquire()
+                self._entries[key] = {"path": path, "size": size, "refs": 0, "used_at": mtime}
+                self._keys_by_path[path] = key
+                self._total_bytes += size
+            self._evict_locked()
+        logger.info(f"Media cache loaded: {len(self._entries)} entries, {self._total_bytes / (1024 * 1024):.2f} MB.")
+
+    def acquire(self, key):
+        """Returns the cached path for `key` and takes a reference on it, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._expired_locked(entry) or not os.path.exists(entry["path"]):
+                if entry is not None and entry["refs"] == 0:
+                    self._drop_locked(key)
+                self.misses += 1
+                return None
+            entry["refs"] += 1
+            entry["used_at"] = time.time()
+            self._entries.move_to_end(key)
+            self.hits += 1
+        try:
+            os.utime(entry["path"])  # Keeps the LRU order and TTL across restarts.
+        except OSError:
+            pass
+        return entry["path"]
+
+    def store(self, key, src_path):
+        """
+        Moves `src_path` into the cache under `key` and returns the cached path, already
+        referenced once. If `key` is already cached, that file is kept (other jobs may be
+        reading it) and `src_path` is deleted instead.
+        """
+        _, ext = os.path.splitext(src_path)
+        dest_path = os.path.join(self.directory, f"{key}{ext}")
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and os.path.exists(entry["path"]):
+                entry["refs"] += 1
+                entry["used_at"] = time.time()
+                self._entries.move_to_end(key)
+                existing_path = entry["path"]
+            else:
+                if entry is not None:
+                    self._drop_locked(key)
+                existing_path = None
+                # Job directories sit next to the cache directory, so this is a cheap rename.
+                os.replace(src_path, dest_path)
+                size = os.path.getsize(dest_path)
+                self._entries[key] = {"path": dest_path, "size": size, "refs": 1, "used_at": time.time()}
+                self._keys_by_path[dest_path] = key
+                self._total_bytes += size
+                self._evict_locked()
+        if existing_path is not None:
+            try:
+                os.remove(src_path)
+            except OSError as e:
+                logger.error(f"Error deleting file {src_path}: {e}")
+            return existing_path
+        return dest_path
+
+    def owns(self, path):
+        with self._lock:
+            return path in self._keys_by_path
+
+    def release(self, path):
+        with self._lock:
+            key = self._keys_by_path.get(path)
+            if key is None:
+                return
+            entry = self._entries[key]
+            entry["refs"] = max(0, entry["refs"] - 1)
+            entry["used_at"] = time.time()
+            self._evict_locked()
+
+    def expire(self):
+        """Drops unreferenced entries past their TTL. Returns how many were removed."""
+        with self._lock:
+            expired = [k for k, e in self._entries.items() if e["refs"] == 0 and self._expired_locked(e)]
+            for key in expired:
+                logger.info(f"Expiring '{key}' from media cache.")
+                self._drop_locked(key)
+        return len(expired)
+
+    def stats(self):
+        with self._lock:
+            in_use = sum(1 for e in self._entries.values() if e["refs"] > 0)
+            return {
+                "entries": len(self._entries), "in_use": in_use, "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses
+            }
+
+    def _expired_locked(self, entry):
+        return self.ttl_seconds is not None and time.time() - entry["used_at"] > self.ttl_seconds
+
+    def _drop_locked(self, key):
+        entry = self._entries.pop(key)
+        self._keys_by_path.pop(entry["path"], None)
+        self._total_bytes -= entry["size"]
+        try:
+            os.remove(entry["path"])
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Error deleting cached file {entry['path']}: {e}")
+
+    def _evict_locked(self):
+        if self._total_bytes <= self.max_bytes:
+            return
+        for key in [k for k, e in self._entries.items() if e["refs"] == 0]:
+            if self._total_bytes <= self.max_bytes:
+                break
+            logger.info(f"Evicting '{key}' from media cache.")
+            self._drop_locked(key)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+_digest_memo = OrderedDict()  # (path, size, mtime_ns) -> hex digest
+_digest_memo_lock = threading.Lock()
+
+def file_digest(path):
+    """
+    SHA-256 of a file, read in 1 MiB chunks so large videos never sit in memory. Results are
+    memoized per (path, size, mtime) since the same file is hashed by several stages.
+    Blocking; call it via asyncio.to_thread.
+    """
+    stat = os.stat(path)
+    memo_key = (path, stat.st_size, stat.st_mtime_ns)
+    with _digest_memo_lock:
+        if memo_key in _digest_memo:
+            return _digest_memo[memo_key]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(partial(f.read, HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    hexdigest = digest.hexdigest()
+    with _digest_memo_lock:
+        _digest_memo[memo_key] = hexdigest
+        while len(_digest_memo) > 256:
+            _digest_memo.popitem(last=False)
+    return hexdigest
+
+async def content_cache_key(path, variant):
+    """Media cache key for an output derived from the content of `path`, or None if it can't be hashed."""
+    if media_cache is None:
+        return None
+    try:
+        return MediaCache.content_key(await asyncio.to_thread(file_digest, path), variant)
+    except OSError as e:
+        logger.warning(f"Could not hash '{path}' for the media cache: {e}")
+        return None
+
+# === Temp Storage Workspace ===
+WORKSPACE_DIR = os.path.join("downloads", "jobs")
+
+class WorkspaceQuotaExceeded(Exception):
+    pass
+
+class WorkspaceManager:
+    """
+    Gives every upload job its own directory and keeps track of the files the job holds
+    (plain files and media cache references). Releasing a job frees all of them at once.
+    New downloads must reserve space first; when the global quota is used up they wait
+    for other jobs to finish and are rejected after `wait_timeout` seconds.
+    """
+    def __init__(self, root, quota_bytes, wait_timeout=60):
+        self.root = os.path.abspath(root)
+        self.quota_bytes = quota_bytes
+        self.wait_timeout = wait_timeout
+        self._jobs = {}  # job_id -> {"user_id", "dir", "files", "reserved", "created_at"}
+        self._reserved_bytes = 0
+        self._waiters = []
+
+    def create_job(self, user_id):
+        job_id = uuid.uuid4().hex[:12]
+        job_dir = os.path.join(self.root, job_id)
+        os.makedirs(job_dir, exist_ok=True)
+        self._jobs[job_id] = {"user_id": user_id, "dir": job_dir, "files": [], "reserved": 0, "created_at": time.time()}
+        logger.info(f"Workspace job {job_id} created for user {user_id}.", extra={"user_id": user_id, "job_id": job_id})
+        return job_id
+
+    def job_dir(self, job_id):
+        job = self._jobs.get(job_id)
+        return job["dir"] if job else None
+
+    def track(self, job_id, path):
+        job = self._jobs.get(job_id)
+        if job is None or not path:
+            # The job is gone (cancelled or swept) - don't leave the file behind.
+            cleanup_temp_files([path])
+            return
+        job["files"].append(path)
+
+    async def reserve(self, job_id, nbytes):
+        job = self._jobs.get(job_id)
+        if job is None or nbytes <= 0:
+            return
+        if nbytes > self.quota_bytes:
+            raise WorkspaceQuotaExceeded(f"File needs {nbytes / (1024 * 1024):.1f} MB, more than the whole temp storage quota.")
+        deadline = time.monotonic() + self.wait_timeout
+        while self._reserved_bytes + nbytes > self.quota_bytes:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise WorkspaceQuotaExceeded("Temp storage is full. Please try again in a few minutes.")
+            logger.warning(f"Workspace quota reached, job {job_id} waiting for {nbytes / (1024 * 1024):.1f} MB.")
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait([waiter], timeout=remaining)
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+            if job_id not in self._jobs:
+                return
+        job["reserved"] += nbytes
+        self._reserved_bytes += nbytes
+
+    def release(self, job_id):
+        job = self._jobs.pop(job_id, None) if job_id else None
+        if job is None:
+            return
+        cleanup_temp_files(job["files"])
+        shutil.rmtree(job["dir"], ignore_errors=True)
+        self._reserved_bytes -= job["reserved"]
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        logger.info(f"Workspace job {job_id} released.")
+
+    def set_busy(self, job_id, busy=True):
+        """Marks a job as being worked on so the sweeper leaves it alone even without a user state."""
+        job = self._jobs.get(job_id)
+        if job is not None:
+            job["busy"] = busy
+
+    def is_busy(self, job_id):
+        job = self._jobs.get(job_id)
+        return bool(job and job.get("busy"))
+
+    def sweep(self, live_job_ids, grace_seconds=120):
+        """Releases jobs nothing refers to any more and returns directories that belong to no job."""
+        now = time.time()
+        swept = 0
+        for job_id, job in list(self._jobs.items()):
+            if job_id in live_job_ids or job.get("busy") or now - job["created_at"] < grace_seconds:
+                continue
+            logger.warning(f"Sweeping orphaned workspace job {job_id} of user {job['user_id']}.")
+            self.release(job_id)
+            swept += 1
+        orphan_dirs = []
+        if os.path.isdir(self.root):
+            orphan_dirs = [os.path.join(self.root, name) for name in os.listdir(self.root) if name not in self._jobs]
+        return swept, orphan_dirs
+
+    def disk_usage_bytes(self):
+        """Bytes currently on disk under the workspace root. Blocking; call it via asyncio.to_thread."""
+        total = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, name))
+                except OSError:
+                    pass
+        return total
+
+    def stats(self):
+        return {"jobs": len(self._jobs), "reserved": self._reserved_bytes, "quota": self.quota_bytes}
+
 
 # === Global Bot Settings ===
 DEFAULT_GLOBAL_SETTINGS = {
@@ -170,7 +732,21 @@ DEFAULT_GLOBAL_SETTINGS = {
         "others": "",
         "custom_buttons": {}
     },
-    "no_compression_admin": True
+    "no_compression_admin": True,
+    # Per-tier video compression, used when "no_compression_admin" is off.
+    "compression_tiers": {
+        "free": {"enabled": True, "target_mb": 50},
+        "premium": {"enabled": False, "target_mb": 100}
+    },
+    "media_cache_max_mb": 2048,
+    "media_cache_ttl_hours": 72,
+    "temp_storage_quota_mb": 5120,
+    "download_parallel_parts": 4,
+    "download_parallel_min_mb": 20,
+    "max_concurrent_transmissions": 8,
+    "media_pool_workers": 2,
+    "story_segment_seconds": 60,
+    "upload_retry_window_minutes": 30
 }
 
 # --- Global State & DB Management ---
@@ -178,18 +754,126 @@ mongo = None
 db = None
 global_settings = {}
 upload_semaphore = None
-user_upload_locks = {}
+upload_slot_usage = {"waiting": 0, "in_use": 0}  # jobs waiting for / holding an upload slot, see upload_slot()
+media_cache = None
+media_executor = None
+workspace = None
 MAX_FILE_SIZE_BYTES = 0
 MAX_CONCURRENT_UPLOADS = 0
 shutdown_event = asyncio.Event()
 valid_log_channel = False
 
 # Pyrogram Client
-app = Client("upload_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+# Workers never receive updates; they only download media and edit the user's processing message.
+if WORKER_MODE:
+    app = Client(f"upload_worker_{WORKER_ID}", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN, in_memory=True, no_updates=True)
+else:
+    app = Client("upload_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
 # Instagram Client
 insta_client = InstaClient()
 insta_client.delay_range = [1, 3]
 
+# --- Metrics (served on /metrics by the health server) ---
+metrics_registry = metrics.Registry()
+STAGE_SECONDS = metrics_registry.histogram(
+    "uploadbot_stage_duration_seconds", "Time spent in each upload pipeline stage.", ("stage",)
+)
+UPLOADS = metrics_registry.counter("uploadbot_uploads", "Instagram uploads by type and outcome, per account.", ("upload_type", "outcome"))
+INSTAGRAM_ERRORS = metrics_registry.counter("uploadbot_instagram_errors", "Errors raised by Instagram calls, by class.", ("error",))
+TELEGRAM_CALLS = metrics_registry.counter("uploadbot_telegram_calls", "Outbound Telegram API calls, by method.", ("method",))
+LOOP_LAG = metrics_registry.histogram(
+    "uploadbot_event_loop_lag_seconds", "How late the event loop ran a periodic heartbeat.",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+
+def _mongo_ping_seconds():
+    if mongo is None or db is None:
+        return None
+    start = time.monotonic()
+    mongo.admin.command('ping')
+    return time.monotonic() - start
+
+def _queued_upload_jobs():
+    if UPLOAD_QUEUE != "mongo" or db is None:
+        return None
+    return db.upload_jobs.count_documents({"status": "queued"})
+
+metrics_registry.gauge("uploadbot_active_tasks", "Background tasks tracked by the TaskTracker.", callback=lambda: task_tracker.active_count())
+metrics_registry.gauge("uploadbot_upload_slots", "Concurrent upload slots.", callback=lambda: MAX_CONCURRENT_UPLOADS)
+metrics_registry.gauge(
+    "uploadbot_upload_slots_available", "Upload slots not in use right now.",
+    callback=lambda: max(MAX_CONCURRENT_UPLOADS - upload_slot_usage["in_use"], 0) if upload_semaphore is not None else None
+)
+metrics_registry.gauge("uploadbot_upload_slot_waiting", "Jobs waiting for an upload slot.", callback=lambda: upload_slot_usage["waiting"])
+metrics_registry.gauge("uploadbot_upload_jobs_queued", "Jobs waiting in the Mongo upload queue.", callback=_queued_upload_jobs)
+metrics_registry.gauge("uploadbot_upload_retries_parked", "Failed upload stages waiting for a retry.", callback=lambda: len(upload_retries))
+metrics_registry.gauge("uploadbot_workspace_jobs", "Upload jobs holding temp storage.", callback=lambda: workspace.stats()["jobs"] if workspace else None)
+metrics_registry.gauge(
+    "uploadbot_media_cache_bytes", "Bytes held by the media cache.",
+    callback=lambda: media_cache.stats()["bytes"] if media_cache is not None else None
+)
+metrics_registry.gauge("uploadbot_mongo_ping_seconds", "Round trip of a MongoDB ping, measured at scrape time.", callback=_mongo_ping_seconds)
+
+def _registry_sizes():
+    registries = {
+        "user_states": user_states, "user_locks": state_backend.locks, "progress_updates": _progress_updates,
+        "user_tasks": task_tracker._user_specific_tasks if task_tracker else {},
+        "progress_futures": task_tracker._progress_futures if task_tracker else {},
+        "upload_retries": upload_retries, "insta_clients": insta_clients._clients, "video_hints": _video_hints,
+    }
+    return {(name,): len(registry) for name, registry in registries.items()}
+
+metrics_registry.gauge("uploadbot_state_entries", "Entries held per per-user registry.", labelnames=("registry",), callback=_registry_sizes)
+
+def count_telegram_calls(client):
+    """Wraps `client.invoke`, which every Pyrogram method goes through, to count outbound calls."""
+    invoke = client.invoke
+
+    async def counted_invoke(query, *args, **kwargs):
+        TELEGRAM_CALLS.inc(method=type(query).__name__)
+        return await invoke(query, *args, **kwargs)
+
+    client.invoke = counted_invoke
+
+count_telegram_calls(app)
+
+class StageTimer:
+    """
+    Monotonic per-stage timings of one upload job, stored with its `db.uploads` records.
+    Every stage is also observed on the stage histogram. A stage that runs more than once
+    (one download per album item) adds up; "upload" is kept per account.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.account_stages = {}
+        self.bytes = Counter()
+        self.video_actions = []
+
+    @contextmanager
+    def stage(self, name, account=None):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            STAGE_SECONDS.observe(elapsed, stage=name)
+            logger.info(f"Stage '{name}' took {elapsed:.2f}s.", extra={"stage": name, "duration": elapsed})
+            stages = self.account_stages.setdefault(account, {}) if account else self.stages
+            stages[name] = stages.get(name, 0.0) + elapsed
+
+    def as_document(self, account=None):
+        stages = {**self.stages, **self.account_stages.get(account, {})}
+        return {
+            "stages": {name: round(seconds, 3) for name, seconds in stages.items()},
+            "total_seconds": round(sum(stages.values()), 3),
+            "bytes": dict(self.bytes),
+            "video_actions": list(self.video_actions),
+        }
+
+def timed_stage(timer, name, account=None):
+    """`timer.stage(...)` when the job has a timer, otherwise just the histogram."""
+    return timer.stage(name, account) if timer is not None else STAGE_SECONDS.time(stage=name)
+
 # --- Task Management ---
 class TaskTracker:
     def __init__(self):
@@ -214,16 +898,34 @@ class TaskTracker:
             if user_id not in self._user_specific_tasks:
                 self._user_specific_tasks[user_id] = {}
             self._user_specific_tasks[user_id][task_name] = task
-            logger.info(f"User-specific task '{task_name}' for user {user_id} created.")
-        logger.info(f"Task {task.get_name()} created. Total tracked tasks: {len(self._tasks)}")
+            task.add_done_callback(partial(self._forget_user_task, user_id, task_name))
+            logger.debug(f"User-specific task '{task_name}' for user {user_id} created.", extra={"user_id": user_id})
+        logger.debug(f"Task {task.get_name()} created. Total tracked tasks: {len(self._tasks)}")
         return task
 
+    def active_count(self):
+        return len(self._tasks)
+
+    def _forget_user_task(self, user_id, task_name, task):
+        user_tasks = self._user_specific_tasks.get(user_id)
+        if user_tasks and user_tasks.get(task_name) is task:
+            del user_tasks[task_name]
+            if not user_tasks:
+                del self._user_specific_tasks[user_id]
+
     def add_progress_future(self, future, user_id, message_id):
         if user_id not in self._progress_futures:
             self._progress_futures[user_id] = {}
         self._progress_futures[user_id][message_id] = future
-        future.add_done_callback(lambda f: self._progress_futures.get(user_id, {}).pop(message_id, None))
-        logger.info(f"Progress future added for user {user_id}, msg {message_id}.")
+        future.add_done_callback(lambda f: self._forget_progress_future(user_id, message_id))
+        logger.debug(f"Progress future added for user {user_id}, msg {message_id}.", extra={"user_id": user_id})
+
+    def _forget_progress_future(self, user_id, message_id):
+        futures = self._progress_futures.get(user_id)
+        if futures is not None:
+            futures.pop(message_id, None)
+            if not futures:
+                del self._progress_futures[user_id]
 
     def cancel_user_task(self, user_id, task_name):
         if user_id in self._user_specific_tasks and task_name in self._user_specific_tasks[user_id]:
@@ -286,8 +988,219 @@ def to_bold_sans(text: str) -> str:
     capitalized_text = ' '.join(word.capitalize() for word in sanitized_text.split())
     return ''.join(bold_sans_map.get(char, char) for char in capitalized_text)
 
+# ===================================================================
+# ================== CONVERSATION STATE BACKENDS ====================
+# ===================================================================
+
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()  # "memory" or "mongo"
+REPLICA_ID = os.getenv("REPLICA_ID") or f"{socket.gethostname()}-{os.getpid()}"
+STATE_LEASE_SECONDS = int(os.getenv("STATE_LEASE_SECONDS", "120"))
+# Hard cap and idle TTL for every per-user registry (flow states, user locks, progress).
+# Past the cap the least recently used entries are dropped first.
+STATE_MAX_USERS = int(os.getenv("STATE_MAX_USERS", "20000"))
+STATE_TTL_SECONDS = int(os.getenv("STATE_TTL_SECONDS", str(6 * 3600)))
+
+def _to_state_document(value):
+    """
+    Returns the JSON/BSON-safe part of a flow state value. Message, media and location refs
+    are stored as their ids; other live objects (StageTimer) are dropped.
+    """
+    if value is None or isinstance(value, (str, bool, int, float, datetime)):
+        return value
+    if isinstance(value, (MessageRef, MediaRef, LocationRef)):
+        return value.as_document()
+    if isinstance(value, dict):
+        doc = {}
+        for k, v in value.items():
+            converted = _to_state_document(v)
+            if converted is not None or v is None:
+                doc[str(k)] = converted
+        return doc
+    if isinstance(value, (list, tuple)):
+        return [_to_state_document(v) for v in value]
+    return None
+
+def _state_evictable(user_id, state):
+    """Flow states whose media is being uploaded are kept however long the upload takes."""
+    return workspace is None or not workspace.is_busy(get_state_job_id(state))
+
+def _state_evicted(user_id, state):
+    job_id = get_state_job_id(state)
+    if workspace is not None and job_id:
+        workspace.release(job_id)
+    logger.info(f"Dropped the idle flow state of user {user_id}.")
+
+class InMemoryStateBackend:
+    """Per-user flow state and user locks kept in this process. Only valid for a single bot process."""
+    name = "memory"
+
+    def __init__(self):
+        self.states = BoundedRegistry(
+            "user_states", STATE_MAX_USERS, STATE_TTL_SECONDS, can_evict=_state_evictable, on_evict=_state_evicted
+        )
+        self.locks = BoundedRegistry("user_locks", STATE_MAX_USERS, STATE_TTL_SECONDS, can_evict=lambda _, lock: not lock.locked())
+
+    async def owns_user(self, user_id):
+        return True
+
+    async def try_lock(self, user_id):
+        """Takes the user's lock without waiting. Returns False if another operation holds it."""
+        lock = self.locks.setdefault(user_id, asyncio.Lock())
+        if lock.locked():
+            return False
+        await lock.acquire()
+        return True
+
+    async def unlock(self, user_id):
+        lock = self.locks.get(user_id)
+        if lock and lock.locked():
+            lock.release()
+
+    async def flush(self):
+        pass
+
+    async def close(self):
+        pass
+
+class MongoStateBackend(InMemoryStateBackend):
+    """
+    Shares flow state and user locks between bot replicas through MongoDB.
+
+    Every user is leased to one replica at a time (`db.user_leases`). The replica holding the
+    lease is the only one that handles the user's updates, so the user lock is the lease plus
+    a local lock, and the user's background tasks (TaskTracker) live on that replica too.
+    Flow state is served from memory and written through to `db.user_states`, so a replica
+    that takes over an expired lease picks the conversation up where it was left.
+    """
+    name = "mongo"
+
+    def __init__(self, database, replica_id=REPLICA_ID, lease_seconds=STATE_LEASE_SECONDS):
+        super().__init__()
+        self.db = database
+        self.replica_id = replica_id
+        self.lease_seconds = lease_seconds
+        self._leases = {}  # user_id -> monotonic time our lease runs out
+        self._flushed = {}  # user_id -> last state document written
+
+    async def owns_user(self, user_id):
+        expires = self._leases.get(user_id)
+        if expires and expires - time.monotonic() > self.lease_seconds / 2:
+            return True
+        now = datetime.utcnow()
+        try:
+            await asyncio.to_thread(
+                self.db.user_leases.find_one_and_update,
+                {"_id": user_id, "$or": [{"owner": self.replica_id}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"owner": self.replica_id, "expires_at": now + timedelta(seconds=self.lease_seconds)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # Another replica holds a live lease on this user.
+            self._leases.pop(user_id, None)
+            return False
+        if expires is None:
+            await self._hydrate(user_id)
+        self._leases[user_id] = time.monotonic() + self.lease_seconds
+        return True
+
+    async def try_lock(self, user_id):
+        if not await self.owns_user(user_id):
+            return False
+        return await super().try_lock(user_id)
+
+    async def _hydrate(self, user_id):
+        doc = await asyncio.to_thread(self.db.user_states.find_one, {"_id": user_id})
+        if doc and get_state_job_id(doc.get("state")):
+            # Downloaded media lives on the other replica's disk; the user has to start that upload again.
+            logger.warning(f"Discarding flow state of user {user_id}: its media is held by replica {doc.get('owner')}.")
+            await asyncio.to_thread(self.db.user_states.delete_one, {"_id": user_id})
+        elif doc and doc.get("state"):
+            self.states[user_id] = restore_refs(doc["state"], app)
+            self._flushed[user_id] = doc["state"]
+            logger.info(f"Took over flow state of user {user_id} from replica {doc.get('owner')}.")
+
+    async def flush(self):
+        """Writes changed states through to MongoDB and renews or drops this replica's leases."""
+        for user_id in list(self._leases):
+            state = self.states.get(user_id)
+            doc = _to_state_document(state) if state is not None else None
+            if doc == self._flushed.get(user_id):
+                continue
+            if doc is None:
+                await asyncio.to_thread(self.db.user_states.delete_one, {"_id": user_id})
+            else:
+                await asyncio.to_thread(
+                    self.db.user_states.update_one,
+                    {"_id": user_id},
+                    {"$set": {"state": doc, "owner": self.replica_id, "updated_at": datetime.utcnow()}},
+                    upsert=True
+                )
+            self._flushed[user_id] = doc
+
+        # Keep leases only for users with an open flow or a running operation.
+        busy = [u for u in self._leases if u in self.states or (self.locks.get(u) is not None and self.locks.get(u).locked())]
+        for user_id in set(self._leases) - set(busy):
+            self._leases.pop(user_id, None)
+            self._flushed.pop(user_id, None)
+            self.locks.pop(user_id, None)
+        if busy:
+            now = datetime.utcnow()
+            await asyncio.to_thread(
+                self.db.user_leases.update_many,
+                {"_id": {"$in": busy}, "owner": self.replica_id},
+                {"$set": {"expires_at": now + timedelta(seconds=self.lease_seconds)}}
+            )
+            for user_id in busy:
+                self._leases[user_id] = time.monotonic() + self.lease_seconds
+
+    async def close(self):
+        await self.flush()
+        # Hand our users over right away instead of making other replicas wait for expiry.
+        await asyncio.to_thread(
+            self.db.user_leases.update_many,
+            {"owner": self.replica_id},
+            {"$set": {"expires_at": datetime.utcnow()}}
+        )
+
+state_backend = InMemoryStateBackend()
 # State dictionary to hold user states
-user_states = {}
+user_states = state_backend.states
+
+async def partition_gate(_, update):
+    """Drops updates of users leased to another replica. Registered only for the Mongo backend."""
+    user = getattr(update, "from_user", None)
+    if user and not await state_backend.owns_user(user.id):
+        update.stop_propagation()
+
+# Update recording for load tests: UPDATE_LOG=update_log.jsonl writes an anonymized line per
+# incoming message and callback query that benchmarks/replay_updates.py can play back.
+UPDATE_LOG = os.getenv("UPDATE_LOG", "")
+update_recorder = None
+
+async def record_update(_, update):
+    update_recorder.record(update)
+
+def start_update_recorder():
+    """Registers the recorder ahead of every other handler. Call after all handlers are added."""
+    global update_recorder
+    keyboard = get_main_keyboard(ADMIN_ID, PREMIUM_PLATFORMS).keyboard
+    update_recorder = update_log.UpdateRecorder(
+        UPDATE_LOG,
+        keep_texts=[button.text for row in keyboard for button in row],
+        callback_patterns=update_log.callback_patterns(app.dispatcher.groups),
+        admin_id=ADMIN_ID,
+    )
+    app.add_handler(MessageHandler(record_update), group=-2)
+    app.add_handler(CallbackQueryHandler(record_update), group=-2)
+    logger.info(f"Recording incoming updates to '{UPDATE_LOG}'.")
+
+async def state_flush_task():
+    while True:
+        await asyncio.sleep(max(STATE_LEASE_SECONDS / 3, 5))
+        try:
+            await state_backend.flush()
+        except Exception as e:
+            logger.error(f"Failed to flush flow state to the {state_backend.name} backend: {e}")
 
 PREMIUM_PLANS = {
     "6_hour_trial": {"duration": timedelta(hours=6), "price": "Free / Free"},
@@ -360,15 +1273,18 @@ def get_insta_logout_confirm_markup(username):
 admin_markup = InlineKeyboardMarkup([
     [InlineKeyboardButton("👥 ᴜꜱᴇʀꜱ ʟɪꜱᴛ", callback_data="users_list"), InlineKeyboardButton("👤 ᴜꜱᴇʀ ᴅᴇᴛᴀɪʟꜱ", callback_data="admin_user_details")],
     [InlineKeyboardButton("➕ ᴍᴀɴᴀɢᴇ ᴩʀᴇᴍɪᴜᴍ", callback_data="manage_premium")],
-    [InlineKeyboardButton("📢 ʙʀᴏᴀᴅᴄᴀꜱᴛ", callback_data="broadcast_message")],
-    [InlineKeyboardButton("⚙️ ɢʟᴏʙᴀʟ ꜱᴇᴛᴛɪɴɢꜱ", callback_data="global_settings_panel")],
-    [InlineKeyboardButton("📊 ꜱᴛᴀᴛꜱ ᴩᴀɴᴇʟ", callback_data="admin_stats_panel")],
+    [InlineKeyboardButton("📢 ʙʀᴏᴀᴅᴄᴀꜱᴛ", callback_data="broadcast_message"), InlineKeyboardButton("🐢 ʟᴏᴏᴩ ʟᴀɢ", callback_data="loop_lag_report")],
+    [InlineKeyboardButton("⚙️ ɢʟᴏʙᴀʟ ꜱᴇᴛᴛɪɴɢꜱ", callback_data="global_settings_panel"), InlineKeyboardButton("🔬 ᴩʀᴏꜰɪʟᴇʀ", callback_data="profile_menu")],
+    [InlineKeyboardButton("📊 ꜱᴛᴀᴛꜱ ᴩᴀɴᴇʟ", callback_data="admin_stats_panel"), InlineKeyboardButton("⏱️ ꜱᴛᴀɢᴇ ᴛɪᴍɪɴɢꜱ", callback_data="stage_timings_24")],
     [InlineKeyboardButton("🔙 ʙᴀᴄᴋ ᴍᴇɴᴜ", callback_data="back_to_main_menu")]
 ])
 
 def get_admin_global_settings_markup():
     event_status = "ON" if global_settings.get("special_event_toggle") else "OFF"
     compression_status = "ᴅɪꜱᴀʙʟᴇᴅ" if global_settings.get("no_compression_admin") else "ᴇɴᴀʙʟᴇᴅ"
+    tiers = global_settings.get("compression_tiers", {})
+    free_status = "ON" if tiers.get("free", {}).get("enabled") else "OFF"
+    premium_status = "ON" if tiers.get("premium", {}).get("enabled") else "OFF"
     return InlineKeyboardMarkup([
         [InlineKeyboardButton(f"📢 Special Event ({event_status})", callback_data="toggle_special_event")],
         [InlineKeyboardButton("✏️ Set Event Title", callback_data="set_event_title")],
@@ -378,6 +1294,8 @@ def get_admin_global_settings_markup():
         [InlineKeyboardButton("ꜱʜᴏᴡ ꜱyꜱᴛᴇᴍ ꜱᴛᴀᴛꜱ", callback_data="show_system_stats")],
         [InlineKeyboardButton("🌐 ᴩʀᴏxʏ ꜱᴇᴛᴛɪɴɢꜱ", callback_data="set_proxy_url")],
         [InlineKeyboardButton(f"🗜️ ᴄᴏᴍᴩʀᴇꜱꜱɪᴏɴ ({compression_status})", callback_data="toggle_compression_admin")],
+        [InlineKeyboardButton(f"🆓 Free Tier ({free_status})", callback_data="toggle_compression_tier_free"),
+         InlineKeyboardButton(f"💎 Premium Tier ({premium_status})", callback_data="toggle_compression_tier_premium")],
         [InlineKeyboardButton("💰 ᴩᴀyᴍᴇɴᴛ ꜱᴇᴛᴛɪɴɢꜱ", callback_data="payment_settings_panel")],
         [InlineKeyboardButton("🔙 ʙᴀᴄᴋ ᴛᴏ ᴀᴅᴍɪɴ", callback_data="admin_panel")]
     ])
@@ -462,7 +1380,8 @@ def get_upload_options_markup(is_album=False, is_premium=True):
     if is_premium:
         buttons.extend([
             [InlineKeyboardButton("👥 ᴛᴀɢ ᴩᴇᴏᴩʟᴇ", callback_data="tag_users_insta")],
-            [InlineKeyboardButton("📍 ʟᴏᴄᴀᴛɪᴏɴ", callback_data="add_location_insta")]
+            [InlineKeyboardButton("📍 ʟᴏᴄᴀᴛɪᴏɴ", callback_data="add_location_insta")],
+            [InlineKeyboardButton("🔀 ᴍᴜʟᴛɪᴩʟᴇ ᴀᴄᴄᴏᴜɴᴛꜱ", callback_data="multi_account_insta")]
         ])
     
     # The primary action button
@@ -543,6 +1462,8 @@ async def is_premium_for_platform(user_id, platform):
 
 # MODIFIED FUNCTION TO SAVE DEVICE SETTINGS
 async def save_platform_session(user_id, platform, session_data, device_settings, username):
+    if platform == "instagram":
+        insta_clients.discard(user_id, username)
     if db is None: return
     await asyncio.to_thread(
         db.sessions.update_one,
@@ -569,6 +1490,8 @@ async def load_platform_session_data(user_id, platform, username):
     return None, None
 
 async def delete_platform_session(user_id, platform, username):
+    if platform == "instagram":
+        insta_clients.discard(user_id, username)
     if db is None: return
     await asyncio.to_thread(db.sessions.delete_one, {"user_id": user_id, "platform": platform, "username": username})
 
@@ -637,7 +1560,9 @@ async def restart_bot(msg):
     )
     shutdown_event.set()
 
-_progress_updates = {}
+# Written from download threads, read by monitor_progress_task. Entries of a monitor that was
+# cancelled before the download finished expire after ten idle minutes.
+_progress_updates = BoundedRegistry("progress_updates", STATE_MAX_USERS, 600)
 
 def progress_callback_threaded(current, total, ud_type, msg_id, chat_id, start_time, last_update_time):
     now = time.time()
@@ -645,23 +1570,21 @@ def progress_callback_threaded(current, total, ud_type, msg_id, chat_id, start_t
         return
     last_update_time[0] = now
     
-    with threading.Lock():
-        _progress_updates[(chat_id, msg_id)] = {
-            "current": current, "total": total, "ud_type": ud_type, "start_time": start_time, "now": now
-        }
+    _progress_updates[(chat_id, msg_id)] = {
+        "current": current, "total": total, "ud_type": ud_type, "start_time": start_time, "now": now
+    }
 
 async def monitor_progress_task(chat_id, msg_id, progress_msg):
     try:
         while True:
             await asyncio.sleep(2)
-            with threading.Lock():
-                update_data = _progress_updates.get((chat_id, msg_id))
+            update_data = _progress_updates.get((chat_id, msg_id))
             if update_data:
                 current, total, ud_type, start_time, now = (
                     update_data['current'], update_data['total'], update_data['ud_type'],
                     update_data['start_time'], update_data['now']
                 )
-                percentage = current * 100 / total
+                percentage = current * 100 / total if total else 0
                 speed = current / (now - start_time) if (now - start_time) > 0 else 0
                 eta_seconds = (total - current) / speed if speed > 0 else 0
                 eta = timedelta(seconds=int(eta_seconds))
@@ -683,32 +1606,395 @@ async def monitor_progress_task(chat_id, msg_id, progress_msg):
                     pass
             
             if update_data and update_data['current'] == update_data['total']:
-                with threading.Lock():
-                    _progress_updates.pop((chat_id, msg_id), None)
+                _progress_updates.pop((chat_id, msg_id), None)
                 break
     except asyncio.CancelledError:
         logger.info(f"Progress monitor task for msg {msg_id} was cancelled.")
 
 def cleanup_temp_files(files_to_delete):
     for file_path in files_to_delete:
+        if media_cache is not None and file_path and media_cache.owns(file_path):
+            # Cached files may be shared with other jobs; just drop this job's reference.
+            media_cache.release(file_path)
+            continue
         if file_path and os.path.exists(file_path):
             try:
                 os.remove(file_path)
             except Exception as e:
                 logger.error(f"Error deleting file {file_path}: {e}")
 
+def get_file_unique_id(msg_context):
+    if not msg_context:
+        return None
+    media = msg_context.video or msg_context.photo or msg_context.document
+    return getattr(media, "file_unique_id", None)
+
+_cache_fills = {}  # media cache key -> Future, done when the job producing that entry is finished
+
+@asynccontextmanager
+async def filling_media_cache(key):
+    """
+    Looks up `key` in the media cache, yielding the cached path (referenced for the caller) or
+    None. On None the caller produces the file and stores it under `key` inside the block;
+    other jobs missing the same key meanwhile wait for that instead of producing it again.
+    """
+    if media_cache is None or not key:
+        yield None
+        return
+    while (pending := _cache_fills.get(key)) is not None:
+        logger.info(f"Waiting for another job to fill media cache entry '{key}'.")
+        await asyncio.shield(pending)
+    cached_path = media_cache.acquire(key)
+    if cached_path:
+        yield cached_path
+        return
+    fill = _cache_fills[key] = asyncio.get_running_loop().create_future()
+    try:
+        yield None
+    finally:
+        del _cache_fills[key]
+        fill.set_result(None)
+
+async def download_media_cached(msg_context, job_id, parts=None, timer=None, **kwargs):
+    """
+    Downloads the media of a message into the job's workspace, reusing the cached copy if the
+    same Telegram file was seen before. The returned path is tracked by the job.
+    Files above `download_parallel_min_mb` are fetched as `parts` concurrent ranges
+    (default `download_parallel_parts`); `parts=1` forces a sequential download.
+    `timer` is the job's StageTimer, if it has one.
+    """
+    unique_id = get_file_unique_id(msg_context)
+    key = MediaCache.make_key(unique_id) if unique_id else None
+    async with filling_media_cache(key) as cached_path:
+        if cached_path:
+            logger.info(f"Media cache hit for '{key}', skipping download.")
+            workspace.track(job_id, cached_path)
+            return cached_path
+
+        media = msg_context.video or msg_context.photo or msg_context.document
+        await workspace.reserve(job_id, getattr(media, "file_size", 0) or 0)
+        if timer is not None:
+            timer.bytes["downloaded"] += getattr(media, "file_size", 0) or 0
+        with timed_stage(timer, "download"):
+            job_dir = workspace.job_dir(job_id)
+            file_size = getattr(media, "file_size", 0) or 0
+            if parts is None:
+                parts = global_settings.get("download_parallel_parts", 4)
+            if job_dir and parts > 1 and file_size >= global_settings.get("download_parallel_min_mb", 20) * 1024 * 1024:
+                try:
+                    path = await download_parallel(
+                        app, msg_context, job_dir, parts=parts,
+                        progress=kwargs.get("progress"), progress_args=kwargs.get("progress_args", ())
+                    )
+                except Exception as e:
+                    logger.warning(f"Parallel download failed ({e}), falling back to a sequential download.")
+                    path = None
+                if path:
+                    return await _store_downloaded_media(path, key, job_id)
+            if job_dir:
+                kwargs.setdefault("file_name", os.path.join(job_dir, ""))
+            # A MediaRef is passed as the media object itself: pyrogram reads its file_id, and
+            # file_size/mime_type/file_name for the progress total and the file name.
+            path = await app.download_media(msg_context, **kwargs)
+            if not path:
+                return path
+            return await _store_downloaded_media(path, key, job_id)
+
+async def _store_downloaded_media(path, key, job_id):
+    if media_cache is not None and key:
+        path = await asyncio.to_thread(media_cache.store, key, path)
+    workspace.track(job_id, path)
+    return path
+
+async def describe_media(path, msg_context):
+    """
+    Builds the MediaInfo for a freshly downloaded file. Telegram's metadata decides whether it
+    is a video; videos are then probed once. If the probe fails the info is left incomplete,
+    which makes later stages fall back to a full conversion and instagrapi's own analysis.
+    """
+    media = msg_context.video or msg_context.document if msg_context else None
+    if media is None or not (msg_context.video or 'video' in (getattr(media, "mime_type", None) or "")):
+        photo = msg_context.photo if msg_context else None
+        return MediaInfo("photo", width=getattr(photo, "width", 0), height=getattr(photo, "height", 0), size=os.path.getsize(path))
+    try:
+        return await asyncio.to_thread(probe_video, path)
+    except FileNotFoundError:
+        logger.error("ffprobe/ffmpeg is not installed. Cannot check video format. Assuming conversion is needed as a fallback.")
+    except ValueError as e:
+        logger.error(f"{e}. It might be corrupted or not a valid video. Assuming conversion is needed.")
+    return MediaInfo("video", audio_codec=None, size=os.path.getsize(path))
+
+async def ensure_media_info(file_info):
+    """Describes every downloaded file of a job that has no MediaInfo yet. Returns the path -> MediaInfo map."""
+    media_info = file_info.setdefault("media_info", {})
+    if file_info.get("upload_type") == "album":
+        pairs = zip(file_info.get("media_paths") or [], file_info.get("original_msgs") or [])
+    else:
+        pairs = [(file_info.get("downloaded_path"), file_info.get("original_media_msg"))]
+    for path, msg_context in pairs:
+        if path and path not in media_info:
+            with timed_stage(file_info.get("timer"), "probe"):
+                media_info[path] = await describe_media(path, msg_context)
+            logger.info(f"Media info for '{path}': {media_info[path]!r}")
+    return media_info
+
+async def convert_for_instagram_cached(path, info, msg_context, job_id, on_convert=None, aspect_ratio="original", timer=None):
+    """
+    Returns an Instagram-compatible version of `path` (which may be `path` itself) together with
+    its MediaInfo, reusing a cached conversion of the same Telegram file when one exists.
+    `aspect_ratio` is the user's `aspect_ratio_instagram` setting.
+    `on_convert` is awaited right before an actual ffmpeg conversion starts.
+    """
+    plan = plan_instagram_video(info, aspect_ratio)
+    video_action_counts[plan["action"]] += 1
+    if timer is not None:
+        timer.video_actions.append(plan["action"])
+    if plan["action"] == "noop":
+        logger.info(f"'{path}' is already compatible. No conversion needed.")
+        return path, info
+    # Keyed by content, so the same video sent again as a new Telegram file, or by another
+    # user, still reuses the conversion.
+    key = await content_cache_key(path, instagram_video_profile(aspect_ratio))
+    async with filling_media_cache(key) as cached_path:
+        if cached_path:
+            logger.info(f"Media cache hit for '{key}', skipping conversion.")
+            workspace.track(job_id, cached_path)
+            return cached_path, planned_output_info(info, plan, cached_path)
+
+        if on_convert:
+            await on_convert()
+        await workspace.reserve(job_id, os.path.getsize(path))
+        # Always a new file in the job dir: `path` may be a media cache entry other jobs are reading.
+        output_dir = workspace.job_dir(job_id) or os.path.dirname(path)
+        fixed_path = os.path.join(output_dir, os.path.basename(path).rsplit(".", 1)[0] + "_fixed.mp4")
+        if plan["action"] == "faststart":
+            # Only the atom order is off; a failed remux is not worth failing the upload for.
+            try:
+                converted_path = await asyncio.to_thread(transform_for_instagram, path, fixed_path, plan)
+            except (FileNotFoundError, ValueError) as e:
+                logger.warning(f"Faststart remux failed for '{path}', uploading it as is: {e}")
+                cleanup_temp_files([fixed_path])
+                return path, info
+        else:
+            converted_path = await asyncio.to_thread(transform_for_instagram, path, fixed_path, plan)
+        converted_info = planned_output_info(info, plan, converted_path)
+        if media_cache is not None and key:
+            converted_path = await asyncio.to_thread(media_cache.store, key, converted_path)
+        workspace.track(job_id, converted_path)
+        return converted_path, converted_info
+
+async def normalize_photo_cached(path, msg_context, job_id, profile="feed"):
+    """
+    Returns an Instagram-ready JPEG for the photo at `path` (which may be `path` itself).
+    The re-encode runs in the media process pool and is cached per Telegram file and profile.
+    """
+    unique_id = get_file_unique_id(msg_context)
+    key = MediaCache.make_key(unique_id, f"photo-{profile}-{media_pool.PHOTO_PROFILE_VERSION}") if unique_id else None
+    async with filling_media_cache(key) as cached_path:
+        if cached_path:
+            logger.info(f"Media cache hit for '{key}', skipping photo normalization.")
+            workspace.track(job_id, cached_path)
+            return cached_path
+
+        await workspace.reserve(job_id, os.path.getsize(path))
+        output_dir = workspace.job_dir(job_id) or os.path.dirname(path)
+        output_path = os.path.join(output_dir, os.path.basename(path).rsplit(".", 1)[0] + f"_{profile}.jpg")
+        try:
+            loop = asyncio.get_running_loop()
+            normalized_path = await loop.run_in_executor(media_executor, media_pool.normalize_photo, path, output_path, profile)
+        except Exception as e:
+            logger.warning(f"Photo normalization failed for '{path}', uploading the original: {e}")
+            return path
+        if not normalized_path:
+            return path
+        logger.info(f"Normalized photo '{path}' ({os.path.getsize(path)} B) -> '{normalized_path}' ({os.path.getsize(normalized_path)} B).")
+        if media_cache is not None and key:
+            normalized_path = await asyncio.to_thread(media_cache.store, key, normalized_path)
+        workspace.track(job_id, normalized_path)
+        return normalized_path
+
+COMPRESSION_AUDIO_KBPS = 128
+COMPRESSION_MIN_VIDEO_KBPS = 400
+
+def compression_target_bytes(is_premium):
+    """Target upload size for the user's tier, or None when compression is off for it."""
+    if global_settings.get("no_compression_admin", True):
+        return None
+    tier = global_settings.get("compression_tiers", {}).get("premium" if is_premium else "free", {})
+    if not tier.get("enabled"):
+        return None
+    return int(tier.get("target_mb", 0) * 1024 * 1024) or None
+
+def plan_target_bitrate(info, target_bytes):
+    """Video kb/s that brings `info` under `target_bytes`, or None if it already fits."""
+    if not info.duration or info.size <= target_bytes:
+        return None
+    # Leave ~5% for container overhead and rate-control overshoot.
+    total_kbps = target_bytes * 8 * 0.95 / info.duration / 1000
+    return max(int(total_kbps - COMPRESSION_AUDIO_KBPS), COMPRESSION_MIN_VIDEO_KBPS)
+
+async def compress_for_target_cached(path, info, job_id, target_bytes, on_compress=None):
+    """
+    Re-encodes a video that is larger than `target_bytes` so it lands near that size, running the
+    encode in the media process pool. Returns (path, MediaInfo, stats); stats is None when the
+    file was left alone, otherwise it holds the sizes and the encode time.
+    """
+    video_kbps = plan_target_bitrate(info, target_bytes)
+    if video_kbps is None:
+        return path, info, None
+
+    key = await content_cache_key(path, f"compressed-{video_kbps}k-v1")
+    encode_seconds = 0.0
+    async with filling_media_cache(key) as compressed_path:
+        if compressed_path:
+            logger.info(f"Media cache hit for '{key}', skipping compression.")
+            workspace.track(job_id, compressed_path)
+        else:
+            if on_compress:
+                await on_compress()
+            await workspace.reserve(job_id, target_bytes)
+            output_dir = workspace.job_dir(job_id) or os.path.dirname(path)
+            output_path = os.path.join(output_dir, os.path.basename(path).rsplit(".", 1)[0] + "_small.mp4")
+            try:
+                loop = asyncio.get_running_loop()
+                encode_seconds = await loop.run_in_executor(media_executor, media_pool.compress_video, path, output_path, video_kbps, COMPRESSION_AUDIO_KBPS)
+            except Exception as e:
+                logger.warning(f"Compression failed for '{path}', uploading it uncompressed: {e}")
+                return path, info, None
+            if os.path.getsize(output_path) >= info.size:
+                logger.info(f"Compressing '{path}' did not make it smaller, uploading the original.")
+                os.remove(output_path)
+                return path, info, None
+            compressed_path = output_path
+            if media_cache is not None and key:
+                compressed_path = await asyncio.to_thread(media_cache.store, key, compressed_path)
+            workspace.track(job_id, compressed_path)
+
+    compressed_size = os.path.getsize(compressed_path)
+    compressed_info = info.derive(
+        container="mov,mp4,m4a,3gp,3g2,mj2", video_codec="h264", audio_codec="aac", rotation=0, faststart=True,
+        size=compressed_size, bitrate=int(compressed_size * 8 / info.duration)
+    )
+    stats = {"original_bytes": info.size, "compressed_bytes": compressed_size, "encode_seconds": round(encode_seconds, 2)}
+    logger.info(f"Compressed '{path}' {info.size} B -> {compressed_size} B at {video_kbps} kb/s in {encode_seconds:.1f}s.")
+    return compressed_path, compressed_info, stats
+
+def summarize_compression(stats_list, upload_seconds):
+    """
+    Folds per-file compression stats into the record stored on the upload. Time saved is the
+    upload time the removed bytes would have taken at the measured throughput, minus encoding.
+    """
+    original = sum(s["original_bytes"] for s in stats_list)
+    compressed = sum(s["compressed_bytes"] for s in stats_list)
+    encode_seconds = sum(s["encode_seconds"] for s in stats_list)
+    summary = {
+        "original_bytes": original, "compressed_bytes": compressed,
+        "ratio": round(original / compressed, 2) if compressed else None,
+        "encode_seconds": round(encode_seconds, 2), "upload_seconds": round(upload_seconds, 2),
+    }
+    if compressed and upload_seconds > 0:
+        bytes_per_second = compressed / upload_seconds
+        summary["time_saved_seconds"] = round((original - compressed) / bytes_per_second - encode_seconds, 1)
+    return summary
+
+async def split_story_video(path, info, job_id, on_split=None):
+    """
+    Cuts a video longer than `story_segment_seconds` into keyframe-aligned segments that are
+    written in parallel on the media process pool. Returns an ordered list of (path, MediaInfo);
+    a video that already fits comes back as the only item.
+    """
+    max_seconds = global_settings.get("story_segment_seconds", 60)
+    if not info.duration or info.duration <= max_seconds + 0.5:
+        return [(path, info)]
+
+    if on_split:
+        await on_split()
+    loop = asyncio.get_running_loop()
+    try:
+        keyframes = await loop.run_in_executor(media_executor, media_pool.keyframe_times, path)
+    except (FileNotFoundError, ValueError) as e:
+        logger.warning(f"Could not read keyframes of '{path}', cutting at fixed offsets: {e}")
+        keyframes = []
+    segments = media_pool.plan_segments(keyframes, info.duration, max_seconds)
+    await workspace.reserve(job_id, info.size)
+
+    output_dir = workspace.job_dir(job_id) or os.path.dirname(path)
+    base_name = os.path.basename(path).rsplit(".", 1)[0]
+    outputs = [os.path.join(output_dir, f"{base_name}_part{n:02d}.mp4") for n in range(1, len(segments) + 1)]
+    for output in outputs:
+        workspace.track(job_id, output)
+    await asyncio.gather(*(
+        loop.run_in_executor(media_executor, media_pool.cut_segment, path, output, start, length, stream_copy)
+        for output, (start, length, stream_copy) in zip(outputs, segments)
+    ))
+    logger.info(f"Split '{path}' ({info.duration:.1f}s) into {len(segments)} story segments "
+                f"({sum(1 for *_, copy in segments if not copy)} re-encoded).")
+    return [
+        (output, info.derive(duration=length, size=os.path.getsize(output), faststart=True))
+        for output, (start, length, _) in zip(outputs, segments)
+    ]
+
+async def prepare_video_upload(path, info, job_id, vertical_cover=False):
+    """
+    Extracts the thumbnail of the final upload file with ffmpeg and registers it together with
+    the known size and duration so instagrapi skips moviepy for this path. Returns the thumbnail
+    path, or None if the MediaInfo is incomplete and instagrapi should analyze the file itself.
+    Call `forget_video_hint(path)` once the upload is done.
+    """
+    if not (info.width and info.height and info.duration):
+        return None
+    output_dir = workspace.job_dir(job_id) or os.path.dirname(path)
+    thumbnail = os.path.join(output_dir, os.path.basename(path).rsplit(".", 1)[0] + "_thumb.jpg")
+    try:
+        await asyncio.to_thread(extract_thumbnail, path, thumbnail, info.duration / 2, vertical_cover)
+    except (FileNotFoundError, ValueError) as e:
+        logger.warning(f"Could not prepare '{path}' for upload, instagrapi will analyze it instead: {e}")
+        return None
+    workspace.track(job_id, thumbnail)
+    register_video_hint(path, info.width, info.height, info.duration, thumbnail)
+    return thumbnail
+
+def get_state_job_id(state_data):
+    """Returns the workspace job referenced by a user state, if any."""
+    if not isinstance(state_data, dict):
+        return None
+    return state_data.get("job_id") or (state_data.get("file_info") or {}).get("job_id")
+
+def discard_upload_state(user_id):
+    """Drops the user's flow state and releases the workspace job it was holding, unless an upload is using it."""
+    state_data = user_states.pop(user_id, None)
+    job_id = get_state_job_id(state_data)
+    if not workspace.is_busy(job_id):
+        workspace.release(job_id)
+
+async def workspace_sweeper_task():
+    while True:
+        await asyncio.sleep(300)
+        expire_upload_retries()
+        live_job_ids = {get_state_job_id(state) for state in user_states.values()}
+        live_job_ids.update(entry["stage"]["job_id"] for entry in upload_retries.values())
+        swept, orphan_dirs = workspace.sweep(live_job_ids)
+        for orphan_dir in orphan_dirs:
+            await asyncio.to_thread(shutil.rmtree, orphan_dir, True)
+        if swept or orphan_dirs:
+            logger.info(f"Workspace sweeper released {swept} orphaned jobs and removed {len(orphan_dirs)} stray directories.")
+        if media_cache is not None:
+            await asyncio.to_thread(media_cache.expire)
+        dropped = sum(registry.sweep() for registry in (state_backend.states, state_backend.locks, _progress_updates))
+        if dropped:
+            logger.info(f"State sweeper dropped {dropped} idle registry entries.")
+
 def with_user_lock(func):
     @wraps(func)
     async def wrapper(client, message, *args, **kwargs):
         user_id = message.from_user.id
-        if user_id not in user_upload_locks:
-            user_upload_locks[user_id] = asyncio.Lock()
-
-        if user_upload_locks[user_id].locked():
+        if not await state_backend.try_lock(user_id):
             return await message.reply("⚠️ " + to_bold_sans("Another Operation Is Already In Progress. Please Wait Until It's Finished Or Use The ❌ Cancel Button."))
         
-        async with user_upload_locks[user_id]:
+        try:
             return await func(client, message, *args, **kwargs)
+        finally:
+            await state_backend.unlock(user_id)
     return wrapper
 
 # ===================================================================
@@ -911,7 +2197,7 @@ async def handle_done_command(_, msg):
         return await msg.reply("❌ " + to_bold_sans("There Is No Active Multi-media Upload Process. Please Use The Appropriate Button To Start."))
 
     media_paths = state_data.get('media_paths', [])
-    if not media_paths:
+    if not state_data.get('media_msgs'):
         return await msg.reply("❌ " + to_bold_sans("You Must Send At Least One Media File."))
 
     # Transition to caption state for the album
@@ -920,7 +2206,8 @@ async def handle_done_command(_, msg):
         "upload_type": "album",
         "media_paths": media_paths,
         "original_msgs": state_data.get('media_msgs', []),
-        "original_msg": msg
+        "job_id": state_data.get('job_id'),
+        "timer": state_data.get('timer') or StageTimer()
     }
     user_states[user_id] = {"action": "waiting_for_caption", "file_info": file_info}
     await msg.reply(
@@ -1047,11 +2334,13 @@ async def initiate_instagram_upload(_, msg):
         "⚡ ɪɴꜱᴛᴀ ꜱᴛᴏʀy": "story"
     }
     upload_type = upload_type_map[msg.text]
+    discard_upload_state(user_id)
 
     if upload_type == "album":
         user_states[user_id] = {
             "action": "waiting_for_album_media", "platform": "instagram",
-            "upload_type": "album", "media_paths": [], "media_msgs": []
+            "upload_type": "album", "media_paths": [], "media_msgs": [],
+            "job_id": workspace.create_job(user_id)
         }
         await msg.reply(
             "🗂️ " + to_bold_sans("Album Mode") + "\n\n"
@@ -1202,7 +2491,9 @@ async def handle_text_input(_, msg):
                 if not user_upload_client:
                     raise LoginRequired("Could not validate session for location search.")
 
-                locations = await asyncio.to_thread(user_upload_client.location_search, location_search_term)
+                # The pooled client isn't thread-safe; an upload on this account may be using it.
+                async with insta_clients.lock(user_id, active_username):
+                    locations = await asyncio.to_thread(user_upload_client.location_search, location_search_term)
                 if not locations:
                     await safe_edit_message(msg.reply_to_message, f"📍 " + to_bold_sans(f"No Locations Found For `{location_search_term}`. Try Again Or Cancel."), reply_markup=get_upload_options_markup())
                     user_states[user_id]["action"] = "waiting_for_location_search_insta"
@@ -1213,7 +2504,7 @@ async def handle_text_input(_, msg):
                 
                 await safe_edit_message(msg.reply_to_message, "📍 " + to_bold_sans("Select A Location:"), reply_markup=InlineKeyboardMarkup(location_buttons))
                 user_states[user_id]['action'] = "selecting_location_insta"
-                user_states[user_id]['location_choices'] = {loc.pk: loc for loc in locations}
+                user_states[user_id]['location_choices'] = {loc.pk: LocationRef.from_location(loc) for loc in locations}
             except Exception as e:
                 await safe_edit_message(msg.reply_to_message, f"❌ " + to_bold_sans(f"Error Searching For Locations: {e}"))
                 user_states[user_id]['action'] = "waiting_for_upload_options"
@@ -1406,17 +2697,10 @@ async def cancel_upload_cb(_, query):
     await query.answer("Upload cancelled.", show_alert=True)
     await safe_edit_message(query.message, "❌ **" + to_bold_sans("Upload Cancelled") + "**\n\n" + to_bold_sans("Your Operation Has Been Successfully Cancelled."))
 
-    state_data = user_states.get(user_id, {})
-    files_to_clean = []
-    file_info = state_data.get("file_info", {})
-    if "media_paths" in file_info:
-        files_to_clean.extend(file_info["media_paths"])
-    if "downloaded_path" in file_info:
-        files_to_clean.append(file_info.get("downloaded_path"))
-    
-    cleanup_temp_files(files_to_clean)
-    if user_id in user_states: del user_states[user_id]
+    job_id = get_state_job_id(user_states.get(user_id))
     await task_tracker.cancel_all_user_tasks(user_id)
+    if user_id in user_states: del user_states[user_id]
+    workspace.release(job_id)
     logger.info(f"User {user_id} cancelled their upload.")
 
 @app.on_callback_query(filters.regex("^upload_now$"))
@@ -1430,6 +2714,22 @@ async def upload_now_cb(_, query):
     await safe_edit_message(query.message, "🚀 " + to_bold_sans("Starting Upload Now..."))
     await start_upload_task(query.message, file_info, user_id=query.from_user.id)
 
+@app.on_callback_query(filters.regex("^retry_upload_"))
+async def retry_upload_cb(_, query):
+    user_id = query.from_user.id
+    retry_id = query.data.split("retry_upload_", 1)[1]
+    entry = upload_retries.get(retry_id)
+    if entry is None or entry["stage"]["user_id"] != user_id:
+        return await query.answer("❌ This upload can no longer be retried. Please send the media again.", show_alert=True)
+
+    del upload_retries[retry_id]
+    await query.answer("Retrying upload...")
+    task_tracker.create_task(
+        safe_task_wrapper(retry_instagram_upload(entry["stage"], query.message)),
+        user_id=user_id,
+        task_name="upload"
+    )
+
 @app.on_callback_query(filters.regex("^tag_users_insta$"))
 async def tag_users_cb(_, query):
     user_id = query.from_user.id
@@ -1505,6 +2805,70 @@ async def cancel_location_cb(_, query):
     state_data['action'] = 'waiting_for_upload_options'
     user_states[user_id] = state_data
 
+def get_multi_account_markup(accounts, selected):
+    buttons = [
+        [InlineKeyboardButton(f"{'✅' if username in selected else '⬜'} @{username}", callback_data=f"multi_acc_toggle_{username}")]
+        for username in accounts
+    ]
+    buttons.append([InlineKeyboardButton("✔️ ᴅᴏɴᴇ", callback_data="multi_acc_done")])
+    return InlineKeyboardMarkup(buttons)
+
+async def show_multi_account_picker(query, state_data):
+    user_id = query.from_user.id
+    sessions = await load_platform_sessions(user_id, "instagram")
+    accounts = [s['username'] for s in sessions]
+    file_info = state_data["file_info"]
+    if not file_info.get("target_accounts"):
+        active_username = (await get_user_settings(user_id)).get("active_ig_username")
+        file_info["target_accounts"] = [active_username] if active_username in accounts else accounts[:1]
+    await safe_edit_message(
+        query.message,
+        "🔀 " + to_bold_sans("Select The Accounts To Post To") + "\n\n" + to_bold_sans("The Media Is Processed Once And Uploaded To Each Account."),
+        reply_markup=get_multi_account_markup(accounts, file_info["target_accounts"])
+    )
+
+@app.on_callback_query(filters.regex("^multi_account_insta$"))
+async def multi_account_cb(_, query):
+    user_id = query.from_user.id
+    if not await is_premium_for_platform(user_id, "instagram"):
+        return await query.answer("❌ This is a premium feature.", show_alert=True)
+
+    state_data = user_states.get(user_id)
+    if not state_data or 'file_info' not in state_data:
+        return await query.answer("❌ Error: State lost, please start over.", show_alert=True)
+
+    sessions = await load_platform_sessions(user_id, "instagram")
+    if len(sessions) < 2:
+        return await query.answer("You need at least two logged-in Instagram accounts for this.", show_alert=True)
+    await show_multi_account_picker(query, state_data)
+
+@app.on_callback_query(filters.regex("^multi_acc_"))
+async def multi_acc_toggle_cb(_, query):
+    user_id = query.from_user.id
+    state_data = user_states.get(user_id)
+    if not state_data or 'file_info' not in state_data:
+        return await query.answer("❌ Error: State lost, please start over.", show_alert=True)
+
+    file_info = state_data["file_info"]
+    if query.data == "multi_acc_done":
+        count = len(file_info.get("target_accounts") or [])
+        return await safe_edit_message(
+            query.message,
+            "🔀 " + to_bold_sans(f"Posting To {count} Account(s). Continue With Other Options Or Upload Now."),
+            reply_markup=get_upload_options_markup(is_album=file_info.get('upload_type') == 'album')
+        )
+
+    choice = query.data.split("multi_acc_toggle_", 1)[1]
+    selected = file_info.get("target_accounts") or []
+    if choice in selected:
+        if len(selected) == 1:
+            return await query.answer("At least one account must stay selected.", show_alert=True)
+        selected.remove(choice)
+    else:
+        selected.append(choice)
+    file_info["target_accounts"] = selected
+    await show_multi_account_picker(query, state_data)
+
 # --- Premium & Payment Callbacks ---
 @app.on_callback_query(filters.regex("^buypypremium$"))
 async def buypypremium_cb(_, query):
@@ -1618,8 +2982,13 @@ async def global_settings_panel_cb(_, query):
         "⚙️ **" + to_bold_sans("Global Bot Settings") + "**\n\n"
         f"**📢 Special Event:** `{global_settings.get('special_event_toggle', False)}`\n"
         f"**Max concurrent uploads:** `{global_settings.get('max_concurrent_uploads')}`\n"
+        f"**Parallel downloads:** `{global_settings.get('download_parallel_parts', 4)}` parts per file, `{global_settings.get('max_concurrent_transmissions', 8)}` transfers total\n"
         f"**Global Proxy:** `{global_settings.get('proxy_url') or 'None'}`\n"
-        f"**Global Compression:** `{'Disabled' if global_settings.get('no_compression_admin') else 'Enabled'}`"
+        f"**Global Compression:** `{'Disabled' if global_settings.get('no_compression_admin') else 'Enabled'}`\n"
+        + "".join(
+            f"  • {tier.capitalize()}: `{'ON' if cfg.get('enabled') else 'OFF'}`, target `{cfg.get('target_mb')} MB`\n"
+            for tier, cfg in global_settings.get("compression_tiers", {}).items()
+        )
     )
     await safe_edit_message(query.message, settings_text, reply_markup=get_admin_global_settings_markup(), parse_mode=enums.ParseMode.MARKDOWN)
 
@@ -1642,7 +3011,7 @@ async def back_to_cb(_, query):
     await _save_user_data(user_id, {"last_active": datetime.utcnow()})
     
     await task_tracker.cancel_all_user_tasks(user_id)
-    if user_id in user_states: del user_states[user_id]
+    discard_upload_state(user_id)
         
     if data == "back_to_main_menu":
         try:
@@ -1726,6 +3095,19 @@ async def toggle_compression_admin_cb(_, query):
     await query.answer(f"Global compression toggled to: {'DISABLED' if new_status else 'ENABLED'}.", show_alert=True)
     await global_settings_panel_cb(app, query)
 
+@app.on_callback_query(filters.regex("^toggle_compression_tier_(free|premium)$"))
+async def toggle_compression_tier_cb(_, query):
+    if not is_admin(query.from_user.id): return await query.answer("❌ Admin access required", show_alert=True)
+
+    tier = query.data.rsplit("_", 1)[1]
+    # global_settings may share its nested dicts with DEFAULT_GLOBAL_SETTINGS; never edit those in place.
+    tiers = copy.deepcopy(global_settings.get("compression_tiers", {}))
+    tiers.setdefault(tier, {"enabled": False, "target_mb": DEFAULT_GLOBAL_SETTINGS["compression_tiers"][tier]["target_mb"]})
+    tiers[tier]["enabled"] = not tiers[tier].get("enabled", False)
+    await _update_global_setting("compression_tiers", tiers)
+    await query.answer(f"{tier.capitalize()} tier compression {'ENABLED' if tiers[tier]['enabled'] else 'DISABLED'}.", show_alert=True)
+    await global_settings_panel_cb(app, query)
+
 @app.on_callback_query(filters.regex("^set_max_uploads$"))
 @with_user_lock
 async def set_max_uploads_cb(_, query):
@@ -1776,18 +3158,37 @@ async def confirm_reset_stats_cb(_, query):
 async def show_system_stats_cb(_, query):
     if not is_admin(query.from_user.id): return await query.answer("❌ Admin access required", show_alert=True)
     try:
-        cpu_usage = psutil.cpu_percent(interval=1)
+        # cpu_percent(interval=1) sleeps for the whole interval; keep it off the event loop.
+        cpu_usage = await asyncio.to_thread(psutil.cpu_percent, interval=1)
         ram = psutil.virtual_memory()
         disk = psutil.disk_usage('/')
         system_stats_text = (
             f"💻 **{to_bold_sans('System Stats')}**\n\n"
             f"**CPU:** `{cpu_usage}%`\n"
             f"**RAM:** `{ram.percent}%` (Used: `{ram.used / (1024**3):.2f}` GB / Total: `{ram.total / (1024**3):.2f}` GB)\n"
-            f"**Disk:** `{disk.percent}%` (Used: `{disk.used / (1024**3):.2f}` GB / Total: `{disk.total / (1024**3):.2f}` GB)\n\n"
+            f"**Disk:** `{disk.percent}%` (Used: `{disk.used / (1024**3):.2f}` GB / Total: `{disk.total / (1024**3):.2f}` GB)\n"
         )
+        if media_cache is not None:
+            cache_stats = media_cache.stats()
+            system_stats_text += (
+                f"**Media Cache:** `{cache_stats['bytes'] / (1024**2):.1f}` MB / `{cache_stats['max_bytes'] / (1024**2):.0f}` MB "
+                f"(`{cache_stats['entries']}` files, `{cache_stats['in_use']}` in use, hits/misses: `{cache_stats['hits']}/{cache_stats['misses']}`)\n"
+            )
+        if sum(video_action_counts.values()):
+            system_stats_text += "**Video Paths:** " + ", ".join(
+                f"{action} `{count}`" for action, count in video_action_counts.items()
+            ) + "\n"
+        if workspace is not None:
+            ws_stats = workspace.stats()
+            ws_disk = await asyncio.to_thread(workspace.disk_usage_bytes)
+            system_stats_text += (
+                f"**Temp Storage:** `{ws_disk / (1024**2):.1f}` MB on disk, `{ws_stats['reserved'] / (1024**2):.1f}` MB reserved "
+                f"of `{ws_stats['quota'] / (1024**2):.0f}` MB quota (`{ws_stats['jobs']}` active jobs)\n"
+            )
+        system_stats_text += "\n"
         gpu_info = "No GPU found or GPUtil is not installed."
         try:
-            gpus = GPUtil.getGPUs()
+            gpus = await asyncio.to_thread(GPUtil.getGPUs)  # Spawns nvidia-smi
             if gpus:
                 gpu_info = "**GPU Info:**\n"
                 for i, gpu in enumerate(gpus):
@@ -1849,10 +3250,9 @@ async def users_list_cb(_, query):
         )
     if len(user_list_text) > 4096:
         await safe_edit_message(query.message, to_bold_sans("User List Is Too Long, Sending As A File..."))
-        with open("users.txt", "w", encoding="utf-8") as f:
-            f.write(user_list_text.replace("`", ""))
-        await app.send_document(query.message.chat.id, "users.txt", caption="👥 " + to_bold_sans("All Users List"))
-        os.remove("users.txt")
+        users_file = io.BytesIO(user_list_text.replace("`", "").encode("utf-8"))
+        users_file.name = "users.txt"
+        await app.send_document(query.message.chat.id, users_file, caption="👥 " + to_bold_sans("All Users List"))
         await safe_edit_message(query.message, "🛠 " + to_bold_sans("Admin Panel"), reply_markup=admin_markup)
     else:
         await safe_edit_message(query.message, user_list_text, reply_markup=admin_markup, parse_mode=enums.ParseMode.MARKDOWN)
@@ -2088,6 +3488,164 @@ async def admin_stats_panel_cb(_, query):
     if not is_admin(query.from_user.id): return await query.answer("❌ Admin access required", show_alert=True)
     await safe_edit_message(query.message, to_bold_sans("Please Use The /stats Command To View Detailed Statistics."), reply_markup=admin_markup)
 
+# --- Stage Timings (admin) ---
+STAGE_TIMING_WINDOWS = {24: "24h", 168: "7d", 720: "30d"}
+STAGE_TIMING_SAMPLE_LIMIT = 5000
+STAGE_ORDER = ("download", "probe", "auth", "convert", "compress", "photo", "split", "thumbnail", "upload")
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an already sorted list."""
+    index = max(0, min(len(sorted_values) - 1, math.ceil(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def summarize_stage_timings(docs):
+    """Groups the stored timings by upload type and stage: {(type, stage): sorted seconds}."""
+    samples = {}
+    for doc in docs:
+        timings = doc.get("timings") or {}
+        for stage, seconds in (timings.get("stages") or {}).items():
+            samples.setdefault((doc.get("upload_type", "?"), stage), []).append(seconds)
+        if timings.get("total_seconds") is not None:
+            samples.setdefault((doc.get("upload_type", "?"), "total"), []).append(timings["total_seconds"])
+    return {key: sorted(values) for key, values in samples.items()}
+
+def get_stage_timings_markup(current_hours):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(("• " if hours == current_hours else "") + label, callback_data=f"stage_timings_{hours}")
+         for hours, label in STAGE_TIMING_WINDOWS.items()],
+        [InlineKeyboardButton("🔙 ʙᴀᴄᴋ ᴛᴏ ᴀᴅᴍɪɴ", callback_data="admin_panel")]
+    ])
+
+@app.on_callback_query(filters.regex(r"^stage_timings_(\d+)$"))
+async def stage_timings_cb(_, query):
+    if not is_admin(query.from_user.id): return await query.answer("❌ Admin access required", show_alert=True)
+    if db is None: return await query.answer("⚠️ Database is unavailable.", show_alert=True)
+    hours = int(query.data.split("stage_timings_")[-1])
+    since = datetime.utcnow() - timedelta(hours=hours)
+    docs = await asyncio.to_thread(
+        lambda: list(db.uploads.find(
+            {"timestamp": {"$gte": since}, "timings": {"$type": "object"}},
+            {"upload_type": 1, "timings.stages": 1, "timings.total_seconds": 1}
+        ).sort("timestamp", -1).limit(STAGE_TIMING_SAMPLE_LIMIT))
+    )
+    samples = summarize_stage_timings(docs)
+
+    text = "⏱️ " + to_bold_sans(f"Stage Timings, Last {STAGE_TIMING_WINDOWS.get(hours, f'{hours}h')}") + f"\n_{len(docs)} uploads, seconds p50 / p95 / p99_\n"
+    if not samples:
+        text += "\n" + to_bold_sans("No Timed Uploads In This Window.")
+    for upload_type in sorted({upload_type for upload_type, _ in samples}):
+        text += f"\n**{upload_type.capitalize()}**\n"
+        stages = [s for s in STAGE_ORDER if (upload_type, s) in samples]
+        stages += sorted(s for t, s in samples if t == upload_type and s not in STAGE_ORDER and s != "total") + ["total"]
+        for stage in stages:
+            values = samples.get((upload_type, stage))
+            if values:
+                text += f"`{stage:<9}` {percentile(values, 50):.1f} / {percentile(values, 95):.1f} / {percentile(values, 99):.1f} (n={len(values)})\n"
+    await safe_edit_message(query.message, text, reply_markup=get_stage_timings_markup(hours), parse_mode=enums.ParseMode.MARKDOWN)
+
+@app.on_callback_query(filters.regex("^loop_lag_report$"))
+async def loop_lag_report_cb(_, query):
+    if not is_admin(query.from_user.id): return await query.answer("❌ Admin access required", show_alert=True)
+    samples = sorted(loop_lag_samples)
+    text = "🐢 " + to_bold_sans("Event Loop Lag") + f"\n_last {len(samples)} heartbeats, seconds_\n\n"
+    if samples:
+        text += f"p50 `{percentile(samples, 50):.3f}` | p95 `{percentile(samples, 95):.3f}` | p99 `{percentile(samples, 99):.3f}` | max `{samples[-1]:.3f}`\n"
+    if blocking_detector is None:
+        text += "\n" + to_bold_sans("Blocking-call Capture Is Off.") + f" Start the bot with `LOOP_DEBUG=1` to record the stacks of callbacks that block for more than {LOOP_BLOCK_THRESHOLD_SECONDS}s."
+    else:
+        offenders = blocking_detector.top()
+        text += "\n**" + to_bold_sans("Top Offenders") + f"** (>{blocking_detector.threshold}s)\n"
+        if not offenders:
+            text += to_bold_sans("None Captured Yet.")
+        for key, entry in offenders:
+            text += f"\n`{key}`\n{entry['count']}x, ~{entry['blocked']:.1f}s blocked\n"
+    await safe_edit_message(
+        query.message, text[:4096],
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔄 ʀᴇꜰʀᴇꜱʜ", callback_data="loop_lag_report")],
+            [InlineKeyboardButton("🔙 ʙᴀᴄᴋ ᴛᴏ ᴀᴅᴍɪɴ", callback_data="admin_panel")]
+        ]),
+        parse_mode=enums.ParseMode.MARKDOWN
+    )
+
+# === Profiler ===
+PROFILE_MODES = {"cpu": "ᴄᴩᴜ (ᴄᴩʀᴏꜰɪʟᴇ)", "sample": "ꜱᴛᴀᴄᴋ ꜱᴀᴍᴩʟᴇꜱ", "memory": "ᴍᴇᴍᴏʀy ᴅɪꜰꜰ"}
+PROFILE_MAX_SECONDS = 300
+profile_running = False
+
+def get_profile_markup():
+    rows = [
+        [InlineKeyboardButton(f"{label} {seconds}ꜱ", callback_data=f"profile_{mode}_{seconds}") for seconds in (10, 30, 60)]
+        for mode, label in PROFILE_MODES.items()
+    ]
+    rows.append([InlineKeyboardButton("🔙 ʙᴀᴄᴋ ᴛᴏ ᴀᴅᴍɪɴ", callback_data="admin_panel")])
+    return InlineKeyboardMarkup(rows)
+
+async def run_profile_capture(chat_id, mode, seconds, status_msg):
+    """
+    Runs one capture and sends the report as a document. Only one capture runs at a time:
+    callers set `profile_running` before their first await, and it is cleared here.
+    """
+    global profile_running
+    try:
+        report = await profiling.CAPTURES[mode](seconds)
+    except Exception as e:
+        logger.error(f"Profile capture '{mode}' failed: {e}", exc_info=True)
+        return await safe_edit_message(status_msg, "❌ " + to_bold_sans(f"Profiling Failed: {e}"))
+    finally:
+        profile_running = False
+    report_file = io.BytesIO(report.encode("utf-8"))
+    report_file.name = f"profile_{mode}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.txt"
+    await app.send_document(chat_id, report_file, caption="🔬 " + to_bold_sans(f"{mode.capitalize()} Profile, {seconds}s"))
+    await safe_edit_message(status_msg, "✅ " + to_bold_sans("Profile Sent."), reply_markup=get_profile_markup())
+
+def start_profile_capture(chat_id, mode, seconds, status_msg):
+    task_tracker.create_task(safe_task_wrapper(run_profile_capture(chat_id, mode, seconds, status_msg)))
+
+@app.on_message(filters.command("profile") & filters.user(ADMIN_ID))
+async def profile_command(_, msg):
+    """/profile [cpu|sample|memory] [seconds]"""
+    global profile_running
+    args = msg.command[1:]
+    mode = args[0].lower() if args else "sample"
+    if mode not in PROFILE_MODES or (len(args) > 1 and not args[1].isdigit()):
+        return await msg.reply("Usage: `/profile [cpu|sample|memory] [seconds]`", parse_mode=enums.ParseMode.MARKDOWN)
+    seconds = min(int(args[1]) if len(args) > 1 else 30, PROFILE_MAX_SECONDS)
+    if profile_running:
+        return await msg.reply("⏳ " + to_bold_sans("A Profile Capture Is Already Running."))
+    profile_running = True
+    try:
+        status_msg = await msg.reply("🔬 " + to_bold_sans(f"Profiling ({mode}) For {seconds}s..."))
+    except Exception:
+        profile_running = False
+        raise
+    start_profile_capture(msg.chat.id, mode, seconds, status_msg)
+
+@app.on_callback_query(filters.regex("^profile_menu$"))
+async def profile_menu_cb(_, query):
+    if not is_admin(query.from_user.id): return await query.answer("❌ Admin access required", show_alert=True)
+    text = (
+        "🔬 " + to_bold_sans("Profiler") + "\n\n"
+        "**CPU** profiles the event loop thread with cProfile.\n"
+        "**Stack samples** sample every thread, worker threads included.\n"
+        "**Memory diff** lists the allocation sites that grew during the window.\n\n"
+        "The report arrives as a document. Also available as `/profile [cpu|sample|memory] [seconds]`."
+    )
+    await safe_edit_message(query.message, text, reply_markup=get_profile_markup(), parse_mode=enums.ParseMode.MARKDOWN)
+
+@app.on_callback_query(filters.regex(r"^profile_(cpu|sample|memory)_(\d+)$"))
+async def profile_run_cb(_, query):
+    global profile_running
+    if not is_admin(query.from_user.id): return await query.answer("❌ Admin access required", show_alert=True)
+    if profile_running:
+        return await query.answer("A profile capture is already running.", show_alert=True)
+    _, mode, seconds = query.data.split("_")
+    seconds = min(int(seconds), PROFILE_MAX_SECONDS)
+    profile_running = True
+    start_profile_capture(query.message.chat.id, mode, seconds, query.message)
+    await query.answer(f"Profiling for {seconds}s...")
+    await safe_edit_message(query.message, "🔬 " + to_bold_sans(f"Profiling ({mode}) For {seconds}s..."))
+
 @app.on_callback_query(filters.regex("^set_caption_"))
 async def set_caption_cb(_, query):
     user_id = query.from_user.id
@@ -2164,7 +3722,7 @@ async def _deferred_download_and_show_options(msg, file_info):
         return await msg.reply("❌ " + to_bold_sans("A Critical Error Occurred. Please Start Over."))
 
     processing_msg = await msg.reply("⏳ " + to_bold_sans("Starting Download..."))
-    file_info["processing_msg"] = processing_msg
+    file_info["processing_msg"] = MessageRef.from_message(processing_msg)
     
     try:
         start_time = time.time()
@@ -2173,12 +3731,15 @@ async def _deferred_download_and_show_options(msg, file_info):
         
         if file_info.get("upload_type") == "album":
             await asyncio.sleep(1) # For albums, download happens earlier.
+        elif UPLOAD_QUEUE == "mongo" and db is not None:
+            pass # The upload worker downloads the media.
         else:
-            file_info["downloaded_path"] = await app.download_media(
-                original_media_msg,
+            file_info["downloaded_path"] = await download_media_cached(
+                original_media_msg, file_info.get("job_id"), timer=file_info.setdefault("timer", StageTimer()),
                 progress=progress_callback_threaded,
                 progress_args=("Download", processing_msg.id, msg.chat.id, start_time, last_update_time)
             )
+            await ensure_media_info(file_info)
         
         task_tracker.cancel_user_task(user_id, "progress_monitor")
 
@@ -2197,12 +3758,16 @@ async def _deferred_download_and_show_options(msg, file_info):
 
     except asyncio.CancelledError:
         logger.info(f"Deferred download cancelled by user {user_id}.")
-        cleanup_temp_files([file_info.get("downloaded_path")])
+        workspace.release(file_info.get("job_id"))
     except Exception as e:
         logger.error(f"Error during deferred file download for user {user_id}: {e}", exc_info=True)
         await safe_edit_message(processing_msg, f"❌ " + to_bold_sans(f"Download Failed: {e}"))
-        cleanup_temp_files([file_info.get("downloaded_path")])
+        workspace.release(file_info.get("job_id"))
         if user_id in user_states: del user_states[user_id]
+    finally:
+        # A failed download never reports completion, which would leave the monitor polling forever.
+        task_tracker.cancel_user_task(user_id, "progress_monitor")
+        _progress_updates.pop((msg.chat.id, processing_msg.id), None)
 
 @app.on_message(filters.media & filters.private)
 @with_user_lock
@@ -2230,18 +3795,23 @@ async def handle_media_upload(_, msg):
     if not media: return await msg.reply("❌ " + to_bold_sans("Unsupported Media Type."))
 
     if media.file_size > MAX_FILE_SIZE_BYTES:
-        if user_id in user_states: del user_states[user_id]
+        discard_upload_state(user_id)
         return await msg.reply(f"❌ " + to_bold_sans(f"File Size Exceeds The Limit Of `{MAX_FILE_SIZE_BYTES / (1024 * 1024):.2f}` Mb."))
 
     if action == "waiting_for_album_media":
-        if len(state_data.get('media_paths', [])) >= 10:
+        if len(state_data.get('media_msgs', [])) >= 10:
             return await msg.reply("⚠️ " + to_bold_sans("Max 10 Items In An Album. Send `/done` To Finish."))
         
+        if UPLOAD_QUEUE == "mongo" and db is not None:
+            # The upload worker downloads album media after /done.
+            state_data['media_msgs'].append(MediaRef.from_message(msg))
+            return await msg.reply(f"✅ " + to_bold_sans(f"Received File {len(state_data['media_msgs'])} For Your Album. Send More Or Use `/done`."))
+
         processing_msg = await msg.reply("⏳ " + to_bold_sans("Downloading Media..."))
         try:
-            file_path = await app.download_media(msg)
+            file_path = await download_media_cached(msg, state_data['job_id'], timer=state_data.setdefault('timer', StageTimer()))
             state_data['media_paths'].append(file_path)
-            state_data['media_msgs'].append(msg)
+            state_data['media_msgs'].append(MediaRef.from_message(msg))
             
             num_files = len(state_data['media_paths'])
             await safe_edit_message(processing_msg, f"✅ " + to_bold_sans(f"Downloaded File {num_files} For Your Album. Send More Or Use `/done`."))
@@ -2254,9 +3824,10 @@ async def handle_media_upload(_, msg):
     file_info = {
         "platform": state_data["platform"],
         "upload_type": upload_type,
-        "original_media_msg": msg, 
+        "original_media_msg": MediaRef.from_message(msg),
         "usertags": [], 
-        "location": None
+        "location": None,
+        "job_id": workspace.create_job(user_id)
     }
     
     if upload_type == "story":
@@ -2277,18 +3848,70 @@ async def handle_media_upload(_, msg):
 # ===================================================================
 
 async def start_upload_task(msg, file_info, user_id):
+    if UPLOAD_QUEUE == "mongo" and db is not None:
+        return await enqueue_upload_job(msg, file_info, user_id)
     task_tracker.create_task(
         safe_task_wrapper(process_and_upload(msg, file_info, user_id)),
         user_id=user_id,
         task_name="upload"
     )
 
-# NEW HELPER FUNCTION TO RESTORE AND VALIDATE THE IG CLIENT
+class InstaClientPool:
+    """
+    Keeps validated instagrapi clients per (user_id, username) so uploads and searches don't
+    restore and re-validate the session every time. A client idle for longer than
+    `max_idle_seconds` is validated again before reuse. An instagrapi client must not be
+    used from two threads at once, so callers hold `lock(user_id, username)` around uploads.
+    """
+    def __init__(self, max_idle_seconds=900, max_clients=200):
+        self.max_idle_seconds = max_idle_seconds
+        self.max_clients = max_clients
+        self._clients = OrderedDict()  # (user_id, username) -> (client, last_used), oldest first
+        self._locks = {}
+
+    def get(self, user_id, username):
+        key = (user_id, username)
+        entry = self._clients.get(key)
+        if entry is None:
+            return None
+        client, last_used = entry
+        if time.monotonic() - last_used > self.max_idle_seconds:
+            del self._clients[key]
+            return None
+        self._clients[key] = (client, time.monotonic())
+        self._clients.move_to_end(key)
+        return client
+
+    def put(self, user_id, username, client):
+        self._clients[(user_id, username)] = (client, time.monotonic())
+        self._clients.move_to_end((user_id, username))
+        while len(self._clients) > self.max_clients:
+            old_key, _ = self._clients.popitem(last=False)
+            lock = self._locks.get(old_key)
+            if lock is not None and not lock.locked():
+                del self._locks[old_key]
+
+    def discard(self, user_id, username):
+        self._clients.pop((user_id, username), None)
+
+    def lock(self, user_id, username):
+        return self._locks.setdefault((user_id, username), asyncio.Lock())
+
+    def __len__(self):
+        return len(self._clients)
+
+insta_clients = InstaClientPool()
+
 async def get_insta_client_for_user(user_id, username):
     """
-    Creates and validates an Instagram client for a user using their saved session
-    and device settings from the database for persistent sessions.
+    Returns a validated Instagram client for one of the user's accounts. Clients come from
+    `insta_clients` when possible; otherwise one is restored from the saved session and
+    device settings and validated.
     """
+    pooled_client = insta_clients.get(user_id, username)
+    if pooled_client is not None:
+        return pooled_client
+
     session_data, device_settings = await load_platform_session_data(user_id, "instagram", username)
 
     if not session_data or not device_settings:
@@ -2310,6 +3933,7 @@ async def get_insta_client_for_user(user_id, username):
         # Make a test API call to ensure the session is fully functional
         await asyncio.to_thread(user_client.get_timeline_feed) 
         logger.info(f"Successfully created and validated insta client for user {user_id} ({username})")
+        insta_clients.put(user_id, username, user_client)
         return user_client
     except Exception as e:
         logger.error(f"Failed to create/validate insta client for user {user_id} ({username}). Error: {e}")
@@ -2317,20 +3941,513 @@ async def get_insta_client_for_user(user_id, username):
         raise LoginRequired("IG session is invalid or expired. Please re-login.")
 
 
+def prepared_media_bytes(prepared):
+    """Total size of the files `prepare_instagram_media` produced for one account's upload."""
+    paths = prepared.get("paths") or [segment_path for segment_path, _ in prepared.get("segments", [])] or [prepared.get("path")]
+    return sum(os.path.getsize(path) for path in paths if path and os.path.exists(path))
+
+async def prepare_instagram_media(file_info, media_info, job_id, user_settings, target_bytes, processing_msg):
+    """
+    Runs every per-file stage (conversion, compression, photo normalization, story splitting
+    and thumbnails) once, so the result can be uploaded to any number of accounts. Each is
+    timed as its own stage on the job's timer. Returns a dict with the files to upload plus
+    "hinted_paths" (call `forget_video_hint` on each when all uploads are done) and
+    "compression_stats".
+    """
+    timer = file_info.get("timer")
+    upload_type = file_info["upload_type"]
+    aspect_ratio = user_settings.get("aspect_ratio_instagram", "original")
+    path = file_info.get("downloaded_path")
+    msg_context = file_info.get('original_media_msg')
+    prepared = {"hinted_paths": [], "compression_stats": []}
+
+    async def prepare_video(video_path, info, item_msg, status, aspect="original"):
+        with timed_stage(timer, "convert"):
+            video_path, info = await convert_for_instagram_cached(
+                video_path, info, item_msg, job_id, on_convert=status, aspect_ratio=aspect, timer=timer
+            )
+        if target_bytes:
+            with timed_stage(timer, "compress"):
+                video_path, info, stats = await compress_for_target_cached(
+                    video_path, info, job_id, target_bytes,
+                    on_compress=partial(safe_edit_message, processing_msg, "🗜️ " + to_bold_sans("Compressing Video..."))
+                )
+            if stats: prepared["compression_stats"].append(stats)
+        return video_path, info
+
+    async def normalize_photo(photo_path, item_msg, profile="feed"):
+        with timed_stage(timer, "photo"):
+            return await normalize_photo_cached(photo_path, item_msg, job_id, profile=profile)
+
+    async def add_thumbnail(video_path, info, vertical_cover=False):
+        with timed_stage(timer, "thumbnail"):
+            thumbnail = await prepare_video_upload(video_path, info, job_id, vertical_cover=vertical_cover)
+        if thumbnail:
+            prepared["hinted_paths"].append(video_path)
+        return thumbnail
+
+    try:
+        if upload_type == "reel":
+            upload_path, upload_info = await prepare_video(
+                path, media_info[path], msg_context,
+                partial(safe_edit_message, processing_msg, "⚙️ " + to_bold_sans("Processing Video... This May Take A Moment.")),
+                aspect=aspect_ratio
+            )
+            prepared["path"] = upload_path
+            prepared["thumbnail"] = await add_thumbnail(upload_path, upload_info, vertical_cover=True)
+
+        elif upload_type == "post":
+            prepared["path"] = await normalize_photo(path, msg_context)
+
+        elif upload_type == "album":
+            converted_paths = []
+            original_album_msgs = file_info.get("original_msgs", [])
+            album_status = partial(safe_edit_message, processing_msg, "⚙️ " + to_bold_sans("Processing Album... This May Take A Moment."))
+            for i, p in enumerate(file_info.get("media_paths") or []):
+                item_msg = original_album_msgs[i] if i < len(original_album_msgs) else None
+                if media_info[p].is_video:
+                    converted_p, converted_info = await prepare_video(p, media_info[p], item_msg, album_status)
+                    await add_thumbnail(converted_p, converted_info)
+                    converted_paths.append(converted_p)
+                else:
+                    converted_paths.append(await normalize_photo(p, item_msg))
+            prepared["paths"] = converted_paths
+
+        elif upload_type == "story":
+            if media_info[path].is_video:
+                upload_path, upload_info = await prepare_video(
+                    path, media_info[path], msg_context,
+                    partial(safe_edit_message, processing_msg, "⚙️ " + to_bold_sans("Processing Video Story...")),
+                    aspect=aspect_ratio
+                )
+                with timed_stage(timer, "split"):
+                    segments = await split_story_video(
+                        upload_path, upload_info, job_id,
+                        on_split=partial(safe_edit_message, processing_msg, "✂️ " + to_bold_sans("Splitting Long Video Into Stories..."))
+                    )
+                prepared["segments"] = [
+                    (segment_path, await add_thumbnail(segment_path, segment_info)) for segment_path, segment_info in segments
+                ]
+            else:
+                prepared["path"] = await normalize_photo(path, msg_context, profile="story")
+
+    except BaseException:
+        for hinted_path in prepared["hinted_paths"]:
+            forget_video_hint(hinted_path)
+        raise
+    return prepared
+
+# Transient Instagram failures (dropped connections, timeouts, throttling) are retried in
+# place with exponential backoff and full jitter; anything else fails the stage at once.
+UPLOAD_RETRY_ATTEMPTS = 3
+UPLOAD_RETRY_BASE_SECONDS = 5
+UPLOAD_RETRY_THROTTLED_BASE_SECONDS = 60  # PleaseWaitFewMinutes / 429s want a longer pause
+UPLOAD_RETRY_MAX_SECONDS = 300
+TRANSIENT_UPLOAD_ERRORS = (
+    PleaseWaitFewMinutes, ClientThrottledError, ClientConnectionError, ClientRequestTimeout,
+    RequestsConnectionError, RequestsTimeout, ConnectionError, TimeoutError
+)
+
+def upload_retry_delay(attempt, error):
+    """Seconds to wait before retry number `attempt` (1-based): full jitter over an exponential cap."""
+    base = UPLOAD_RETRY_THROTTLED_BASE_SECONDS if isinstance(error, (PleaseWaitFewMinutes, ClientThrottledError)) else UPLOAD_RETRY_BASE_SECONDS
+    return random.uniform(0, min(UPLOAD_RETRY_MAX_SECONDS, base * 2 ** (attempt - 1)))
+
+# The upload slot and account locks the current task holds, as (lock, task that acquired it),
+# so a retry can hand them back while it backs off instead of blocking other uploads for
+# minutes. Tasks started inside the `async with` (the per-account uploads of
+# upload_to_accounts) inherit this, but must leave their parent's locks alone.
+_held_upload_locks = contextvars.ContextVar("held_upload_locks", default=())
+
+@asynccontextmanager
+async def hold_upload_lock(lock):
+    """`async with lock`, remembering it as released-while-backing-off for `call_with_upload_retries`."""
+    async with lock:
+        token = _held_upload_locks.set(_held_upload_locks.get() + ((lock, asyncio.current_task()),))
+        try:
+            yield
+        finally:
+            _held_upload_locks.reset(token)
+
+@asynccontextmanager
+async def upload_slot():
+    """`hold_upload_lock(upload_semaphore)`, counted in `upload_slot_usage` while waiting and while held."""
+    upload_slot_usage["waiting"] += 1
+    waiting = True
+    try:
+        async with hold_upload_lock(upload_semaphore):
+            upload_slot_usage["waiting"] -= 1
+            waiting = False
+            upload_slot_usage["in_use"] += 1
+            try:
+                yield
+            finally:
+                upload_slot_usage["in_use"] -= 1
+    finally:
+        if waiting:
+            upload_slot_usage["waiting"] -= 1
+
+async def sleep_without_upload_locks(delay):
+    """
+    Sleeps with every lock this task took through `hold_upload_lock` released; takes them back
+    in order. Locks taken by a parent task stay held.
+    """
+    task = asyncio.current_task()
+    held = [lock for lock, owner in _held_upload_locks.get() if owner is task]
+    for lock in reversed(held):
+        lock.release()
+    try:
+        await asyncio.sleep(delay)
+    finally:
+        # The enclosing `async with` blocks release these again, so they must be held on the
+        # way out even if the task is cancelled while waiting for them.
+        cancelled = False
+        for lock in held:
+            while True:
+                try:
+                    await lock.acquire()
+                    break
+                except asyncio.CancelledError:
+                    cancelled = True
+        if cancelled:
+            raise asyncio.CancelledError
+
+# How far back (seconds) a post may look to count as created by a failed call; covers clock
+# skew between this host and Instagram.
+POSTED_MEDIA_CLOCK_SKEW = 30
+
+def find_posted_media(client, since, media_type=None, caption=None, exclude_pks=()):
+    """
+    The media a failed upload call may have created anyway: a post of this account (of
+    `media_type`, with `caption`) or, with media_type None, a story, taken after `since` and
+    not in `exclude_pks`. Returns None if there is none. Blocking.
+    """
+    if media_type is None:
+        candidates = client.user_stories_v1(client.user_id)
+    else:
+        candidates = [
+            # Not user_medias_v1 and friends: they return an empty list when the request fails.
+            media for media in map(extract_media_v1, client.private_request(f"feed/user/{client.user_id}/", params={"count": 5})["items"])
+            if media.media_type == media_type and (media.caption_text or "").strip() == (caption or "").strip()
+        ]
+    for media in candidates:
+        if media.taken_at.timestamp() >= since - POSTED_MEDIA_CLOCK_SKEW and str(media.pk) not in exclude_pks:
+            return media
+    return None
+
+async def call_with_upload_retries(func, *args, on_retry=None, find_posted=None, **kwargs):
+    """
+    Runs a blocking instagrapi call in a thread, retrying transient errors up to
+    UPLOAD_RETRY_ATTEMPTS times. `on_retry(attempt, delay, error)` is awaited before each wait;
+    the wait itself happens without the locks held through `hold_upload_lock`.
+
+    A timeout or dropped connection can hit after Instagram already configured the post, so
+    before running `func` again `find_posted(started_at)` (blocking, returns the media or None)
+    is asked whether the failed call posted anyway, and its media is returned if it did.
+    """
+    attempt = 0
+    started = None
+    while True:
+        try:
+            if started is not None and find_posted is not None:
+                posted = await asyncio.to_thread(find_posted, started)
+                if posted is not None:
+                    logger.info(f"{func.__name__} failed but its media {posted.pk} was posted; not posting again.")
+                    return posted
+            started = time.time()
+            return await asyncio.to_thread(func, *args, **kwargs)
+        except Exception as e:
+            INSTAGRAM_ERRORS.inc(error=type(e).__name__)
+            attempt += 1
+            if not isinstance(e, TRANSIENT_UPLOAD_ERRORS) or attempt > UPLOAD_RETRY_ATTEMPTS:
+                raise
+            delay = upload_retry_delay(attempt, e)
+            logger.warning(f"{func.__name__} failed ({type(e).__name__}: {e}). Retry {attempt}/{UPLOAD_RETRY_ATTEMPTS} in {delay:.1f}s.")
+            if on_retry:
+                await on_retry(attempt, delay, e)
+            await sleep_without_upload_locks(delay)
+
+async def upload_prepared_media(client, username, upload_type, prepared, caption, usertag_names, location, on_status):
+    """
+    Uploads media from `prepare_instagram_media` to one account. `on_status(text)` is awaited
+    with progress text. Returns (last instagrapi result, url); stories may return several
+    newline-separated urls. Story segments already posted by an earlier attempt are skipped.
+    """
+    async def on_retry(attempt, delay, error):
+        await on_status(f"Instagram Didn't Respond, Retrying In {delay:.0f}s ({attempt}/{UPLOAD_RETRY_ATTEMPTS})...")
+
+    usertags = []
+    for u_name in usertag_names:
+        try:
+            user_info = await asyncio.to_thread(client.user_info_by_username, u_name)
+            usertags.append(Usertag(user=user_info, x=0.5, y=0.5))
+        except Exception as e:
+            logger.warning(f"Could not find user to tag: {u_name}, Error: {e}")
+
+    if upload_type == "reel":
+        await on_status("Uploading To Instagram... Please Wait.")
+        result = await call_with_upload_retries(
+            client.clip_upload, prepared["path"], caption,
+            thumbnail=prepared["thumbnail"], usertags=usertags, location=location, on_retry=on_retry,
+            find_posted=partial(find_posted_media, client, media_type=2, caption=caption)
+        )
+        return result, f"https://instagram.com/reel/{result.code}"
+
+    if upload_type == "post":
+        await on_status("Uploading To Instagram... Please Wait.")
+        result = await call_with_upload_retries(
+            client.photo_upload, prepared["path"], caption, usertags=usertags, location=location, on_retry=on_retry,
+            find_posted=partial(find_posted_media, client, media_type=1, caption=caption)
+        )
+        return result, f"https://instagram.com/p/{result.code}"
+
+    if upload_type == "album":
+        await on_status("Uploading Album To Instagram... Please Wait.")
+        result = await call_with_upload_retries(
+            client.album_upload, prepared["paths"], caption, usertags=usertags, location=location, on_retry=on_retry,
+            find_posted=partial(find_posted_media, client, media_type=8, caption=caption)
+        )
+        return result, f"https://instagram.com/p/{result.code}"
+
+    if "segments" in prepared:
+        segments = prepared["segments"]
+        posted = prepared.setdefault("posted_segments", {}).setdefault(username, [])  # [(result, url)]
+        for n, (segment_path, thumbnail) in enumerate(segments[len(posted):], len(posted) + 1):
+            await on_status(f"Uploading Story {n}/{len(segments)}..." if len(segments) > 1 else "Uploading Story...")
+            result = await call_with_upload_retries(
+                client.video_upload_to_story, segment_path, thumbnail=thumbnail, on_retry=on_retry,
+                find_posted=partial(find_posted_media, client, exclude_pks={str(r.pk) for r, _ in posted})
+            )
+            posted.append((result, f"https://instagram.com/stories/{username}/{result.pk}"))
+        return posted[-1][0], "\n".join(url for _, url in posted)
+
+    await on_status("Uploading Story...")
+    result = await call_with_upload_retries(
+        client.photo_upload_to_story, prepared["path"], on_retry=on_retry, find_posted=partial(find_posted_media, client)
+    )
+    return result, f"https://instagram.com/stories/{username}/{result.pk}"
+
+# Telegram answers frequent edits of one message with FloodWait; status changes are batched.
+MULTI_ACCOUNT_STATUS_INTERVAL = 2
+
+async def upload_to_accounts(user_id, accounts, upload_type, prepared, caption, usertag_names, location, processing_msg, timer=None):
+    """
+    Uploads prepared media to several of the user's accounts at once. Each account gets its
+    own status line in `processing_msg`, and a failure on one account doesn't stop the others.
+    Returns {username: (result, url)} for the accounts that succeeded.
+    """
+    lines = {username: "⏳ Waiting..." for username in accounts}
+    changed = asyncio.Event()
+
+    def set_line(username, line):
+        lines[username] = line
+        changed.set()
+
+    async def render():
+        text = "🔀 " + to_bold_sans("Posting To Multiple Accounts") + "\n\n" + "\n".join(
+            f"@{username}: {line}" for username, line in lines.items()
+        )
+        await safe_edit_message(processing_msg, text, parse_mode=None)
+
+    async def render_changes():
+        """Edits the status message at most once per MULTI_ACCOUNT_STATUS_INTERVAL, with the latest lines."""
+        while True:
+            await changed.wait()
+            changed.clear()
+            await render()
+            await asyncio.sleep(MULTI_ACCOUNT_STATUS_INTERVAL)
+
+    async def upload_one(username):
+        async def on_status(text):
+            set_line(username, "⬆️ " + text)
+        try:
+            set_line(username, "🔑 Authenticating...")
+            with timed_stage(timer, "auth", username):
+                client = await get_insta_client_for_user(user_id, username)
+            if not client:
+                raise LoginRequired("Session is invalid or expired. Please re-login.")
+            async with hold_upload_lock(insta_clients.lock(user_id, username)):
+                with timed_stage(timer, "upload", username):
+                    result, url = await upload_prepared_media(client, username, upload_type, prepared, caption, usertag_names, location, on_status)
+            set_line(username, "✅ " + url.replace("\n", " "))
+            return username, (result, url)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if isinstance(e, LoginRequired):
+                insta_clients.discard(user_id, username)
+            set_line(username, f"❌ {type(e).__name__}: {e}")
+            logger.error(f"Upload to @{username} failed for user {user_id}: {e}")
+            return username, None
+
+    renderer = asyncio.create_task(render_changes())
+    try:
+        outcomes = await asyncio.gather(*(upload_one(username) for username in accounts))
+    finally:
+        renderer.cancel()
+        await asyncio.gather(renderer, return_exceptions=True)
+    await render()  # The final lines go out straight away, not after the interval.
+    return {username: outcome for username, outcome in outcomes if outcome is not None}
+
+# Failed upload stages wait here for the user's retry button. The job workspace (downloads,
+# converted files, thumbnails) and the video hints stay alive until the retry succeeds or the
+# window set by "upload_retry_window_minutes" runs out.
+upload_retries = {}  # retry_id -> {"stage", "expires_at"}
+
+def park_upload_for_retry(stage):
+    """Keeps `stage` around for a retry and returns the markup with its retry button."""
+    if WORKER_MODE:
+        return None  # Callbacks reach the front end, not the worker; queued jobs are re-run instead.
+    retry_id = uuid.uuid4().hex[:12]
+    window = global_settings.get("upload_retry_window_minutes", 30) * 60
+    upload_retries[retry_id] = {"stage": stage, "expires_at": time.time() + window}
+    logger.info(f"Upload stage of job {stage['job_id']} parked for retry as {retry_id}.")
+    return InlineKeyboardMarkup([[InlineKeyboardButton("🔁 ʀᴇᴛʀʏ ᴜᴩʟᴏᴀᴅ", callback_data=f"retry_upload_{retry_id}")]])
+
+def release_upload_stage(stage):
+    for hinted_path in stage["prepared"]["hinted_paths"]:
+        forget_video_hint(hinted_path)
+    workspace.release(stage["job_id"])
+
+def expire_upload_retries():
+    now = time.time()
+    for retry_id, entry in list(upload_retries.items()):
+        if entry["expires_at"] <= now:
+            del upload_retries[retry_id]
+            release_upload_stage(entry["stage"])
+            logger.info(f"Retry window of {retry_id} closed.")
+
+def upload_error_text(e):
+    if isinstance(e, LoginRequired):
+        return f"❌ " + to_bold_sans(f"Login Required. Session May Have Expired. Please Use /instagramlogin") + f".\nError: {e}"
+    if isinstance(e, (PleaseWaitFewMinutes, ClientThrottledError)):
+        return f"❌ " + to_bold_sans("Instagram Asked Us To Slow Down. Please Retry In A Few Minutes.")
+    if isinstance(e, ClientError):
+        return f"❌ " + to_bold_sans(f"Instagram Client Error: {e}. Please Try Again Later.")
+    return f"❌ " + to_bold_sans(f"Upload Failed: {str(e)}")
+
+async def run_instagram_upload_stage(stage, processing_msg):
+    """
+    Uploads a prepared job to its accounts and records the result. Raises when nothing was
+    uploaded. When only some accounts failed, parks them for a retry and returns the retry
+    markup; returns None otherwise.
+    """
+    user_id, upload_type, accounts, prepared = stage["user_id"], stage["upload_type"], stage["accounts"], stage["prepared"]
+    timer = stage.get("timer")
+    upload_args = (upload_type, prepared, stage["caption"], stage["usertag_names"], stage["location"])
+    failed_accounts, retry_markup = [], None
+    upload_started = time.monotonic()
+
+    if len(accounts) == 1:
+        # A fresh job authenticated (and timed it) before converting; a retry fetches the client again.
+        client = stage.pop("client", None)
+        if client is None:
+            with timed_stage(timer, "auth"):
+                client = await get_insta_client_for_user(user_id, accounts[0])
+        if not client:
+            raise LoginRequired("Could not authenticate your Instagram session. Please re-login using /instagramlogin.")
+        async with hold_upload_lock(insta_clients.lock(user_id, accounts[0])):
+            with timed_stage(timer, "upload", accounts[0]):
+                results = {accounts[0]: await upload_prepared_media(
+                    client, accounts[0], *upload_args,
+                    on_status=lambda text: safe_edit_message(processing_msg, "⬆️ " + to_bold_sans(text))
+                )}
+    else:
+        results = await upload_to_accounts(user_id, accounts, *upload_args, processing_msg, timer=timer)
+        failed_accounts = [username for username in accounts if username not in results]
+        if not results:
+            raise ValueError(f"Upload failed on all {len(accounts)} selected accounts.")
+        if failed_accounts:
+            retry_markup = park_upload_for_retry({**stage, "accounts": failed_accounts})
+
+    UPLOADS.inc(len(results), upload_type=upload_type, outcome="succeeded")
+    if failed_accounts:
+        UPLOADS.inc(len(failed_accounts), upload_type=upload_type, outcome="failed")
+    compression_summary = None
+    if prepared["compression_stats"]:
+        compression_summary = summarize_compression(prepared["compression_stats"], time.monotonic() - upload_started)
+    if len(results) == 1:
+        url = next(iter(results.values()))[1]
+    else:
+        url = "\n".join(f"@{username}: {account_url}" for username, (_, account_url) in results.items())
+
+    if db is not None:
+        with timed_stage(timer, "record"):
+            await asyncio.to_thread(db.uploads.insert_many, [
+                {
+                    "user_id": user_id, "ig_username": username, "media_id": str(result.pk), "media_type": str(result.media_type),
+                    "platform": "instagram", "upload_type": upload_type, "timestamp": datetime.utcnow(),
+                    "url": account_url, "caption": stage["caption"], "compression": compression_summary,
+                    "timings": timer.as_document(username) if timer is not None else None
+                }
+                for username, (result, account_url) in results.items()
+            ])
+
+    log_msg = f"📤 New Instagram {upload_type.capitalize()} Upload\n" \
+              f"👤 User: `{user_id}`\n🔗 URL: {url}\n📅 {datetime.utcnow().strftime('%Y-%m-%d %H:%M')}"
+    if compression_summary:
+        log_msg += f"\n🗜️ Compressed {compression_summary['ratio']}x, saved ~{compression_summary.get('time_saved_seconds', 'N/A')}s"
+    done_text = "✅ " + to_bold_sans("Uploaded Successfully!") + f"\n\n{url}"
+    if failed_accounts:
+        done_text = "⚠️ " + to_bold_sans(f"Uploaded To {len(results)} Of {len(results) + len(failed_accounts)} Accounts") + \
+                    f"\n\n{url}\n\n❌ Failed: " + ", ".join(f"@{username}" for username in failed_accounts)
+        log_msg += f"\n❌ Failed accounts: {', '.join(failed_accounts)}"
+    await safe_edit_message(processing_msg, done_text, reply_markup=retry_markup, parse_mode=None)
+    await send_log_to_channel(app, LOG_CHANNEL, log_msg)
+    return retry_markup
+
+async def retry_instagram_upload(stage, processing_msg):
+    """Re-runs only the Instagram stage of a parked job, reusing its prepared files."""
+    user_id, job_id = stage["user_id"], stage["job_id"]
+    bind_log_context(user_id=user_id, job_id=job_id)
+    retry_markup = None
+    async with upload_slot():
+        workspace.set_busy(job_id)
+        try:
+            await safe_edit_message(processing_msg, "🔁 " + to_bold_sans("Retrying Upload..."))
+            retry_markup = await run_instagram_upload_stage(stage, processing_msg)
+        except asyncio.CancelledError:
+            logger.warning(f"Upload retry for user {user_id} was cancelled.")
+            await safe_edit_message(processing_msg, "❌ " + to_bold_sans("Upload Process Cancelled."))
+        except Exception as e:
+            UPLOADS.inc(upload_type=stage["upload_type"], outcome="failed")
+            retry_markup = park_upload_for_retry(stage)
+            await safe_edit_message(processing_msg, upload_error_text(e), reply_markup=retry_markup, parse_mode=enums.ParseMode.MARKDOWN)
+            logger.error(f"Upload retry failed for {user_id}: {type(e).__name__}: {e}")
+        finally:
+            if retry_markup is None:
+                release_upload_stage(stage)
+            else:
+                workspace.set_busy(job_id, False)
+
 async def process_and_upload(msg, file_info, user_id, is_scheduled=False):
+    """Runs the upload pipeline for one job and reports progress by editing the processing message. Returns True on success."""
     platform = file_info["platform"]
     upload_type = file_info["upload_type"]
     processing_msg = file_info.get("processing_msg") or msg
     
     task_tracker.cancel_user_task(user_id, "timeout")
 
-    async with upload_semaphore:
+    async with upload_slot():
+        job_id = file_info.get("job_id")
+        bind_log_context(user_id=user_id, job_id=job_id)
         logger.info(f"Semaphore acquired for user {user_id}. Starting upload to {platform}.")
-        files_to_clean = []
+        workspace.set_busy(job_id)
+        succeeded = False
+        stage, retry_markup = None, None
+        timer = file_info.setdefault("timer", StageTimer())
         try:
-            if upload_type == 'story' and 'downloaded_path' not in file_info:
-                processing_msg = await msg.reply("⏳ " + to_bold_sans("Starting Download For Story..."))
-                file_info['downloaded_path'] = await app.download_media(file_info['original_media_msg'])
+            if upload_type == 'album' and not file_info.get('media_paths'):
+                # Queued jobs: the front end only collected the album messages.
+                await safe_edit_message(processing_msg, "⏳ " + to_bold_sans("Downloading Album Media..."))
+                file_info['media_paths'] = [await download_media_cached(m, job_id, timer=timer) for m in file_info.get('original_msgs', [])]
+            elif upload_type != 'album' and 'downloaded_path' not in file_info:
+                if file_info.get("processing_msg"):
+                    await safe_edit_message(processing_msg, "⏳ " + to_bold_sans("Starting Download..."))
+                else:
+                    processing_msg = await msg.reply("⏳ " + to_bold_sans("Starting Download For Story..."))
+                file_info['downloaded_path'] = await download_media_cached(file_info['original_media_msg'], job_id, timer=timer)
+            media_info = await ensure_media_info(file_info)
 
             user_settings = await get_user_settings(user_id)
             is_premium = await is_premium_for_platform(user_id, platform)
@@ -2342,146 +4459,81 @@ async def process_and_upload(msg, file_info, user_id, is_scheduled=False):
             if hashtags:
                 final_caption = f"{final_caption}\n\n{hashtags}"
             
-            url, media_id, media_type_value = "N/A", "N/A", "N/A"
+            url = "N/A"
 
             if platform == "instagram":
                 active_username = user_settings.get("active_ig_username")
                 if not active_username:
                     raise LoginRequired("No active IG account set. Please login and select an account.")
-                
-                await safe_edit_message(processing_msg, "🔑 " + to_bold_sans("Authenticating Session..."))
-                
-                # Use the helper function to get a stable, restored client
-                user_upload_client = await get_insta_client_for_user(user_id, active_username)
-                
-                if not user_upload_client:
-                    raise LoginRequired("Could not authenticate your Instagram session. Please re-login using /instagramlogin.")
-
-                usertags_to_add = []
-                if is_premium and file_info.get("usertags"):
-                    for u_name in file_info["usertags"]:
-                        try:
-                            user_info = await asyncio.to_thread(user_upload_client.user_info_by_username, u_name)
-                            usertags_to_add.append(Usertag(user=user_info, x=0.5, y=0.5))
-                        except Exception as e:
-                            logger.warning(f"Could not find user to tag: {u_name}, Error: {e}")
-
-                location_to_add = file_info.get("location") if is_premium else None
-                path = file_info.get("downloaded_path")
-                paths = file_info.get("media_paths")
-                
-                # Helper to determine if media is a video
-                def is_video(msg_context=None):
-                    if not msg_context: return False
-                    return msg_context.video is not None or (msg_context.document and 'video' in msg_context.document.mime_type)
+                accounts = file_info.get("target_accounts") or [active_username]
 
-                await safe_edit_message(processing_msg, "🤔 " + to_bold_sans("Checking file format..."), reply_markup=None)
+                client = None
+                if len(accounts) == 1:
+                    await safe_edit_message(processing_msg, "🔑 " + to_bold_sans("Authenticating Session..."))
+                    # Use the helper function to get a stable, restored client
+                    with timer.stage("auth"):
+                        client = await get_insta_client_for_user(user_id, accounts[0])
+                    if not client:
+                        raise LoginRequired("Could not authenticate your Instagram session. Please re-login using /instagramlogin.")
 
-                if upload_type == "reel":
-                    files_to_clean.append(path)
-                    upload_path = path
-                    if await asyncio.to_thread(needs_conversion, path):
-                        await safe_edit_message(processing_msg, "⚙️ " + to_bold_sans("Processing Video... This May Take A Moment."))
-                        fixed_path = path.rsplit(".", 1)[0] + "_fixed.mp4"
-                        converted_path = await asyncio.to_thread(fix_for_instagram, path, fixed_path)
-                        files_to_clean.append(converted_path)
-                        upload_path = converted_path
-                    
-                    await safe_edit_message(processing_msg, "⬆️ " + to_bold_sans("Uploading To Instagram... Please Wait."))
-                    result = await asyncio.to_thread(user_upload_client.clip_upload, upload_path, final_caption, usertags=usertags_to_add, location=location_to_add)
-                    url = f"https://instagram.com/reel/{result.code}"
-
-                elif upload_type == "post":
-                    files_to_clean.append(path)
-                    await safe_edit_message(processing_msg, "⬆️ " + to_bold_sans("Uploading To Instagram... Please Wait."))
-                    result = await asyncio.to_thread(user_upload_client.photo_upload, path, final_caption, usertags=usertags_to_add, location=location_to_add)
-                    url = f"https://instagram.com/p/{result.code}"
-
-                elif upload_type == "album":
-                    files_to_clean.extend(paths)
-                    converted_paths = []
-                    original_album_msgs = file_info.get("original_msgs", [])
-
-                    needs_any_conversion = False
-                    for i, p in enumerate(paths):
-                        msg_context = original_album_msgs[i] if i < len(original_album_msgs) else None
-                        if is_video(msg_context) and await asyncio.to_thread(needs_conversion, p):
-                            needs_any_conversion = True
-                            break
-                    
-                    if needs_any_conversion:
-                        await safe_edit_message(processing_msg, "⚙️ " + to_bold_sans("Processing Album... This May Take A Moment."))
-
-                    for i, p in enumerate(paths):
-                        msg_context = original_album_msgs[i] if i < len(original_album_msgs) else None
-                        if is_video(msg_context) and await asyncio.to_thread(needs_conversion, p):
-                            fixed_p = p.rsplit(".", 1)[0] + "_fixed.mp4"
-                            converted_p = await asyncio.to_thread(fix_for_instagram, p, fixed_p)
-                            converted_paths.append(converted_p)
-                            files_to_clean.append(converted_p)
-                        else:
-                            converted_paths.append(p)
-                    
-                    await safe_edit_message(processing_msg, "⬆️ " + to_bold_sans("Uploading Album To Instagram... Please Wait."))
-                    result = await asyncio.to_thread(user_upload_client.album_upload, converted_paths, final_caption, usertags=usertags_to_add, location=location_to_add)
-                    url = f"https://instagram.com/p/{result.code}"
-
-                elif upload_type == "story":
-                    files_to_clean.append(path)
-                    upload_path = path
-                    uploader_func = user_upload_client.photo_upload_to_story
-                    
-                    if is_video(file_info.get('original_media_msg')):
-                        uploader_func = user_upload_client.video_upload_to_story
-                        if await asyncio.to_thread(needs_conversion, path):
-                            await safe_edit_message(processing_msg, "⚙️ " + to_bold_sans("Processing Video Story..."))
-                            fixed_path = path.rsplit(".", 1)[0] + "_fixed.mp4"
-                            converted_path = await asyncio.to_thread(fix_for_instagram, path, fixed_path)
-                            files_to_clean.append(converted_path)
-                            upload_path = converted_path
-                    
-                    await safe_edit_message(processing_msg, "⬆️ " + to_bold_sans("Uploading Story..."))
-                    result = await asyncio.to_thread(uploader_func, upload_path)
-                    url = f"https://instagram.com/stories/{active_username}/{result.pk}"
-                
-                media_id, media_type_value = result.pk, result.media_type
+                path = file_info.get("downloaded_path")
+                await safe_edit_message(processing_msg, "🤔 " + to_bold_sans("Checking file format..."), reply_markup=None)
 
-            if db is not None:
-                await asyncio.to_thread(db.uploads.insert_one, {
-                    "user_id": user_id, "media_id": str(media_id), "media_type": str(media_type_value),
-                    "platform": platform, "upload_type": upload_type, "timestamp": datetime.utcnow(),
-                    "url": url, "caption": final_caption
-                })
+                if upload_type == "reel" and not media_info[path].is_video:
+                    raise ValueError("Reels need a video file. Use the post option for photos.")
+                if upload_type == "post" and media_info[path].is_video:
+                    raise ValueError("Posts need a photo. Use the reel option for videos.")
 
-            log_msg = f"📤 New {platform.capitalize()} {upload_type.capitalize()} Upload\n" \
-                      f"👤 User: `{user_id}`\n🔗 URL: {url}\n📅 {datetime.utcnow().strftime('%Y-%m-%d %H:%M')}"
-            await safe_edit_message(processing_msg, f"✅ " + to_bold_sans("Uploaded Successfully!") + f"\n\n{url}", parse_mode=None)
-            await send_log_to_channel(app, LOG_CHANNEL, log_msg)
+                prepared = await prepare_instagram_media(
+                    file_info, media_info, job_id, user_settings, compression_target_bytes(is_premium), processing_msg
+                )
+                timer.bytes["uploaded"] = prepared_media_bytes(prepared)
+                stage = {
+                    "user_id": user_id, "job_id": job_id, "upload_type": upload_type, "accounts": accounts,
+                    "prepared": prepared, "timer": timer, "caption": final_caption, "client": client,
+                    "usertag_names": (file_info.get("usertags") or []) if is_premium else [],
+                    "location": Location(**file_info["location"].as_fields()) if is_premium and file_info.get("location") else None,
+                }
+                retry_markup = await run_instagram_upload_stage(stage, processing_msg)
+            else:
+                if db is not None:
+                    await asyncio.to_thread(db.uploads.insert_one, {
+                        "user_id": user_id, "media_id": "N/A", "media_type": "N/A",
+                        "platform": platform, "upload_type": upload_type, "timestamp": datetime.utcnow(),
+                        "url": url, "caption": final_caption, "compression": None, "timings": timer.as_document()
+                    })
+                log_msg = f"📤 New {platform.capitalize()} {upload_type.capitalize()} Upload\n" \
+                          f"👤 User: `{user_id}`\n🔗 URL: {url}\n📅 {datetime.utcnow().strftime('%Y-%m-%d %H:%M')}"
+                await safe_edit_message(processing_msg, f"✅ " + to_bold_sans("Uploaded Successfully!") + f"\n\n{url}", parse_mode=None)
+                await send_log_to_channel(app, LOG_CHANNEL, log_msg)
+            succeeded = True
 
         except asyncio.CancelledError:
+            if file_info.get("lease", {}).get("lost"):
+                raise  # A queued job another worker has taken over; that worker reports to the user.
             logger.warning(f"Upload process for user {user_id} was cancelled.")
             await safe_edit_message(processing_msg, "❌ " + to_bold_sans("Upload Process Cancelled."))
-        except LoginRequired as e:
-            error_msg = f"❌ " + to_bold_sans(f"Login Required. Session May Have Expired. Please Use /instagramlogin") + f".\nError: {e}"
-            await safe_edit_message(processing_msg, error_msg, parse_mode=enums.ParseMode.MARKDOWN)
-            logger.error(f"LoginRequired during upload for user {user_id}: {e}")
-        except ClientError as e:
-            error_msg = f"❌ " + to_bold_sans(f"Instagram Client Error: {e}. Please Try Again Later.")
-            await safe_edit_message(processing_msg, error_msg, parse_mode=enums.ParseMode.MARKDOWN)
-            logger.error(f"ClientError during upload for user {user_id}: {e}")
         except Exception as e:
-            error_msg = f"❌ " + to_bold_sans(f"Upload Failed: {str(e)}")
-            await safe_edit_message(processing_msg, error_msg, parse_mode=enums.ParseMode.MARKDOWN)
-            logger.error(f"General upload failed for {user_id} on {platform}: {e}", exc_info=True)
+            # Once the media is prepared, a failure only costs the Instagram stage: offer a retry.
+            UPLOADS.inc(upload_type=upload_type, outcome="failed")
+            retry_markup = park_upload_for_retry(stage) if stage is not None else None
+            await safe_edit_message(processing_msg, upload_error_text(e), reply_markup=retry_markup, parse_mode=enums.ParseMode.MARKDOWN)
+            logger.error(f"Upload failed for {user_id} on {platform}: {type(e).__name__}: {e}", exc_info=not isinstance(e, ClientError))
         finally:
-            cleanup_temp_files(files_to_clean)
+            if retry_markup is not None:
+                workspace.set_busy(job_id, False)
+            elif stage is not None:
+                release_upload_stage(stage)
+            else:
+                workspace.release(job_id)
             if user_id in user_states: del user_states[user_id]
             logger.info(f"Semaphore released for user {user_id}.")
+    return succeeded
 
 async def timeout_task(user_id, message_id):
     await asyncio.sleep(600)
     if user_id in user_states:
-        del user_states[user_id]
+        discard_upload_state(user_id)
         logger.info(f"Task for user {user_id} timed out and was canceled.")
         try:
             await app.edit_message_text(
@@ -2491,25 +4543,354 @@ async def timeout_task(user_id, message_id):
         except Exception as e:
             logger.warning(f"Could not send timeout message to user {user_id}: {e}")
 
+# === Upload Workers ===
+UPLOAD_JOB_LEASE_SECONDS = int(os.getenv("UPLOAD_JOB_LEASE_SECONDS", "300"))
+# A job whose lease keeps running out (its worker died mid-upload, e.g. ffmpeg OOM) is given
+# up after this many claims instead of taking down one worker after another.
+UPLOAD_JOB_MAX_ATTEMPTS = int(os.getenv("UPLOAD_JOB_MAX_ATTEMPTS", "3"))
+
+async def enqueue_upload_job(msg, file_info, user_id):
+    """Hands a finalized upload to the worker fleet through `db.upload_jobs`."""
+    processing_msg = file_info.get("processing_msg")
+    if processing_msg is None:
+        processing_msg = await msg.reply("⏳ " + to_bold_sans("Preparing Upload..."))
+    media_msgs = file_info.get("original_msgs") or [file_info.get("original_media_msg")]
+    location = file_info.get("location")
+    job = {
+        "status": "queued",
+        "user_id": user_id,
+        "chat_id": processing_msg.chat.id,
+        "processing_msg_id": processing_msg.id,
+        "media": [{"chat_id": m.chat.id, "message_id": m.id} for m in media_msgs if m is not None],
+        "platform": file_info["platform"],
+        "upload_type": file_info["upload_type"],
+        "custom_caption": file_info.get("custom_caption"),
+        "usertags": list(file_info.get("usertags") or []),
+        "target_accounts": list(file_info.get("target_accounts") or []),
+        "location": location.as_fields() if location is not None else None,
+        "created_at": datetime.utcnow(),
+        "attempts": 0,
+    }
+    await asyncio.to_thread(db.upload_jobs.insert_one, job)
+    task_tracker.cancel_user_task(user_id, "timeout")
+    discard_upload_state(user_id)
+    await safe_edit_message(processing_msg, "🕒 " + to_bold_sans("Queued. Your Upload Will Start Shortly."))
+    logger.info(f"Queued {job['upload_type']} upload {job['_id']} for user {user_id}.")
+
+async def _claim_upload_job():
+    now = datetime.utcnow()
+    return await asyncio.to_thread(
+        db.upload_jobs.find_one_and_update,
+        {"$or": [
+            {"status": "queued"},
+            {"status": "running", "lease_until": {"$lt": now}, "attempts": {"$lt": UPLOAD_JOB_MAX_ATTEMPTS}},
+        ]},
+        {
+            "$set": {"status": "running", "claimed_by": WORKER_ID, "lease_until": now + timedelta(seconds=UPLOAD_JOB_LEASE_SECONDS)},
+            "$inc": {"attempts": 1},
+        },
+        sort=[("created_at", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+async def _fail_exhausted_upload_job():
+    """Marks one job that ran out of attempts as failed and tells its user. Returns the job or None."""
+    job = await asyncio.to_thread(
+        db.upload_jobs.find_one_and_update,
+        {"status": "running", "lease_until": {"$lt": datetime.utcnow()}, "attempts": {"$gte": UPLOAD_JOB_MAX_ATTEMPTS}},
+        {"$set": {"status": "failed", "error": "attempts exhausted", "finished_at": datetime.utcnow()}, "$unset": {"lease_until": ""}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if job is None:
+        return None
+    logger.error(f"Upload job {job['_id']} of user {job['user_id']} failed: its worker stopped {job['attempts']} times.")
+    UPLOADS.inc(upload_type=job["upload_type"], outcome="failed")
+    await safe_edit_message(
+        MessageRef(app, job["chat_id"], job["processing_msg_id"]),
+        "❌ " + to_bold_sans("Upload Failed: Processing This Media Kept Crashing. Please Try A Smaller Or Different File.")
+    )
+    return job
+
+async def _renew_upload_job_lease(job_id, job_task, lease):
+    """
+    Extends the lease while the job runs. If another worker took the job over, sets
+    `lease["lost"]` and cancels `job_task`.
+    """
+    while True:
+        await asyncio.sleep(UPLOAD_JOB_LEASE_SECONDS / 3)
+        try:
+            result = await asyncio.to_thread(
+                db.upload_jobs.update_one,
+                {"_id": job_id, "status": "running", "claimed_by": WORKER_ID},
+                {"$set": {"lease_until": datetime.utcnow() + timedelta(seconds=UPLOAD_JOB_LEASE_SECONDS)}}
+            )
+        except Exception as e:
+            logger.warning(f"Could not renew the lease of upload job {job_id}: {e}")
+            continue
+        if result.matched_count == 0:
+            logger.error(f"Worker {WORKER_ID} lost the lease of upload job {job_id}; cancelling it here.")
+            lease["lost"] = True
+            job_task.cancel()
+            return
+
+async def run_upload_job(job):
+    """
+    Rebuilds the upload context from a queued job and runs the normal pipeline. If the lease
+    is lost, stops without telling the user or touching the job: its new owner does both.
+    """
+    user_id = job["user_id"]
+    lease = {"lost": False}
+    heartbeat = asyncio.create_task(_renew_upload_job_lease(job["_id"], asyncio.current_task(), lease))
+    succeeded = False
+    try:
+        processing_msg = await app.get_messages(job["chat_id"], job["processing_msg_id"])
+        media_msgs = [await app.get_messages(m["chat_id"], m["message_id"]) for m in job["media"]]
+        media_msgs = [m for m in media_msgs if m and not m.empty]
+        if not media_msgs:
+            await safe_edit_message(processing_msg, "❌ " + to_bold_sans("Upload Failed: The Original Media Is No Longer Available."))
+            return
+        file_info = {
+            "platform": job["platform"],
+            "upload_type": job["upload_type"],
+            "custom_caption": job.get("custom_caption"),
+            "usertags": job.get("usertags") or [],
+            "target_accounts": job.get("target_accounts") or [],
+            "location": LocationRef.from_location(Location(**job["location"])) if job.get("location") else None,
+            "processing_msg": processing_msg,
+            "job_id": workspace.create_job(user_id),
+            "lease": lease,
+        }
+        if job["upload_type"] == "album":
+            file_info["original_msgs"] = media_msgs
+        else:
+            file_info["original_media_msg"] = media_msgs[0]
+        succeeded = await process_and_upload(processing_msg, file_info, user_id)
+    except asyncio.CancelledError:
+        if not lease["lost"]:
+            raise
+        logger.warning(f"Worker {WORKER_ID} stopped upload job {job['_id']} after losing its lease.")
+    except Exception as e:
+        logger.error(f"Upload job {job['_id']} crashed on worker {WORKER_ID}: {e}", exc_info=True)
+    finally:
+        heartbeat.cancel()
+        if not lease["lost"]:
+            await asyncio.to_thread(
+                db.upload_jobs.update_one,
+                {"_id": job["_id"], "claimed_by": WORKER_ID},
+                {"$set": {"status": "done" if succeeded else "failed", "finished_at": datetime.utcnow()}, "$unset": {"lease_until": ""}}
+            )
+
+async def upload_worker_loop():
+    """Claims queued upload jobs while this worker has free upload slots."""
+    active = set()
+    logger.info(f"Upload worker {WORKER_ID} polling for jobs (max {MAX_CONCURRENT_UPLOADS} concurrent).")
+    while True:
+        job = None
+        if len(active) < MAX_CONCURRENT_UPLOADS:
+            try:
+                job = await _claim_upload_job()
+            except Exception as e:
+                logger.error(f"Failed to claim upload job: {e}")
+        if job is None:
+            try:
+                await _fail_exhausted_upload_job()
+            except Exception as e:
+                logger.error(f"Failed to check for exhausted upload jobs: {e}")
+            await asyncio.sleep(2)
+            continue
+        logger.info(f"Worker {WORKER_ID} claimed upload job {job['_id']} (attempt {job['attempts']}).")
+        task = asyncio.create_task(run_upload_job(job))
+        active.add(task)
+        task.add_done_callback(active.discard)
+
 # === HTTP Server for Health Checks ===
-class HealthHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-        self.wfile.write(b"Bot is running")
-    def do_HEAD(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-
-def run_server():
+# Served from the event loop itself, so a loop stuck in a blocking call stops answering /livez
+# and the orchestrator restarts the instance. /readyz tells it whether to route work here.
+HEALTH_PORT = int(os.getenv("HEALTH_PORT", "8080"))
+LIVENESS_MAX_LAG_SECONDS = float(os.getenv("LIVENESS_MAX_LAG_SECONDS", "10"))
+READINESS_MIN_FREE_MB = int(os.getenv("READINESS_MIN_FREE_MB", "1024"))
+# Jobs allowed to wait for an upload slot before /readyz asks for no more. All slots busy is
+# normal load and keeps the instance ready.
+READINESS_MAX_UPLOAD_BACKLOG = int(os.getenv("READINESS_MAX_UPLOAD_BACKLOG", "20"))
+HEALTH_CHECK_TIMEOUT = 3
+# LOOP_DEBUG=1 starts a watchdog that captures the stack of whatever blocks the loop.
+LOOP_DEBUG = os.getenv("LOOP_DEBUG", "0") == "1"
+LOOP_BLOCK_THRESHOLD_SECONDS = float(os.getenv("LOOP_BLOCK_THRESHOLD_SECONDS", "0.5"))
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+HTTP_REASONS = {200: "OK", 404: "Not Found", 503: "Service Unavailable"}
+
+loop_heartbeat = {"at": None, "lag": 0.0, "interval": 1.0}
+loop_lag_samples = deque(maxlen=2400)  # ~10 minutes of heartbeats, for the admin report
+
+async def loop_heartbeat_task(interval=0.25):
+    """Records how late the event loop wakes this task up; a blocked loop shows up as lag."""
+    loop = asyncio.get_running_loop()
+    loop_heartbeat["interval"] = interval
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        loop_heartbeat["lag"] = max(0.0, loop.time() - expected)
+        loop_heartbeat["at"] = time.monotonic()
+        LOOP_LAG.observe(loop_heartbeat["lag"])
+        loop_lag_samples.append(loop_heartbeat["lag"])
+
+class BlockingCallDetector:
+    """
+    Debug-mode watchdog thread. When the loop heartbeat is more than `threshold` seconds late,
+    the loop thread is stuck in some callback; its current stack is sampled once per stall
+    and attributed to the innermost frame from this repo (or the innermost frame at all).
+    """
+    def __init__(self, threshold, max_offenders=50):
+        self.threshold = threshold
+        self.max_offenders = max_offenders
+        self.offenders = {}  # "file:line in func" -> {"count", "blocked", "stack"}
+        self._lock = threading.Lock()
+        self._loop_thread_id = None
+        self._stop = threading.Event()
+
+    def start(self):
+        self._loop_thread_id = threading.get_ident()
+        threading.Thread(target=self._run, name="blocking-call-detector", daemon=True).start()
+        logger.info(f"Blocking-call detector started (threshold {self.threshold}s).")
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        captured_for, key, counted = None, None, 0.0
+        while not self._stop.wait(self.threshold / 2):
+            last = loop_heartbeat["at"]
+            if last is None:
+                continue
+            late = time.monotonic() - last - loop_heartbeat["interval"]
+            if late <= self.threshold:
+                continue
+            if captured_for != last:
+                frame = sys._current_frames().get(self._loop_thread_id)
+                if frame is None:
+                    continue
+                captured_for, counted = last, late
+                key = self._record(traceback.extract_stack(frame), late)
+            else:
+                # Same stall still going: keep adding to its blocked time.
+                with self._lock:
+                    if key in self.offenders:
+                        self.offenders[key]["blocked"] += late - counted
+                counted = late
+
+    def _record(self, stack, late):
+        own = [f for f in stack if os.path.dirname(os.path.abspath(f.filename)) == REPO_DIR]
+        culprit = (own or stack)[-1]
+        key = f"{os.path.basename(culprit.filename)}:{culprit.lineno} in {culprit.name}"
+        with self._lock:
+            entry = self.offenders.setdefault(key, {"count": 0, "blocked": 0.0, "stack": ""})
+            entry["count"] += 1
+            entry["blocked"] += late
+            entry["stack"] = "".join(traceback.format_list(stack[-8:]))
+            if len(self.offenders) > self.max_offenders:
+                del self.offenders[min(self.offenders, key=lambda k: self.offenders[k]["count"])]
+        logger.warning(f"Event loop blocked for {late:.2f}s+ at {key}\n{entry['stack']}")
+        return key
+
+    def top(self, n=5):
+        with self._lock:
+            return sorted(self.offenders.items(), key=lambda item: item[1]["blocked"], reverse=True)[:n]
+
+blocking_detector = BlockingCallDetector(LOOP_BLOCK_THRESHOLD_SECONDS) if LOOP_DEBUG else None
+
+def liveness_checks():
+    checks = {}
+    last = loop_heartbeat["at"]
+    if last is None:
+        checks["event_loop"] = (True, "starting")
+    else:
+        stale = time.monotonic() - last
+        lag = max(loop_heartbeat["lag"], stale - loop_heartbeat["interval"])
+        checks["event_loop"] = (lag <= LIVENESS_MAX_LAG_SECONDS, f"lag {lag:.3f}s")
+    return checks
+
+async def readiness_checks():
+    checks = {}
+    if db is None:
+        checks["mongo"] = (False, "not connected (degraded mode)")
+    else:
+        try:
+            start = time.monotonic()
+            await asyncio.wait_for(asyncio.to_thread(mongo.admin.command, 'ping'), HEALTH_CHECK_TIMEOUT)
+            checks["mongo"] = (True, f"ping {time.monotonic() - start:.3f}s")
+        except Exception as e:
+            checks["mongo"] = (False, f"ping failed: {type(e).__name__}: {e}")
+
+    checks["telegram"] = (bool(app.is_connected), "connected" if app.is_connected else "disconnected")
+
+    disk_root = WORKSPACE_DIR if os.path.isdir(WORKSPACE_DIR) else "."
+    free_mb = shutil.disk_usage(disk_root).free / (1024 * 1024)
+    checks["disk"] = (free_mb >= READINESS_MIN_FREE_MB, f"{free_mb:.0f} MB free, need {READINESS_MIN_FREE_MB} MB")
+
+    if upload_semaphore is None:
+        checks["upload_backlog"] = (False, "not initialized")
+    else:
+        # Only this instance's own backlog: the Mongo queue is shared, so routing traffic
+        # away from one front end would not shorten it.
+        waiting, in_use = upload_slot_usage["waiting"], upload_slot_usage["in_use"]
+        checks["upload_backlog"] = (
+            waiting <= READINESS_MAX_UPLOAD_BACKLOG,
+            f"{waiting} waiting (max {READINESS_MAX_UPLOAD_BACKLOG}), {in_use}/{MAX_CONCURRENT_UPLOADS} slots in use"
+        )
+    return checks
+
+def health_response(checks):
+    ok = all(passed for passed, _ in checks.values())
+    body = json.dumps({
+        "status": "ok" if ok else "fail",
+        "checks": {name: {"ok": passed, "detail": detail} for name, (passed, detail) in checks.items()}
+    })
+    return (200 if ok else 503), "application/json", body
+
+async def handle_health_request(reader, writer):
     try:
-        server = HTTPServer(('0.0.0.0', 8080), HealthHandler)
-        logger.info("HTTP health check server started on port 8080.")
-        server.serve_forever()
+        request_line = await asyncio.wait_for(reader.readline(), HEALTH_CHECK_TIMEOUT)
+        while True:  # Headers are not needed; read past them.
+            line = await asyncio.wait_for(reader.readline(), HEALTH_CHECK_TIMEOUT)
+            if line in (b"\r\n", b"\n", b""):
+                break
+        method, target = request_line.decode("latin-1").split()[:2]
+        path = target.split("?", 1)[0]
+
+        if path == "/livez":
+            status, content_type, body = health_response(liveness_checks())
+        elif path == "/readyz":
+            status, content_type, body = health_response(await readiness_checks())
+        elif path == "/metrics":
+            # Some gauges query MongoDB, so render off the loop.
+            status, content_type, body = 200, metrics.CONTENT_TYPE, await asyncio.to_thread(metrics_registry.render)
+        elif path in ("/", "/health"):
+            status, content_type, body = 200, "text/plain", "Bot is running"
+        else:
+            status, content_type, body = 404, "text/plain", "Not found"
+
+        payload = body.encode()
+        head = (
+            f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+            f"Content-Type: {content_type}\r\nContent-Length: {len(payload)}\r\nConnection: close\r\n\r\n"
+        )
+        writer.write(head.encode() + (b"" if method == "HEAD" else payload))
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError, ValueError):
+        pass
     except Exception as e:
+        logger.error(f"Health request failed: {e}")
+    finally:
+        writer.close()
+
+async def start_health_server():
+    try:
+        server = await asyncio.start_server(handle_health_request, '0.0.0.0', HEALTH_PORT)
+    except OSError as e:
         logger.error(f"HTTP server failed: {e}")
+        return None
+    logger.info(f"HTTP health check server started on port {HEALTH_PORT} (/livez, /readyz, /metrics).")
+    return server
 
 async def send_log_to_channel(client, channel_id, text):
     global valid_log_channel
@@ -2524,15 +4905,16 @@ async def send_log_to_channel(client, channel_id, text):
 # ===================================================================
 # ======================== BOT STARTUP ============================
 # ===================================================================
-async def start_bot():
-    global mongo, db, global_settings, upload_semaphore, MAX_CONCURRENT_UPLOADS, MAX_FILE_SIZE_BYTES, task_tracker, valid_log_channel
+async def init_runtime():
+    """Connects to MongoDB and sets up settings, limits and temp storage. Shared by the bot and worker modes."""
+    global mongo, db, global_settings, upload_semaphore, MAX_CONCURRENT_UPLOADS, MAX_FILE_SIZE_BYTES, media_cache, workspace, media_executor
 
     os.makedirs("sessions", exist_ok=True)
     logger.info("Session directories ensured.")
 
     try:
         mongo = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
-        mongo.admin.command('ping')
+        await asyncio.to_thread(mongo.admin.command, 'ping')
         db = mongo.NowTok
         logger.info("✅ Connected to MongoDB successfully.")
         
@@ -2559,13 +4941,74 @@ async def start_bot():
     MAX_CONCURRENT_UPLOADS = global_settings.get("max_concurrent_uploads")
     upload_semaphore = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
     MAX_FILE_SIZE_BYTES = global_settings.get("max_file_size_mb") * 1024 * 1024
+    # Pyrogram allows one file transfer at a time by default, which would serialize the
+    # parts of a parallel download. The semaphore caps concurrent parts across all downloads.
+    app.get_file_semaphore = asyncio.Semaphore(global_settings.get("max_concurrent_transmissions", 8))
+
+    media_cache = MediaCache(
+        MEDIA_CACHE_DIR, global_settings.get("media_cache_max_mb", 2048) * 1024 * 1024,
+        ttl_seconds=global_settings.get("media_cache_ttl_hours", 72) * 3600
+    )
+    await asyncio.to_thread(media_cache.load)
+    workspace = WorkspaceManager(WORKSPACE_DIR, global_settings.get("temp_storage_quota_mb", 5120) * 1024 * 1024)
+    # No job survives a restart, so everything left in the workspace is an orphan.
+    _, orphan_dirs = workspace.sweep(set())
+    for orphan_dir in orphan_dirs:
+        await asyncio.to_thread(shutil.rmtree, orphan_dir, True)
+
+    media_executor = ProcessPoolExecutor(
+        max_workers=global_settings.get("media_pool_workers", 2),
+        mp_context=media_pool_context()
+    )
+    await asyncio.get_running_loop().run_in_executor(media_executor, media_pool.warm_up)
 
-    server_thread = threading.Thread(target=run_server, daemon=True)
-    server_thread.start()
+def media_pool_context():
+    """
+    The multiprocessing context for the media workers. By now this process has threads (the
+    log listener, MongoDB monitors, executor threads), so forking it could hand a worker a
+    lock some thread was holding. Workers are forked from a forkserver instead: a fresh
+    interpreter that has imported only media_pool.
+
+    Every worker also re-imports the script that started this process. That is launcher.py,
+    which imports nothing outside its `__main__` guard, so workers never load this module.
+    """
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(["media_pool"])
+    return context
+
+async def start_bot():
+    global state_backend, user_states, valid_log_channel
+
+    await init_runtime()
+
+    if STATE_BACKEND == "mongo":
+        if db is not None:
+            state_backend = MongoStateBackend(db)
+            user_states = state_backend.states
+            app.add_handler(MessageHandler(partition_gate), group=-1)
+            app.add_handler(CallbackQueryHandler(partition_gate), group=-1)
+            logger.info(f"Using MongoDB state backend as replica '{REPLICA_ID}'.")
+        else:
+            logger.error("STATE_BACKEND=mongo requires a database connection. Falling back to in-memory state.")
+    if UPLOAD_QUEUE == "mongo":
+        if db is not None:
+            logger.info("Upload jobs will be queued for worker processes (UPLOAD_QUEUE=mongo).")
+        else:
+            logger.error("UPLOAD_QUEUE=mongo requires a database connection. Uploads will run in this process.")
+    if UPDATE_LOG:
+        start_update_recorder()
+
+    health_server = await start_health_server()
     
     await app.start()
     
     task_tracker.loop = asyncio.get_running_loop()
+    task_tracker.create_task(safe_task_wrapper(loop_heartbeat_task()))
+    if blocking_detector is not None:
+        blocking_detector.start()
+    task_tracker.create_task(safe_task_wrapper(workspace_sweeper_task()))
+    if state_backend.name != "memory":
+        task_tracker.create_task(safe_task_wrapper(state_flush_task()))
 
     if LOG_CHANNEL:
         try:
@@ -2579,17 +5022,64 @@ async def start_bot():
     await idle()
 
     logger.info("Shutting down...")
+    if health_server is not None:
+        health_server.close()
     await task_tracker.cancel_and_wait_all()
+    try:
+        await state_backend.close()
+    except Exception as e:
+        logger.error(f"Failed to hand over flow state on shutdown: {e}")
     await app.stop()
+    if update_recorder is not None:
+        update_recorder.close()
+    media_executor.shutdown(cancel_futures=True)
     if mongo:
         mongo.close()
     logger.info("Bot has been shut down gracefully.")
 
-if __name__ == "__main__":
+async def start_worker():
+    global valid_log_channel
+
+    await init_runtime()
+    if db is None:
+        logger.critical("Worker mode needs MongoDB to receive upload jobs. Exiting.")
+        return
+
+    health_server = await start_health_server()
+    await app.start()
+    task_tracker.loop = asyncio.get_running_loop()
+    task_tracker.create_task(safe_task_wrapper(loop_heartbeat_task()))
+    if blocking_detector is not None:
+        blocking_detector.start()
+    task_tracker.create_task(safe_task_wrapper(workspace_sweeper_task()))
+    task_tracker.create_task(safe_task_wrapper(upload_worker_loop()))
+    valid_log_channel = bool(LOG_CHANNEL)
+
+    logger.info(f"Upload worker '{WORKER_ID}' is online. Waiting for jobs...")
+    await idle()
+
+    logger.info("Shutting down worker...")
+    if health_server is not None:
+        health_server.close()
+    await task_tracker.cancel_and_wait_all()
+    await app.stop()
+    media_executor.shutdown(cancel_futures=True)
+    if mongo:
+        mongo.close()
+    logger.info("Worker has been shut down gracefully.")
+
+def run():
+    """Runs the bot, or an upload worker with `--worker`, until it is stopped. Called by launcher.py."""
+    global task_tracker
     task_tracker = TaskTracker()
     try:
-        app.run(start_bot())
+        app.run(start_worker() if WORKER_MODE else start_bot())
     except (KeyboardInterrupt, SystemExit):
         logger.info("Shutdown signal received.")
     except Exception as e:
         logger.critical(f"Bot crashed during startup: {e}", exc_info=True)
+
+if __name__ == "__main__":
+    # Media workers re-import whatever script started the process; this module is far too
+    # heavy for that (see media_pool_context).
+    sys.exit("Start the bot with `python launcher.py`.")
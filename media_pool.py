@@ -0,0 +1,172 @@
+"""
+CPU-bound media work that runs inside the bot's process pool.
+
+Everything here must stay importable without the bot itself (no Pyrogram, no MongoDB) and
+every entry point must be a plain top-level function so it can be pickled to a worker.
+"""
+import os
+import time
+import logging
+import subprocess
+
+from PIL import Image, ImageOps
+
+logger = logging.getLogger("BotUser")
+
+# Instagram serves photos at most 1080 px wide. Feed posts must stay between 4:5 portrait
+# and 1.91:1 landscape; stories are shown at 9:16 and get cropped beyond that.
+PHOTO_PROFILES = {
+    "feed": {"max_width": 1080, "min_ratio": 4 / 5, "max_ratio": 1.91},
+    "story": {"max_width": 1080, "min_ratio": 9 / 16, "max_ratio": 1.91},
+}
+# Bump when the encoder settings below change so cached outputs are not reused.
+PHOTO_PROFILE_VERSION = "v1"
+JPEG_QUALITY = 90
+MAX_PHOTO_BYTES = 8 * 1024 * 1024
+EXIF_ORIENTATION_TAG = 0x0112
+
+def warm_up():
+    """No-op used to start the pool's workers ahead of the first real job."""
+    return os.getpid()
+
+def _clamped_box(width, height, min_ratio, max_ratio):
+    """Returns the centered crop box that brings width/height inside [min_ratio, max_ratio]."""
+    ratio = width / height
+    if ratio < min_ratio:
+        new_height = round(width / min_ratio)
+        top = (height - new_height) // 2
+        return (0, top, width, top + new_height)
+    if ratio > max_ratio:
+        new_width = round(height * max_ratio)
+        left = (width - new_width) // 2
+        return (left, 0, left + new_width, height)
+    return None
+
+def photo_is_compliant(img, file_size, profile):
+    """True if the photo can go to Instagram as it is."""
+    limits = PHOTO_PROFILES[profile]
+    width, height = img.size
+    return (
+        img.format == "JPEG"
+        and img.mode in ("RGB", "L")
+        and img.getexif().get(EXIF_ORIENTATION_TAG, 1) == 1
+        and width <= limits["max_width"]
+        and limits["min_ratio"] <= width / height <= limits["max_ratio"]
+        and file_size <= MAX_PHOTO_BYTES
+    )
+
+def normalize_photo(input_file, output_file, profile="feed"):
+    """
+    Rewrites a photo as an Instagram-ready JPEG: EXIF orientation applied, aspect ratio
+    center-cropped into the profile's range and width capped. Returns `output_file`, or
+    None when the input already complies and can be uploaded untouched.
+    """
+    limits = PHOTO_PROFILES[profile]
+    with Image.open(input_file) as img:
+        if photo_is_compliant(img, os.path.getsize(input_file), profile):
+            return None
+
+        # Let the JPEG decoder downscale by a power of two when the source is much larger
+        # than the target; this is far cheaper than decoding at full size.
+        if img.format == "JPEG" and img.width > 2 * limits["max_width"]:
+            img.draft("RGB", (limits["max_width"], round(limits["max_width"] * img.height / img.width)))
+
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ("RGBA", "LA", "P"):
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel("A"))
+            img = background
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+
+        box = _clamped_box(img.width, img.height, limits["min_ratio"], limits["max_ratio"])
+        if box:
+            img = img.crop(box)
+        if img.width > limits["max_width"]:
+            new_height = round(img.height * limits["max_width"] / img.width)
+            img = img.resize((limits["max_width"], new_height), Image.LANCZOS)
+
+        img.save(output_file, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True, subsampling="4:2:0")
+    return output_file
+
+def compress_video(input_file, output_file, video_kbps, audio_kbps=128):
+    """
+    Re-encodes a video to roughly `video_kbps` + `audio_kbps` with a constrained-quality x264
+    encode: CRF keeps easy scenes small while maxrate caps the hard ones. Returns the
+    wall-clock seconds the encode took.
+    """
+    start = time.monotonic()
+    command = [
+        'ffmpeg', '-y', '-i', input_file,
+        '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '23',
+        '-maxrate', f'{video_kbps}k', '-bufsize', f'{video_kbps * 2}k', '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-b:a', f'{audio_kbps}k', '-ar', '48000',
+        '-movflags', '+faststart', output_file
+    ]
+    try:
+        subprocess.run(command, check=True, capture_output=True, text=True)
+    except subprocess.CalledProcessError as e:
+        raise ValueError(f"ffmpeg compression failed for {input_file}. Error: {e.stderr[-2000:]}")
+    return time.monotonic() - start
+
+def keyframe_times(input_file):
+    """
+    Presentation times of the video keyframes, read from packet flags so nothing is decoded.
+    """
+    command = [
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', input_file
+    ]
+    try:
+        result = subprocess.run(command, check=True, capture_output=True, text=True)
+    except subprocess.CalledProcessError as e:
+        raise ValueError(f"Could not read keyframes of {input_file}. Error: {e.stderr}")
+    times = []
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags and pts_time not in ('', 'N/A'):
+            times.append(float(pts_time))
+    return sorted(times)
+
+def plan_segments(keyframes, duration, max_seconds):
+    """
+    Splits [0, duration) into pieces of at most `max_seconds` that start on keyframes where
+    possible. Returns (start, length, stream_copy) tuples; stream_copy is False only for a piece
+    that had to start between keyframes because the GOP was longer than `max_seconds`.
+    """
+    segments = []
+    start, start_on_keyframe = 0.0, True
+    while duration - start > 0.05:
+        limit = start + max_seconds
+        if limit >= duration:
+            end = duration
+        else:
+            candidates = [t for t in keyframes if start + 0.5 < t <= limit]
+            end = candidates[-1] if candidates else limit
+        segments.append((start, end - start, start_on_keyframe))
+        start_on_keyframe = end == duration or end in keyframes
+        start = end
+    return segments
+
+# With stream copy, input seeking starts at the last keyframe at or before -ss. ffprobe prints
+# keyframe times rounded to microseconds (8.333333 for 8.3333333...), which would land on the
+# keyframe before, repeating up to a GOP; a millisecond forward stays well within one frame.
+KEYFRAME_SEEK_NUDGE = 0.001
+
+def cut_segment(input_file, output_file, start, length, stream_copy=True):
+    """Writes one story segment. Stream copy when it starts on a keyframe, fast x264 otherwise."""
+    if stream_copy and start > 0:
+        start += KEYFRAME_SEEK_NUDGE
+    # repr keeps full precision; a fixed number of decimals can round below the keyframe.
+    command = ['ffmpeg', '-y', '-ss', repr(float(start)), '-i', input_file, '-t', repr(float(length))]
+    if stream_copy:
+        command += ['-c', 'copy', '-avoid_negative_ts', 'make_zero']
+    else:
+        command += ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '21', '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-b:a', '128k']
+    command += ['-movflags', '+faststart', output_file]
+    try:
+        subprocess.run(command, check=True, capture_output=True, text=True)
+    except subprocess.CalledProcessError as e:
+        raise ValueError(f"Cutting {input_file} at {start:.1f}s failed. Error: {e.stderr[-2000:]}")
+    return output_file
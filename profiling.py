@@ -0,0 +1,126 @@
+"""
+On-demand profiling for the admin panel. Nothing here runs or is imported by the profilers
+until a capture is requested, and every capture switches its profiler off again when done.
+
+- `capture_cpu`: cProfile on the event loop thread, where every handler and task runs.
+  Work that runs in `asyncio.to_thread` or the media process pool is not seen.
+- `capture_samples`: a thread samples the stacks of all threads every few milliseconds,
+  so worker threads show up too; cheaper than cProfile but statistical.
+- `capture_memory`: tracemalloc for the window, reported as the allocation sites that grew.
+
+Each returns the report as text.
+"""
+import io
+import sys
+import time
+import asyncio
+import threading
+from collections import Counter
+
+REPORT_TOP = 40
+
+def _header(title, seconds):
+    return f"{title}\nwindow: {seconds}s, taken {time.strftime('%Y-%m-%d %H:%M:%S')}\n\n"
+
+async def capture_cpu(seconds):
+    import cProfile
+    import pstats
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+
+    def render():
+        out = io.StringIO()
+        out.write(_header("cProfile of the event loop thread", seconds))
+        stats = pstats.Stats(profiler, stream=out).strip_dirs()
+        out.write("== by cumulative time ==\n")
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(REPORT_TOP)
+        out.write("\n== by own time ==\n")
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(REPORT_TOP)
+        return out.getvalue()
+
+    return await asyncio.to_thread(render)
+
+def _frame_key(frame):
+    code = frame.f_code
+    return f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno} {code.co_name}"
+
+async def capture_samples(seconds, interval=0.005):
+    own, total, threads = Counter(), Counter(), Counter()
+    samples = [0]
+    stop = threading.Event()
+
+    def sample():
+        me = threading.get_ident()
+        names = {}
+        while not stop.wait(interval):
+            names.update((t.ident, t.name) for t in threading.enumerate())
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                threads[names.get(thread_id, str(thread_id))] += 1
+                own[_frame_key(frame)] += 1
+                seen = set()
+                while frame is not None:
+                    key = _frame_key(frame)
+                    if key not in seen:
+                        seen.add(key)
+                        total[key] += 1
+                    frame = frame.f_back
+            samples[0] += 1
+
+    sampler = threading.Thread(target=sample, name="profile-sampler", daemon=True)
+    sampler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        stop.set()
+        while sampler.is_alive():
+            await asyncio.sleep(interval)
+
+    count = max(samples[0], 1)
+    out = io.StringIO()
+    out.write(_header(f"Stack samples of all threads every {interval * 1000:.0f}ms ({samples[0]} rounds)", seconds))
+    out.write("Idle threads show up under their wait call (select, wait, sleep).\n\n")
+    for title, counter in (("by cumulative samples", total), ("by own samples", own), ("by thread", threads)):
+        out.write(f"== {title} ==\n")
+        for key, hits in counter.most_common(REPORT_TOP):
+            out.write(f"{hits / count * 100:7.1f}%  {hits:7d}  {key}\n")
+        out.write("\n")
+    return out.getvalue()
+
+async def capture_memory(seconds, frames=10):
+    import tracemalloc
+
+    if tracemalloc.is_tracing():
+        raise RuntimeError("tracemalloc is already running (PYTHONTRACEMALLOC?)")
+    tracemalloc.start(frames)
+    try:
+        # Snapshots copy every traced block; with a large heap that takes long enough to stall the loop.
+        before = await asyncio.to_thread(tracemalloc.take_snapshot)
+        await asyncio.sleep(seconds)
+        after = await asyncio.to_thread(tracemalloc.take_snapshot)
+        traced, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    def render():
+        out = io.StringIO()
+        out.write(_header("tracemalloc: allocations made during the window and still alive", seconds))
+        out.write(f"traced now {traced / 1024 / 1024:.1f} MB, peak {peak / 1024 / 1024:.1f} MB\n\n")
+        out.write("== top allocation sites by growth ==\n")
+        for stat in after.compare_to(before, "lineno")[:REPORT_TOP]:
+            out.write(f"{stat}\n")
+        out.write("\n== top growing tracebacks ==\n")
+        for stat in after.compare_to(before, "traceback")[:5]:
+            out.write(f"\n{stat.size_diff / 1024:.1f} KiB in {stat.count_diff:+d} blocks\n")
+            out.write("\n".join(stat.traceback.format()) + "\n")
+        return out.getvalue()
+
+    return await asyncio.to_thread(render)
+
+CAPTURES = {"cpu": capture_cpu, "sample": capture_samples, "memory": capture_memory}
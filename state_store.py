@@ -0,0 +1,274 @@
+"""
+Compact records and bounded registries for per-user conversation state.
+
+Flow state used to hold whole pyrogram `Message` objects (with their client, chat, user and
+reply-markup graphs) and instagrapi `Location` models. The refs below keep only the ids and
+the few media fields the pipeline reads, and quack enough like a message (`.id`, `.chat.id`,
+`.video`/`.photo`/`.document`, `edit_text`) that helpers taking a message also take a ref.
+Refs are plain data, so they also survive `_to_state_document` for the Mongo state backend.
+
+`BoundedRegistry` is the dict that backs every per-user registry: least recently used
+entries are dropped beyond a hard cap and idle ones after a TTL.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+class _ChatRef:
+    __slots__ = ("id",)
+
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+class MessageRef:
+    """A message the bot keeps editing (status and progress messages), by id only."""
+    __slots__ = ("client", "chat_id", "message_id")
+    text = caption = reply_markup = None
+
+    def __init__(self, client, chat_id, message_id):
+        self.client = client
+        self.chat_id = chat_id
+        self.message_id = message_id
+
+    @classmethod
+    def from_message(cls, message):
+        if message is None or isinstance(message, cls):
+            return message
+        return cls(message._client, message.chat.id, message.id)
+
+    @property
+    def id(self):
+        return self.message_id
+
+    @property
+    def chat(self):
+        return _ChatRef(self.chat_id)
+
+    async def edit_text(self, text, **kwargs):
+        return await self.client.edit_message_text(self.chat_id, self.message_id, text, **kwargs)
+
+    async def reply(self, text, **kwargs):
+        return await self.client.send_message(self.chat_id, text, reply_to_message_id=self.message_id, **kwargs)
+
+    def as_document(self):
+        return {"_ref": "message", "chat_id": self.chat_id, "message_id": self.message_id}
+
+class MediaRef:
+    """
+    A received media message: where it is and what Telegram told us about the file.
+    `.video`, `.photo` and `.document` return the ref itself for its own kind, so code written
+    against `msg.video or msg.photo or msg.document` keeps working.
+    """
+    __slots__ = (
+        "chat_id", "message_id", "kind", "file_id", "file_unique_id", "file_size",
+        "mime_type", "file_name", "width", "height", "duration"
+    )
+
+    def __init__(self, chat_id, message_id, kind, file_id, file_unique_id, file_size=0,
+                 mime_type=None, file_name=None, width=0, height=0, duration=0):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.kind = kind  # "video", "photo" or "document"
+        self.file_id = file_id
+        self.file_unique_id = file_unique_id
+        self.file_size = file_size
+        # pyrogram's download_media reads these with getattr(..., ""), so never None.
+        self.mime_type = mime_type or ""
+        self.file_name = file_name or ""
+        self.width = width
+        self.height = height
+        self.duration = duration
+
+    @classmethod
+    def from_message(cls, message):
+        if message is None or isinstance(message, cls):
+            return message
+        for kind in ("video", "photo", "document"):
+            media = getattr(message, kind, None)
+            if media is not None:
+                return cls(
+                    message.chat.id, message.id, kind, media.file_id, media.file_unique_id,
+                    file_size=getattr(media, "file_size", 0) or 0,
+                    mime_type=getattr(media, "mime_type", None),
+                    file_name=getattr(media, "file_name", None),
+                    width=getattr(media, "width", 0) or 0,
+                    height=getattr(media, "height", 0) or 0,
+                    duration=getattr(media, "duration", 0) or 0,
+                )
+        raise ValueError("This message doesn't contain any downloadable media")
+
+    @property
+    def id(self):
+        return self.message_id
+
+    @property
+    def chat(self):
+        return _ChatRef(self.chat_id)
+
+    @property
+    def video(self):
+        return self if self.kind == "video" else None
+
+    @property
+    def photo(self):
+        return self if self.kind == "photo" else None
+
+    @property
+    def document(self):
+        return self if self.kind == "document" else None
+
+    def as_document(self):
+        doc = {name: getattr(self, name) for name in self.__slots__}
+        doc["_ref"] = "media"
+        return doc
+
+class LocationRef:
+    """The fields of an instagrapi `Location` that a post needs; `Location(**ref.as_fields())` rebuilds it."""
+    __slots__ = ("pk", "name", "address", "lat", "lng", "external_id", "external_id_source")
+
+    def __init__(self, pk, name, address=None, lat=None, lng=None, external_id=None, external_id_source=None):
+        self.pk = pk
+        self.name = name
+        self.address = address
+        self.lat = lat
+        self.lng = lng
+        self.external_id = external_id
+        self.external_id_source = external_id_source
+
+    @classmethod
+    def from_location(cls, location):
+        return cls(**{name: getattr(location, name, None) for name in cls.__slots__})
+
+    def as_fields(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def as_document(self):
+        doc = self.as_fields()
+        doc["_ref"] = "location"
+        return doc
+
+def restore_refs(value, client=None):
+    """Inverse of the `as_document()` conversion: turns stored ref documents back into refs."""
+    if isinstance(value, dict):
+        kind = value.get("_ref")
+        fields = {k: v for k, v in value.items() if k != "_ref"}
+        if kind == "message":
+            return MessageRef(client, **fields)
+        if kind == "media":
+            return MediaRef(**fields)
+        if kind == "location":
+            return LocationRef(**fields)
+        return {k: restore_refs(v, client) for k, v in value.items()}
+    if isinstance(value, list):
+        return [restore_refs(v, client) for v in value]
+    return value
+
+class BoundedRegistry:
+    """
+    A dict with a hard size cap and an idle TTL. Reading or writing an entry marks it used.
+    Entries beyond `max_entries` are dropped least recently used first, and entries idle for
+    `ttl_seconds` are dropped when next read or on `sweep()`. `can_evict(key, value)` can veto
+    dropping an entry that is still in use; `on_evict(key, value)` runs for every dropped one.
+    Safe to use from worker threads.
+    """
+
+    def __init__(self, name, max_entries, ttl_seconds, can_evict=None, on_evict=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.can_evict = can_evict
+        self.on_evict = on_evict
+        self.evictions = 0
+        self._data = OrderedDict()  # key -> [value, last used (monotonic)]
+        self._lock = threading.RLock()
+
+    def _expired(self, entry, now):
+        return self.ttl_seconds and now - entry[1] > self.ttl_seconds
+
+    def _evictable(self, key, value):
+        return self.can_evict is None or self.can_evict(key, value)
+
+    def _drop(self, key):
+        value = self._data.pop(key)[0]
+        self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+    def __getitem__(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data[key]
+            if self._expired(entry, now) and self._evictable(key, entry[0]):
+                self._drop(key)
+                raise KeyError(key)
+            entry[1] = now
+            self._data.move_to_end(key)
+            return entry[0]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data[key] = [value, time.monotonic()]
+            self._data.move_to_end(key)
+            if len(self._data) > self.max_entries:
+                for old_key in list(self._data):
+                    if len(self._data) <= self.max_entries:
+                        break
+                    if old_key != key and self._evictable(old_key, self._data[old_key][0]):
+                        self._drop(old_key)
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(list(self._data))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        with self._lock:
+            if key in self._data:
+                return self._data.pop(key)[0]
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def setdefault(self, key, default=None):
+        with self._lock:
+            try:
+                return self[key]
+            except KeyError:
+                self[key] = default
+                return default
+
+    def keys(self):
+        return list(self._data)
+
+    def values(self):
+        """A snapshot of the values. Does not count as use."""
+        with self._lock:
+            return [entry[0] for entry in self._data.values()]
+
+    def items(self):
+        """A snapshot of the items. Does not count as use."""
+        with self._lock:
+            return [(key, entry[0]) for key, entry in self._data.items()]
+
+    def sweep(self):
+        """Drops every expired entry that may be dropped. Returns how many went."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, entry in self._data.items() if self._expired(entry, now) and self._evictable(key, entry[0])]
+            for key in expired:
+                self._drop(key)
+        return len(expired)
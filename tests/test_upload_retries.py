@@ -0,0 +1,269 @@
+"""
+The retrying Instagram upload stage (`call_with_upload_retries`) against a local HTTP stand-in
+for the Instagram private API. instagrapi runs unmodified; only its session is pointed at the
+stand-in, which can drop a connection before or after handling a request.
+
+    python tests/test_upload_retries.py
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import tempfile
+import threading
+import unittest
+from functools import partial
+from types import ModuleType
+from unittest import mock
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from PIL import Image
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+# main.py validates these at import time; nothing here connects to the real services.
+for name, value in {
+    "TELEGRAM_API_ID": "1", "TELEGRAM_API_HASH": "test", "TELEGRAM_BOT_TOKEN": "1:test",
+    "ADMIN_ID": "1", "MONGO_DB": "mongodb://test.invalid", "LOG_FILE": "",
+}.items():
+    os.environ[name] = value
+# main.py creates its download and cache directories in the working directory.
+os.chdir(tempfile.mkdtemp(prefix="upload_retry_test_"))
+
+import main
+import instagrapi.mixins.photo
+
+ACCOUNT_ID = 4242
+
+class InstagramStandIn(ThreadingHTTPServer):
+    """
+    Serves the endpoints a photo post touches: rupload, media/configure, qe/expose and the
+    account's feed. `faults[kind]` is a list of "drop" (close before handling) or "drop_after"
+    (handle, then close without answering), used up one per request of that kind.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.posts = []  # newest first, as Instagram lists them
+        self.calls = {"rupload": 0, "configure": 0, "feed": 0}
+        self.faults = {}
+        self.lock = threading.Lock()
+
+    def configure(self, caption):
+        with self.lock:
+            pk = str(1000 + len(self.posts))
+            media = {
+                "pk": pk, "id": f"{pk}_{ACCOUNT_ID}", "code": f"C{pk}", "taken_at": int(time.time()),
+                "media_type": 1, "caption": {"text": caption},
+                "user": {"pk": str(ACCOUNT_ID), "username": "standin"},
+                "image_versions2": {"candidates": [{"url": "https://example.com/p.jpg", "width": 1080, "height": 1080}]},
+            }
+            self.posts.insert(0, media)
+            return media
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _kind(self):
+        path = urlsplit(self.path).path
+        if path.startswith("/rupload_"):
+            return "rupload"
+        if path == "/api/v1/media/configure/":
+            return "configure"
+        if path.startswith(f"/api/v1/feed/user/{ACCOUNT_ID}/"):
+            return "feed"
+        return "other"
+
+    def _reply(self, payload):
+        body = json.dumps({**payload, "status": "ok"}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        kind = self._kind()
+        with self.server.lock:
+            if kind in self.server.calls:
+                self.server.calls[kind] += 1
+            faults = self.server.faults.get(kind) or []
+            fault = faults.pop(0) if faults else None
+        if fault == "drop":
+            self.close_connection = True
+            return
+        if kind == "configure":
+            signed = parse_qs(body.decode())["signed_body"][0]
+            payload = {"media": self.server.configure(json.loads(signed.split(".", 1)[1])["caption"])}
+        elif kind == "feed":
+            payload = {"items": list(self.server.posts), "more_available": False, "num_results": len(self.server.posts)}
+        elif kind == "rupload":
+            payload = {"upload_id": "1"}
+        else:
+            payload = {}
+        if fault == "drop_after":
+            self.close_connection = True
+            return
+        self._reply(payload)
+
+    do_GET = do_POST = _handle
+
+class ToStandIn(requests.adapters.HTTPAdapter):
+    """Sends every https request of the session to the stand-in over plain http."""
+    def __init__(self, port):
+        super().__init__()
+        self.port = port
+
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        request.url = f"http://127.0.0.1:{self.port}{parts.path}" + (f"?{parts.query}" if parts.query else "")
+        return super().send(request, **kwargs)
+
+class UploadRetryTests(unittest.TestCase):
+    def setUp(self):
+        self.server = self.start_stand_in()
+        self.client = self.client_for(self.server)
+
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        self.photo = os.path.join(workdir.name, "photo.jpg")
+        Image.new("RGB", (1080, 1080), (40, 90, 180)).save(self.photo, "JPEG")
+
+        # instagrapi waits 3s before configuring a photo; the stand-in is ready at once.
+        no_sleep_time = ModuleType("time")
+        no_sleep_time.__dict__.update(time.__dict__, sleep=lambda seconds: None)
+        patches = [
+            mock.patch.object(instagrapi.mixins.photo, "time", no_sleep_time),
+            mock.patch.object(main, "upload_retry_delay", lambda attempt, error: 0.2),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def start_stand_in(self):
+        server = InstagramStandIn()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def client_for(self, server):
+        client = main.InstaClient()
+        client.request_timeout = 0
+        client.delay_range = None
+        client.authorization_data = {"ds_user_id": str(ACCOUNT_ID), "sessionid": f"{ACCOUNT_ID}%3Atest"}
+        client.private.mount("https://", ToStandIn(server.server_address[1]))
+        return client
+
+    def upload(self, caption="stand-in post"):
+        return main.call_with_upload_retries(
+            self.client.photo_upload, self.photo, caption,
+            find_posted=partial(main.find_posted_media, self.client, media_type=1, caption=caption)
+        )
+
+    def test_upload_succeeds_first_time(self):
+        media = asyncio.run(self.upload())
+        self.assertEqual(len(self.server.posts), 1)
+        self.assertEqual(media.pk, self.server.posts[0]["pk"])
+        self.assertEqual(self.server.calls["feed"], 0)
+
+    def test_dropped_rupload_is_retried(self):
+        self.server.faults["rupload"] = ["drop"]
+        media = asyncio.run(self.upload())
+        self.assertEqual(self.server.calls["rupload"], 2)
+        self.assertEqual(self.server.calls["configure"], 1)
+        self.assertEqual(media.pk, self.server.posts[0]["pk"])
+
+    def test_lost_configure_response_does_not_post_twice(self):
+        self.server.faults["configure"] = ["drop_after"]
+        media = asyncio.run(self.upload())
+        self.assertEqual(self.server.calls["configure"], 1)
+        self.assertEqual(len(self.server.posts), 1)
+        self.assertEqual(media.pk, self.server.posts[0]["pk"])
+
+    def test_failed_check_retries_the_check_not_the_post(self):
+        self.server.faults["configure"] = ["drop_after"]
+        self.server.faults["feed"] = ["drop"]
+        media = asyncio.run(self.upload())
+        self.assertEqual(self.server.calls["feed"], 2)
+        self.assertEqual(len(self.server.posts), 1)
+        self.assertEqual(media.pk, self.server.posts[0]["pk"])
+
+    def test_gives_up_after_the_retry_budget(self):
+        self.server.faults["rupload"] = ["drop"] * (main.UPLOAD_RETRY_ATTEMPTS + 1)
+        with self.assertRaises(requests.ConnectionError):
+            asyncio.run(self.upload())
+        self.assertEqual(self.server.calls["rupload"], main.UPLOAD_RETRY_ATTEMPTS + 1)
+        self.assertEqual(self.server.posts, [])
+
+    def test_backoff_releases_held_locks(self):
+        self.server.faults["rupload"] = ["drop"]
+
+        async def scenario():
+            slot, account = asyncio.Semaphore(1), asyncio.Lock()
+            got_slot = asyncio.Event()
+
+            async def upload_holding_locks():
+                async with main.hold_upload_lock(slot), main.hold_upload_lock(account):
+                    return await self.upload()
+
+            async def other_upload():
+                async with slot:
+                    got_slot.set()
+
+            upload = asyncio.create_task(upload_holding_locks())
+            await asyncio.sleep(0)
+            other = asyncio.create_task(other_upload())
+            await asyncio.wait_for(got_slot.wait(), timeout=10)
+            self.assertFalse(upload.done(), "the other upload only got the slot after the retry finished")
+            media = await upload
+            await other
+            self.assertFalse(slot.locked())
+            self.assertFalse(account.locked())
+            return media
+
+        media = asyncio.run(scenario())
+        self.assertEqual(media.pk, self.server.posts[0]["pk"])
+
+    def test_concurrent_backoffs_keep_the_job_slot(self):
+        # One stand-in per account, so neither account's check sees the other's post.
+        servers = {"first": self.server, "second": self.start_stand_in()}
+        clients = {username: self.client_for(server) for username, server in servers.items()}
+        for server in servers.values():
+            server.faults["rupload"] = ["drop"]
+
+        class RecordingSemaphore(asyncio.Semaphore):
+            def release(self):
+                super().release()
+                self.peak_free = max(getattr(self, "peak_free", 0), self._value)
+
+        async def get_client(user_id, username):
+            return clients[username]
+
+        async def scenario():
+            slots = RecordingSemaphore(2)
+            with mock.patch.object(main, "get_insta_client_for_user", get_client), \
+                    mock.patch.object(main, "safe_edit_message", mock.AsyncMock()):
+                async with main.hold_upload_lock(slots):
+                    results = await main.upload_to_accounts(
+                        1, list(servers), "post", {"path": self.photo}, "stand-in post", [], None, None
+                    )
+                    self.assertEqual(getattr(slots, "peak_free", 1), 1, "a backing-off account gave up the job's slot")
+            self.assertEqual(slots._value, 2)
+            return results
+
+        results = asyncio.run(scenario())
+        self.assertEqual(set(results), set(servers))
+        for server in servers.values():
+            self.assertEqual(server.calls["rupload"], 2)
+            self.assertEqual(len(server.posts), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+"""
+Records the shape of incoming Telegram updates as compact JSON lines for offline replay
+(see benchmarks/replay_updates.py).
+
+A record keeps what drives load and nothing that identifies anyone: users become small
+sequential numbers, free text is reduced to its length, usernames and other dynamic parts of
+callback data are cut off, and media is described by type and size only. Lines are written
+by a background thread so recording never blocks the event loop.
+"""
+import re
+import json
+import time
+import queue
+import logging
+import threading
+
+logger = logging.getLogger("BotUser")
+
+# Telegram user and chat ids inside callback data; mapped like the sender ids.
+_LONG_NUMBER = re.compile(r"\d{6,}")
+_MEDIA_ATTRS = ("video", "photo", "document", "animation", "audio", "voice", "video_note", "sticker")
+
+class UpdateRecorder:
+    def __init__(self, path, keep_texts=(), callback_patterns=(), admin_id=None):
+        """
+        `keep_texts` are fixed labels (reply keyboard buttons) that are logged verbatim; any
+        other text only by length. `callback_patterns` are the compiled regexes of the callback
+        handlers; only the part of the data a pattern matches is kept.
+        """
+        self.path = path
+        self.keep_texts = set(keep_texts)
+        self.callback_patterns = list(callback_patterns)
+        self.admin_id = admin_id
+        self._users = {}
+        self._groups = {}
+        self._start = time.monotonic()
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._writer, name="update-recorder", daemon=True)
+        self._thread.start()
+
+    def _anon(self, mapping, value):
+        return mapping.setdefault(value, len(mapping) + 1)
+
+    def _anon_number(self, match):
+        number = int(match.group(0))
+        if number == self.admin_id:
+            return "0"
+        return str(self._anon(self._users, number))
+
+    def describe(self, update):
+        """The record for one Message or CallbackQuery, or None for anything else."""
+        user = getattr(update, "from_user", None)
+        if user is None:
+            return None
+        record = {"t": round(time.monotonic() - self._start, 3), "user": self._anon(self._users, user.id)}
+        if user.id == self.admin_id:
+            record["admin"] = True
+
+        data = getattr(update, "data", None)
+        if data is not None:
+            record["type"] = "callback_query"
+            record["data"] = self._redact_callback(data if isinstance(data, str) else data.decode(errors="replace"))
+            return record
+
+        record["type"] = "message"
+        for attr in _MEDIA_ATTRS:
+            media = getattr(update, attr, None)
+            if media is not None:
+                record["kind"] = attr
+                record["size"] = getattr(media, "file_size", 0) or 0
+                for field in ("mime_type", "duration", "width", "height"):
+                    value = getattr(media, field, None)
+                    if value:
+                        record[field] = value
+                if getattr(update, "media_group_id", None):
+                    record["media_group"] = self._anon(self._groups, update.media_group_id)
+                if getattr(update, "caption", None):
+                    record["caption_len"] = len(update.caption)
+                return record
+
+        text = getattr(update, "text", None) or ""
+        if text.startswith("/"):
+            record["kind"] = "command"
+            record["command"] = text[1:].split(maxsplit=1)[0].split("@")[0].lower() if len(text) > 1 else ""
+            record["args"] = len(text.split()) - 1
+        elif text in self.keep_texts:
+            record["kind"] = "button"
+            record["text"] = text
+        else:
+            record["kind"] = "text" if text else "other"
+            record["text_len"] = len(text)
+        return record
+
+    def _redact_callback(self, data):
+        for pattern in self.callback_patterns:
+            match = pattern.match(data)
+            if match:
+                kept = match.group(0)
+                record = _LONG_NUMBER.sub(self._anon_number, kept)
+                return record if len(kept) == len(data) else record + "…"
+        return "…"
+
+    def record(self, update):
+        try:
+            entry = self.describe(update)
+        except Exception as e:
+            logger.warning(f"Could not record update: {e}")
+            return
+        if entry is not None:
+            self._queue.put(json.dumps(entry, ensure_ascii=False, separators=(",", ":")))
+
+    def _writer(self):
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                line = self._queue.get()
+                if line is None:
+                    return
+                f.write(line + "\n")
+                if self._queue.empty():
+                    f.flush()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+def callback_patterns(dispatcher_groups):
+    """Collects the regex of every callback query handler filter, walking & / | / ~ combinations."""
+    patterns = []
+
+    def walk(flt):
+        if flt is None:
+            return
+        pattern = getattr(flt, "p", None)
+        if isinstance(pattern, re.Pattern):
+            patterns.append(pattern)
+        for attr in ("base", "other"):
+            walk(getattr(flt, attr, None))
+
+    for handlers in dispatcher_groups.values():
+        for handler in handlers:
+            if type(handler).__name__ == "CallbackQueryHandler":
+                walk(getattr(handler, "filters", None))
+    # Longest first, so "^upload_now$" wins over a shorter prefix pattern that also matches.
+    return sorted(patterns, key=lambda p: len(p.pattern), reverse=True)